@@ -19,6 +19,8 @@ from yt.mods import *
 import yt.utilities.physical_constants as phys_const
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm, Normalize
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from yt.data_objects.particle_filters import \
         particle_filter, filter_registry
 from yt.data_objects.particle_fields import \
@@ -29,6 +31,12 @@ from yt.data_objects.particle_fields import \
     particle_deposition_functions, \
     particle_vector_functions
 from yt.startup_tasks import YTParser, unparsed_args
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                'yt-sunrise_pipeline'))
+from plotWriter import PlotWriter
+
+# Plots are encoded and written to disk by background threads
+plot_writer = PlotWriter(nthreads=2)
 
 @particle_filter("finest", ["ParticleMassMsun"])
 def finest(pfilter, data):
@@ -141,9 +149,9 @@ def process_dataset(ds, center):
     #=======================
     for ptype in ["finest", "all"]:
         p = ProjectionPlot(ds, "z", ("deposit", "%s_density" % ptype), center = center)
-        p.save("./images/%s_z1_%s.png" % (ds, ptype))
+        plot_writer.save(p, "./images/%s_z1_%s.png" % (ds, ptype))
         p.zoom(60)
-        p.save("./images/%s_z2_%s.png" % (ds, ptype))
+        plot_writer.save(p, "./images/%s_z2_%s.png" % (ds, ptype))
 
     #=======================
     #  [3] PLOTS-2
@@ -169,15 +177,15 @@ def process_dataset(ds, center):
     den *= (RE[axis] - LE[axis])*ds['cm'] # dl
     proj = (num/den)
     proj[proj!=proj] = 1e-100 # remove NaN's
-    plt.clf()
+    fig = plt.figure()
     norm = LogNorm(colorbounds[0], colorbounds[1], clip=True)
     plt.imshow(proj.swapaxes(0,1), interpolation='nearest', origin='lower',
                norm = norm, extent = [-0.5*(w[0]/ds[w[1]]), 0.5*(w[0]/ds[w[1]]), 
                                        -0.5*(w[0]/ds[w[1]]), 0.5*(w[0]/ds[w[1]])])
     cb = plt.colorbar()
     cb.set_label(r"$\mathrm{Density}\/\/[\mathrm{g}/\mathrm{cm}^3]$")
-    plt.savefig("./images/%s_%s.png" % (ds, field[1]), dpi=150, bbox_inches='tight', \
-                pad_inches=0.1)
+    plot_writer.savefig(fig, "./images/%s_%s.png" % (ds, field[1]), dpi=150, 
+                        bbox_inches='tight', pad_inches=0.1)
     
     #=======================
     #  [4] PROFILES
@@ -198,12 +206,9 @@ def process_dataset(ds, center):
     shell_volume[1:] -= shell_volume_temp[0:-1]
     prof["AverageDMDensity"] /= shell_volume
 
-    plt.clf()
-    plt.loglog(prof["ParticleRadiuskpc"], prof["AverageDMDensity"], '-k')
-    plt.xlabel(r"$\mathrm{Radius}\/\/[\mathrm{kpc}]$")
-    plt.ylabel(r"$\mathrm{Dark}\/\mathrm{Matter}\/\mathrm{Density}\/\/[\mathrm{g}/\mathrm{cm}^3]$")
-    plt.ylim(1e-29, 1e-23)
-    plt.savefig("./images/%s_radprof.png" % ds)
+    plot_writer.savefig(plot_radprof(np.array(prof["ParticleRadiuskpc"]),
+                                     np.array(prof["AverageDMDensity"])),
+                        "./images/%s_radprof.png" % ds)
 
     fout = open("./images/%s_profile.dat" % ds, "w")
     fout.write("# sphere_radius:"+str(sphere_radius)+"\n")
@@ -230,7 +235,20 @@ def process_dataset(ds, center):
         pw = proj.to_pw(fields = [field], center = center, width = w)
         pw.set_zlim(field, 1e-31, 1e-24)
         pw.annotate_hop_circles(halos, annotate=True, print_halo_mass=False, min_size=1000)
-        pw.save("./images/%s_Projection_z_%s_subset.png" % (ds, field[1]))
+        plot_writer.save(pw, "./images/%s_Projection_z_%s_subset.png" % (ds, field[1]))
+
+    plot_writer.flush()
+    plot_writer.report()
+
+def plot_radprof(radius, density):
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.loglog(radius, density, '-k')
+    ax.set_xlabel(r"$\mathrm{Radius}\/\/[\mathrm{kpc}]$")
+    ax.set_ylabel(r"$\mathrm{Dark}\/\mathrm{Matter}\/\mathrm{Density}\/\/[\mathrm{g}/\mathrm{cm}^3]$")
+    ax.set_ylim(1e-29, 1e-23)
+    return fig
 
 if __name__ == '__main__':
     parser = YTParser(description = 'AGORA analysis')
@@ -255,3 +273,4 @@ if __name__ == '__main__':
     for output in sorted(outputs):  
         mylog.info("Examining %s", output)
         output_functions[output]()
+    plot_writer.close()
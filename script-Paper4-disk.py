@@ -10,10 +10,16 @@
 #        (especially with RAMSES data)
 #
 #######################################################################
-import sys
+import sys, os
 from yt.mods import *
 import matplotlib.colorbar as cb
 import yt.utilities.physical_constants as constants
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yt-sunrise_pipeline'))
+from plotWriter import PlotWriter
+
+# Figures are encoded and written by background threads while the next
+# snapshot is being analyzed
+plot_writer = PlotWriter(nthreads=2)
 
 # If RAMSES data, use pf=load('/path/to/data', fields=["list of fields"]).  
 # For other codes, the syntax to load may be different - see the yt docs.  
@@ -66,15 +72,15 @@ for time in range(5):
             p._autoset_label()
 
         if time == 0:
-            fig.savefig("Enzo_0Myr_Sigma")
+            plot_writer.savefig(fig, "Enzo_0Myr_Sigma")
         if time == 1:
-            fig.savefig("Enzo_250Myr_Sigma")
+            plot_writer.savefig(fig, "Enzo_250Myr_Sigma")
         if time == 2:
-            fig.savefig("Enzo_500Myr_Sigma")
+            plot_writer.savefig(fig, "Enzo_500Myr_Sigma")
         if time == 3:
-            fig.savefig("Enzo_750Myr_Sigma")
+            plot_writer.savefig(fig, "Enzo_750Myr_Sigma")
         if time == 4:
-            fig.savefig("Enzo_1000Myr_Sigma")
+            plot_writer.savefig(fig, "Enzo_1000Myr_Sigma")
 
         # Plot projected cell size weighted by inverse square of cell V (c/o Sam Leitner)    
         def _CellSizepc(field,data): return (data['CellVolume'])**(1/3.)/constants.cm_per_pc
@@ -115,16 +121,16 @@ for time in range(5):
             p.colorbar=cbar
             p._autoset_label()
 
-            if time == 0:
-                figa.savefig("Enzo_cellsize_0Myr")
-            if time == 1:
-                figa.savefig("Enzo_cellsize_250Myr")
-            if time == 2:
-                figa.savefig("Enzo_cellsize_500Myr")
-            if time == 3:
-                figa.savefig("Enzo_cellsize_750Myr")
-            if time == 4:
-                figa.savefig("Enzo_cellsize_1000Myr")
+        if time == 0:
+            plot_writer.savefig(figa, "Enzo_cellsize_0Myr")
+        if time == 1:
+            plot_writer.savefig(figa, "Enzo_cellsize_250Myr")
+        if time == 2:
+            plot_writer.savefig(figa, "Enzo_cellsize_500Myr")
+        if time == 3:
+            plot_writer.savefig(figa, "Enzo_cellsize_750Myr")
+        if time == 4:
+            plot_writer.savefig(figa, "Enzo_cellsize_1000Myr")
 
         # Create cumulative and mass fraction histograms of Cell Mass for final timestep
         if time ==4:
@@ -138,4 +144,7 @@ for time in range(5):
             p.set_log_field(False)
             p2=pc.add_profile_sphere(40.0,'kpc',["CellMassMsun","Mfrac"],weight=None,x_bins=100,x_log=True,x_bounds=[1.0e4,1.0e8],accumulation=True)
             p2.set_log_field(False)
-            pc.save("Enzo_histogram")
+            plot_writer.save(pc, "Enzo_histogram")
+
+plot_writer.close()
+plot_writer.report()
@@ -0,0 +1,209 @@
+'''
+Fixtures of the pipeline tests: a small simulation with one exported
+snapshot, as genSunriseInput.py leaves it, the impression and pipeline
+install dirs setupSunriseRun.py takes its templates from, and a snapshot
+of a galaxy for the analysis stages.
+'''
+import os, sys
+import numpy as np
+import pyfits
+import pytest
+
+import sunriseCameras
+
+
+pipeline_dir = os.path.dirname(os.path.abspath(__file__))
+
+config_templates = {
+    'sfrhist.config': 'include_file         $RUN_DIR/input/sfrhist_base.stub\n'
+                      'snapshot_file        $RUN_DIR/input/initial.fits\n'
+                      'output_file          $RUN_DIR/output/sfrhist.fits\n'
+                      'translate_origin     0 0 0\n',
+    'mcrx.config': 'input_file           $RUN_DIR/output/sfrhist.fits\n'
+                   'output_file          $RUN_DIR/output/mcrx.fits\n'
+                   'camera_positions     $RUN_DIR/input/cameras\n'
+                   'nrays_nonscatter     1e6\n',
+    'broadband.config': 'input_file           $RUN_DIR/output/mcrx.fits\n'
+                        'output_file          $RUN_DIR/output/broadband.fits\n'
+                        'filter_list          $FILTERSET\n',
+    'broadbandz.config': 'input_file           $RUN_DIR/output/mcrx.fits\n'
+                         'output_file          $RUN_DIR/output/broadbandz.fits\n'
+                         'filter_list          $FILTERSETZ\n'
+                         'redshift             $REDSHIFT\n',
+}
+
+
+def write_export(fits_file, nstars=50, ncells=64, seed=0):
+    '''
+    A FITS export with the HDUs of sunrise_octree_exporter, PARTICLEDATA
+    being the fifth
+    '''
+    rng = np.random.RandomState(seed)
+    grid = pyfits.BinTableHDU.from_columns(
+        [pyfits.Column('mass_gas', 'D', array=rng.uniform(1, 2, ncells)),
+         pyfits.Column('gas_temp_m', 'D', array=rng.uniform(1e3, 1e4, ncells))],
+        name='GRIDDATA')
+    particles = pyfits.BinTableHDU.from_columns(
+        [pyfits.Column('position', '3D', array=rng.uniform(-5, 5, (nstars, 3))),
+         pyfits.Column('velocity', '3D', array=rng.normal(0, 100, (nstars, 3))),
+         pyfits.Column('mass', 'D', array=rng.uniform(1e4, 1e5, nstars)),
+         pyfits.Column('age', 'D', array=10**rng.uniform(6, 10, nstars)),
+         pyfits.Column('metallicity', 'D', array=rng.uniform(1e-3, 2e-2, nstars))],
+        name='PARTICLEDATA')
+    structure = pyfits.BinTableHDU.from_columns(
+        [pyfits.Column('structure', 'L', array=np.zeros(ncells+1, dtype=bool))],
+        name='GRIDSTRUCTURE')
+    pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.ImageHDU(name='MAKEGRID'), structure,
+                    grid, particles]).writeto(fits_file)
+
+# Stand-ins of the Sunrise executables, run with the config file. mcrx
+# writes the HDUs mcrxAux.py reads.
+stub_config = '''
+import sys
+import numpy as np
+import pyfits
+config = dict([l.split(None, 1) for l in open(sys.argv[1]) if len(l.split()) > 1])
+output = config['output_file'].strip()
+'''
+
+sunrise_stubs = {
+    'sfrhist': stub_config+'''
+pd = pyfits.getdata(config['snapshot_file'].strip(), 'PARTICLEDATA')
+pyfits.HDUList([pyfits.PrimaryHDU(), pyfits.BinTableHDU(pd, name='PARTICLEDATA')]).writeto(output)
+''',
+    'mcrx': stub_config+'''
+mcrx = pyfits.ImageHDU(name='MCRX')
+mcrx.header['N_CAMERA'] = 1
+structure = pyfits.BinTableHDU.from_columns(
+    [pyfits.Column('structure', 'L', array=np.zeros(9, dtype=bool))], name='GRIDSTRUCTURE')
+pyfits.HDUList([pyfits.PrimaryHDU(), mcrx, structure,
+                pyfits.ImageHDU(np.zeros((3, 4, 4)), name='CAMERA0'),
+                pyfits.ImageHDU(np.zeros((3, 4, 4)), name='CAMERA0-NONSCATTER')]).writeto(output)
+''',
+    'broadband': stub_config+'''
+pyfits.HDUList([pyfits.PrimaryHDU(),
+                pyfits.ImageHDU(np.zeros((1, 4, 4)), name='CAMERA0-BROADBAND')]).writeto(output)
+''',
+}
+
+
+def write_stubs(src_dir):
+    '''
+    Write the Sunrise stubs as executables of src_dir, run by the
+    interpreter of the tests
+    '''
+    for name, text in sunrise_stubs.iteritems():
+        filename = os.path.join(src_dir, name)
+        fh = open(filename, 'w')
+        fh.write('#!%s\n'%sys.executable+text)
+        fh.close()
+        os.chmod(filename, 0755)
+
+
+@pytest.fixture
+def sunrise_inputs(tmpdir, monkeypatch):
+    '''
+    A simulation dir with one snapshot input dir made by genSunriseInput.py,
+    with the impression, blackbox, Sunrise (with stub executables) and
+    pipeline install dirs, and the environment of setupSunriseRun.py.
+    Returns their paths.
+    '''
+    sim_dir = tmpdir.mkdir('sim')
+    input_dir = sim_dir.mkdir('analysis').mkdir('sunrise_analysis')
+    snap_dir = input_dir.mkdir('10MpcBox_csf512_a0.500')
+    fits_file = str(snap_dir.join('10MpcBox_csf512_a0.500.fits'))
+    write_export(fits_file)
+    names, rows = ['face', 'edge'], np.array([[0, 0, 100, 0, 0, -1, 0, 1, 0, 0.5],
+                                              [100, 0, 0, -1, 0, 0, 0, 0, 1, 0.5]])
+    sunriseCameras.write_cameras(fits_file.replace('.fits', '.cameras'), rows)
+    sunriseCameras.write_camnames(fits_file.replace('.fits', '.camnames'), names)
+    np.save(fits_file.replace('.fits', '_export_info.npy'),
+            {'sim_name':'10MpcBox', 'scale':0.5, 'export_center':np.array([0.0, 0.0, 0.0]),
+             'halo_id':7})
+
+    imp_dir = tmpdir.mkdir('impression')
+    export_input = imp_dir.mkdir('export').mkdir('input')
+    for name, text in config_templates.iteritems():
+        export_input.join(name).write(text)
+    for name in ['filters_redshifted', 'filters_redshifted_short', 'filters_restframe',
+                 'filters_restframe_short']:
+        export_input.join(name).write('u_SDSS.res\n')
+
+    pipe_dir = tmpdir.mkdir('pipe')
+    pipe_dir.join('scripts').mksymlinkto(pipeline_dir)
+    sunrise_dir = tmpdir.mkdir('sunrise')
+    write_stubs(str(sunrise_dir.mkdir('src')))
+
+    monkeypatch.setenv('AGORA_PIPE_INSTALL', str(pipe_dir))
+    monkeypatch.setenv('IMPRESSION', str(imp_dir))
+    monkeypatch.setenv('BLACKBOX', str(tmpdir.mkdir('blackbox')))
+    monkeypatch.setenv('SUNRISE_DIR', str(sunrise_dir))
+    return {'tmpdir':tmpdir, 'sim_dir':str(sim_dir), 'input_dir':str(input_dir),
+            'snap_dir':str(snap_dir), 'fits_file':fits_file, 'impression':str(imp_dir),
+            'sunrise_dir':str(sunrise_dir), 'pipe_dir':str(pipe_dir)}
+
+
+@pytest.fixture
+def setup_runs(sunrise_inputs, monkeypatch):
+    '''
+    Set up the runs of the snapshot of sunrise_inputs as setupSunriseRun.py
+    does for the given command line options. Returns their (run_name,
+    short, run_dir), None for the runs that were skipped.
+    '''
+    import setupSunriseRun
+
+    def setup(*options):
+        monkeypatch.setattr(sys, 'argv', ['setupSunriseRun.py', sunrise_inputs['sim_dir']]+
+                            list(options))
+        args = setupSunriseRun.parse()
+        sweep = any([args[s] for s in ['sweep_parameter_sets', 'sweep_mcrx', 'sweep_sfrhist',
+                                       'sweep_broadband', 'sweep_pbs']])
+        combos = setupSunriseRun.expand_sweep(args) if sweep else [args]
+        # The input dir as the __main__ of setupSunriseRun.py spells it
+        input_dir = sunrise_inputs['sim_dir']+'/'+args['input_dir'].replace('sim_dir', '')
+        runs = []
+        for in_dir, fits_file, info_file in setupSunriseRun.find_inputs(input_dir):
+            for combo in combos:
+                runs.append(setupSunriseRun.setup_task(
+                        (fits_file, info_file, in_dir, combo, sunrise_inputs['sunrise_dir'],
+                         sunrise_inputs['impression'], os.environ['BLACKBOX'])))
+        return runs
+    return setup
+
+
+@pytest.fixture
+def galaxy_snapshot():
+    '''
+    A 32**3 uniform grid snapshot of a 1 Mpc box with the gas fields of the
+    ART snapshots, and a clump of stars at (510, 510, 510) kpc in a dark
+    matter halo at the center of the box
+    '''
+    yt = pytest.importorskip('yt')
+    yt.funcs.mylog.setLevel(40)
+
+    rng = np.random.RandomState(0)
+    n = 32
+    rho = rng.uniform(1e-27, 1e-25, (n, n, n))
+    data = {'density': (rho, 'g/cm**3'), 'metal_ia_density': (0.01*rho, 'g/cm**3'),
+            'metal_ii_density': (0.02*rho, 'g/cm**3')}
+    for ax in 'xyz':
+        data['momentum_'+ax] = (rho*rng.normal(0, 1e7, (n, n, n)), 'g/cm**2/s')
+    for ptype, npart, center, sigma in [('stars', 2000, 510.0, 15.0),
+                                        ('darkmatter', 3000, 500.0, 60.0)]:
+        pos = rng.normal(center, sigma, (npart, 3)).clip(1.0, 999.0)
+        for i, ax in enumerate('xyz'):
+            data[ptype, 'particle_position_'+ax] = (pos[:,i]/1000.0, 'code_length')
+            data[ptype, 'particle_velocity_'+ax] = (rng.normal(0, 50, npart), 'km/s')
+        data[ptype, 'particle_mass'] = (rng.uniform(1e5, 1e6, npart), 'Msun')
+        data[ptype, 'particle_metallicity'] = (rng.uniform(0, 0.02, npart), '')
+    ds = yt.load_uniform_grid(data, [n]*3, length_unit=(1.0, 'Mpc'), mass_unit=(1.0, 'Msun'),
+                              bbox=np.array([[0.0, 1.0]]*3), nprocs=1)
+
+    # The ART frontend has these as gas fields
+    for name in ['metal_ia_density', 'metal_ii_density', 'momentum_x', 'momentum_y',
+                 'momentum_z']:
+        def _alias(field, data, name=name):
+            return data['stream', name]
+        ds.add_field(('gas', name), function=_alias, units=data[name][1],
+                     sampling_type='cell')
+    return ds
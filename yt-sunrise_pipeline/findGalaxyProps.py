@@ -8,7 +8,7 @@ by Miguel Rocha  - miguel@scitechanalytics.com
 import os, sys, argparse
 from glob import glob
 import numpy as np
-from visnap.general.halo_particles import axis_ratios
+from genCutouts import load_cutout, cell_sphere
 
 
 def parse():
@@ -48,6 +48,11 @@ def parse():
                         help='File containing the Most Massive Progenitor branch properties. '\
                              'A python dictionary is expected as generated by findHostandMMPB.py.')
 
+    parser.add_argument('--cutout_dir', default=None,
+                        help='Directory with the cutouts written by genCutouts.py, e.g. '\
+                            'sim_dir/analysis/cutouts/. If given the cutouts are analyzed '\
+                            'instead of the snapshots.')
+
     parser.add_argument('--out_dir',default='sim_dir/analysis/catalogs/',
                         help='Directory where the output will be placed.') 
 
@@ -124,6 +129,8 @@ def find_shapes(center, pos, ds, nrad=10, rmax=None):
         radii = np.linspace(0.1*rmax, rmax, nrad)
     else:
         radii = np.array([])
+    if radii.size:
+        from visnap.general.halo_particles import axis_ratios
     
     c_to_a = np.empty(radii.size)     
     b_to_a = np.empty(radii.size)
@@ -144,6 +151,132 @@ def find_shapes(center, pos, ds, nrad=10, rmax=None):
     return radii, c_to_a, b_to_a, axes        
        
 
+def galaxy_properties(ds, halo_center, halo_rvir, center='hist', sc_sphere_r=0.25,
+                      shapes_nrad=10, shapes_rmax=20.0, particles=None):
+    '''
+    Properties of the galaxy in the halo of halo_center and halo_rvir in
+    ds, as a dictionary with one entry per field of the galaxy properties
+    file but scale. The particles are read from particles if given, the
+    particle dataset of a cutout (see genCutouts.load_cutout), and from ds
+    otherwise.
+    '''
+    import yt
+
+    props = {}
+    pds = ds if particles is None else particles
+    to_pds = lambda a: pds.arr(a.in_units('kpc').value, 'kpc')
+
+    # Generate sphere selection
+    hc_sphere = cell_sphere(ds, halo_center, halo_rvir)
+    hp_sphere = hc_sphere if pds is ds else pds.sphere(to_pds(halo_center), to_pds(halo_rvir))
+
+    # Get total stellar mass 
+    stars_mass = hp_sphere[('stars', 'particle_mass')].in_units('Msun')
+    stars_total_mass = stars_mass.sum().value[()]
+    props['stars_total_mass'] = stars_total_mass
+
+    # Get center of mass of stars
+    stars_pos_x = hp_sphere[('stars', 'particle_position_x')].in_units('kpc')
+    stars_pos_y = hp_sphere[('stars', 'particle_position_y')].in_units('kpc')
+    stars_pos_z = hp_sphere[('stars', 'particle_position_z')].in_units('kpc')
+    stars_com = np.array([np.dot(stars_pos_x, stars_mass)/stars_total_mass, 
+                          np.dot(stars_pos_y, stars_mass)/stars_total_mass, 
+                          np.dot(stars_pos_z, stars_mass)/stars_total_mass])
+    props['stars_com'] = stars_com
+    
+    # Get max density of stars (value, location), the location being the
+    # last three entries of max_location in every yt version
+    stars_maxdens = hc_sphere.quantities.max_location(('deposit', 'stars_cic'))
+    stars_maxdens_val = stars_maxdens[0].in_units('Msun/kpc**3').value[()]
+    stars_maxdens_loc = np.array([x.in_units('kpc').value[()] for x in stars_maxdens[-3:]])
+    props['stars_maxdens'] = (stars_maxdens_val, stars_maxdens_loc)
+
+    # Get refined histogram center of stars
+    stars_pos = np.array([stars_pos_x, stars_pos_y, stars_pos_z]).transpose()
+    stars_hist_center = find_hist_center(stars_pos, stars_mass)
+    props['stars_hist_center'] = stars_hist_center
+
+    # Define center of stars
+    if center == 'max_dens': stars_center = stars_maxdens_loc
+    elif center == 'com': stars_center = stars_com
+    else: stars_center = stars_hist_center
+    stars_center = ds.arr(stars_center, 'kpc')
+   
+    # Get shape of stars
+    radii, c_to_a, b_to_a, axes = \
+        find_shapes(stars_center, stars_pos, ds, shapes_nrad, shapes_rmax)
+    props['stars_c_to_a'] = (radii, c_to_a)
+    props['stars_b_to_a'] = (radii, b_to_a)
+    props['stars_shape_axes'] = (radii, axes)
+
+    # Get shape of dm
+    dm_pos_x = hp_sphere[('darkmatter', 'particle_position_x')].in_units('kpc')
+    dm_pos_y = hp_sphere[('darkmatter', 'particle_position_y')].in_units('kpc')
+    dm_pos_z = hp_sphere[('darkmatter', 'particle_position_z')].in_units('kpc')
+    dm_pos = np.array([dm_pos_x, dm_pos_y, dm_pos_z]).transpose()
+    radii, c_to_a, b_to_a, axes = \
+        find_shapes(stars_center, dm_pos, ds, shapes_nrad, shapes_rmax)
+    props['dm_c_to_a'] = (radii, c_to_a)
+    props['dm_b_to_a'] = (radii, b_to_a)
+    props['dm_shape_axes'] = (radii, axes)
+
+    # Get stellar density profile
+    ssphere_r = sc_sphere_r*halo_rvir.in_units('code_length')
+    while ssphere_r < ds.index.get_smallest_dx():
+        ssphere_r = 2.0*ssphere_r
+    sc_sphere =  cell_sphere(ds, stars_center, ssphere_r)
+    try:
+        p_plot = yt.ProfilePlot(sc_sphere, 'radius', 'stars_mass', n_bins=100,
+                                weight_field=None, accumulation=True)
+        p_plot.set_unit('radius', 'kpc')
+        p_plot.set_unit('stars_mass', 'Msun')
+        p = p_plot.profiles[0]
+        radii, smass = p.x.value, p['stars_mass'].value 
+        rhalf = radii[smass >= 0.5*smass.max()][0]
+    except (IndexError, ValueError): # not enough stars found
+        radii, smass = None, None 
+        rhalf = None
+    props['stars_rhalf'] = rhalf
+    props['stars_mass_profile'] = (radii, smass)
+
+    # Get angular momentum of stars
+    sp_sphere = sc_sphere if pds is ds else pds.sphere(to_pds(stars_center), to_pds(ssphere_r))
+    try:
+        x, y, z = [sp_sphere[('stars', 'particle_position_%s'%s)] for s in 'xyz'] 
+        vx, vy, vz = [sp_sphere[('stars', 'particle_velocity_%s'%s)] for s in 'xyz'] 
+        mass = sp_sphere[('stars', 'particle_mass')]
+        metals = sp_sphere[('stars', 'particle_metallicity')]
+        stars_L = L_crossing(x, y, z, vx, vy, vz, mass*metals, sp_sphere.center)
+    except IndexError: # no stars found
+        stars_L = [None, None, None]
+    props['stars_L'] = stars_L
+    del(sc_sphere, sp_sphere)
+
+    # Get total mass of gas
+    gas_mass = hc_sphere[('gas', 'cell_mass')].in_units('Msun')
+    gas_total_mass = gas_mass.sum().value[()]
+    props['gas_total_mass'] = gas_total_mass
+    
+    # Get max density of gas
+    gas_maxdens = hc_sphere.quantities.max_location(('gas', 'density'))
+    gas_maxdens_val = gas_maxdens[0].in_units('Msun/kpc**3').value[()]
+    gas_maxdens_loc = np.array([x.in_units('kpc').value[()] for x in gas_maxdens[-3:]])
+    props['gas_maxdens'] = (gas_maxdens_val, gas_maxdens_loc)
+    
+    # Get angular momentum of gas
+    gas_center = ds.arr(gas_maxdens_loc, 'kpc')
+    gc_sphere =  cell_sphere(ds, gas_center, ssphere_r)
+    x, y, z = [gc_sphere[('index', '%s'%s)] for s in 'xyz'] 
+    vx, vy, vz = [gc_sphere[('gas', 'momentum_%s'%s)] for s in 'xyz'] # momentum density
+    cell_volume = gc_sphere[('index', 'cell_volume')]
+    metals = gc_sphere[('gas', 'metal_ia_density')] + gc_sphere[('gas', 'metal_ii_density')]
+    gas_L = L_crossing(x, y, z, vx, vy, vz, metals*cell_volume**2, gc_sphere.center)
+    props['gas_L'] = gas_L
+    del(gc_sphere, hc_sphere, hp_sphere)
+
+    return props
+
+
 def L_crossing(x, y, z, vx, vy, vz, weight, center):
     x, y, z = x-center[0], y-center[1],z-center[2]
     cx, cy, cz = y*vz - z*vy, z*vx - x*vz, x*vy - y*vx
@@ -183,6 +316,7 @@ if __name__ == "__main__":
     center = args['center']
     sc_sphere_r = args['sc_sphere_r']
     shapes_nrad, shapes_rmax = args['shapes_nrad'], args['shapes_rmax']
+    cutout_dir = args['cutout_dir']
     
         
     # Loop over simulation directories    
@@ -209,9 +343,19 @@ if __name__ == "__main__":
             mmpb_file = mmpb_files[0]
             mmpb_props = np.load(mmpb_file)[()] 
     
-        # Generate data series
-        snaps = glob(sim_dir+'/'+snap_base+'*')
-        ts = yt.DatasetSeries(snaps)
+        # Generate data series, of the cells of the cutouts and their particles
+        # if they are analyzed
+        particles = {}
+        if cutout_dir:
+            cutouts = glob(cutout_dir.replace('sim_dir', sim_dir+'/')+'/'+
+                           snap_base+'*_cutout.h5')
+            ts = []
+            for cutout in sorted(cutouts):
+                cells, particles[cells] = load_cutout(cutout)
+                ts.append(cells)
+        else:
+            snaps = glob(sim_dir+'/'+snap_base+'*')
+            ts = yt.DatasetSeries(snaps)
 
         # Initialize galaxy properties dictionary 
         galaxy_props = {}
@@ -235,124 +379,19 @@ if __name__ == "__main__":
             print '\nFinding galaxy properties for snapshot ', ds.parameter_filename.split('/')[-1]
             print ''
 
-            galaxy_props['scale'] = np.append(galaxy_props['scale'], scale)
             idx = np.argwhere(mmpb_props['scale'] == scale)[0][0]
-
-            # Generate sphere selection
             halo_center = ds.arr([mmpb_props['x'][idx], mmpb_props['y'][idx],
                                   mmpb_props['z'][idx]], 'Mpccm/h') # halo props are in Rockstar units
             halo_rvir = ds.arr(mmpb_props['rvir'][idx], 'kpccm/h')  
-            hc_sphere = ds.sphere(halo_center, halo_rvir)
-
-            # Get total stellar mass 
-            stars_mass = hc_sphere[('stars', 'particle_mass')].in_units('Msun')
-            stars_total_mass = stars_mass.sum().value[()]
-            galaxy_props['stars_total_mass'] = np.append(galaxy_props['stars_total_mass'],
-                                                         stars_total_mass)
-
-            # Get center of mass of stars
-            stars_pos_x = hc_sphere[('stars', 'particle_position_x')].in_units('kpc')
-            stars_pos_y = hc_sphere[('stars', 'particle_position_y')].in_units('kpc')
-            stars_pos_z = hc_sphere[('stars', 'particle_position_z')].in_units('kpc')
-            stars_com = np.array([np.dot(stars_pos_x, stars_mass)/stars_total_mass, 
-                                  np.dot(stars_pos_y, stars_mass)/stars_total_mass, 
-                                  np.dot(stars_pos_z, stars_mass)/stars_total_mass])
-            galaxy_props['stars_com'].append(stars_com)
-            
-            # Get max density of stars (value, location)
-            stars_maxdens = hc_sphere.quantities.max_location(('deposit', 'stars_cic'))
-            stars_maxdens_val = stars_maxdens[0].in_units('Msun/kpc**3').value[()]
-            stars_maxdens_loc = np.array([stars_maxdens[2].in_units('kpc').value[()], 
-                                          stars_maxdens[3].in_units('kpc').value[()], 
-                                          stars_maxdens[4].in_units('kpc').value[()]])
-            galaxy_props['stars_maxdens'].append((stars_maxdens_val, stars_maxdens_loc))
-
-            # Get refined histogram center of stars
-            stars_pos = np.array([stars_pos_x, stars_pos_y, stars_pos_z]).transpose()
-            stars_hist_center = find_hist_center(stars_pos, stars_mass)
-            galaxy_props['stars_hist_center'].append(stars_hist_center)
-
-            # Define center of stars
-            if center == 'max_dens': stars_center = stars_maxdens_loc
-            elif center == 'com': stars_center = stars_com
-            else: stars_center = stars_hist_center
-            stars_center = ds.arr(stars_center, 'kpc')
-   
-            # Get shape of stars
-            radii, c_to_a, b_to_a, axes = \
-                find_shapes(stars_center, stars_pos, ds, shapes_nrad, shapes_rmax)
-            galaxy_props['stars_c_to_a'].append((radii, c_to_a))
-            galaxy_props['stars_b_to_a'].append((radii, b_to_a))    
-            galaxy_props['stars_shape_axes'].append((radii, axes))
-
-            # Get shape of dm
-            dm_pos_x = hc_sphere[('darkmatter', 'particle_position_x')].in_units('kpc')
-            dm_pos_y = hc_sphere[('darkmatter', 'particle_position_y')].in_units('kpc')
-            dm_pos_z = hc_sphere[('darkmatter', 'particle_position_z')].in_units('kpc')
-            dm_pos = np.array([dm_pos_x, dm_pos_y, dm_pos_z]).transpose()
-            radii, c_to_a, b_to_a, axes = \
-                find_shapes(stars_center, dm_pos, ds, shapes_nrad, shapes_rmax)
-            galaxy_props['dm_c_to_a'].append((radii, c_to_a))
-            galaxy_props['dm_b_to_a'].append((radii, b_to_a))    
-            galaxy_props['dm_shape_axes'].append((radii, axes))
-
-            # Get stellar density profile
-            ssphere_r = sc_sphere_r*halo_rvir.in_units('code_length')
-            while ssphere_r < ds.index.get_smallest_dx():
-                ssphere_r = 2.0*ssphere_r
-            sc_sphere =  ds.sphere(stars_center, ssphere_r)
-            try:
-                p_plot = yt.ProfilePlot(sc_sphere, 'radius', 'stars_mass', n_bins=100,
-                                        weight_field=None, accumulation=True)
-                p_plot.set_unit('radius', 'kpc')
-                p_plot.set_unit('stars_mass', 'Msun')
-                p = p_plot.profiles[0]
-                radii, smass = p.x.value, p['stars_mass'].value 
-                rhalf = radii[smass >= 0.5*smass.max()][0]
-            except (IndexError, ValueError): # not enough stars found
-                radii, smass = None, None 
-                rhalf = None
-            galaxy_props['stars_rhalf'] = np.append(galaxy_props['stars_rhalf'], rhalf)
-            galaxy_props['stars_mass_profile'].append((radii, smass))             
-
-            # Get angular momentum of stars
-            try:
-                x, y, z = [sc_sphere[('stars', 'particle_position_%s'%s)] for s in 'xyz'] 
-                vx, vy, vz = [sc_sphere[('stars', 'particle_velocity_%s'%s)] for s in 'xyz'] 
-                mass = sc_sphere[('stars', 'particle_mass')]
-                metals = sc_sphere[('stars', 'particle_metallicity')]
-                stars_L = L_crossing(x, y, z, vx, vy, vz, mass*metals, sc_sphere.center)
-            except IndexError: # no stars found
-                stars_L = [None, None, None]
-            galaxy_props['stars_L'].append(stars_L)
-            del(sc_sphere)
-
-            # Get total mass of gas
-            gas_mass = hc_sphere[('gas', 'cell_mass')].in_units('Msun')
-            gas_total_mass = gas_mass.sum().value[()]
-            galaxy_props['gas_total_mass'] = np.append(galaxy_props['gas_total_mass'], 
-                                                       gas_total_mass)
-            
-            # Get max density of gas
-            gas_maxdens = hc_sphere.quantities.max_location(('gas', 'density'))
-            gas_maxdens_val = gas_maxdens[0].in_units('Msun/kpc**3').value[()]
-            gas_maxdens_loc = np.array([gas_maxdens[2].in_units('kpc').value[()], 
-                                        gas_maxdens[3].in_units('kpc').value[()], 
-                                        gas_maxdens[4].in_units('kpc').value[()]])
-            galaxy_props['gas_maxdens'].append((gas_maxdens_val, gas_maxdens_loc)) 
-            
-            # Get angular momentum of gas
-            gas_center = ds.arr(gas_maxdens_loc, 'kpc')
-            gc_sphere =  ds.sphere(gas_center, ssphere_r)
-            x, y, z = [gc_sphere[('index', '%s'%s)] for s in 'xyz'] 
-            vx, vy, vz = [gc_sphere[('gas', 'momentum_%s'%s)] for s in 'xyz'] # momentum density
-            cell_volume = gc_sphere[('index', 'cell_volume')]
-            metals = gc_sphere[('gas', 'metal_ia_density')] + gc_sphere[('gas', 'metal_ii_density')]
-            gas_L = L_crossing(x, y, z, vx, vy, vz, metals*cell_volume**2, gc_sphere.center)
-            galaxy_props['gas_L'].append(gas_L)
-            del(gc_sphere)
-                               
-            del(hc_sphere)                    
+
+            props = galaxy_properties(ds, halo_center, halo_rvir, center, sc_sphere_r,
+                                      shapes_nrad, shapes_rmax, particles.get(ds))
+            props['scale'] = scale
+            for field in fields:
+                if field in ['scale', 'stars_total_mass', 'stars_rhalf', 'gas_total_mass' ]:
+                    galaxy_props[field] = np.append(galaxy_props[field], props[field])
+                else:
+                    galaxy_props[field].append(props[field])
 
         # Save galaxy props
         galaxy_props_file = mmpb_file.replace('mmpb', 'galaxy')    
@@ -0,0 +1,118 @@
+'''
+Dump the headers of the FITS files of a Sunrise run to data-fits_headers,
+in the format of the old printheaders.py, and to a JSON index. Only the
+header blocks are read: the data of each HDU is skipped using the sizes
+in its header (see fitsLayers.hdu_spans), and the files are read
+concurrently.
+
+Usage (in the output dir of a run):
+
+    python fitsHeaders.py --output data-fits_headers --index data-fits_headers.json
+    python fitsHeaders.py mcrx.fits broadband.fits
+'''
+import os, sys, argparse
+import json
+from glob import glob
+from multiprocessing.pool import ThreadPool
+
+import fitsLayers
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Dump the headers of FITS files without reading their data.
+                                 ''')
+
+    parser.add_argument('files', nargs='*', default=None,
+                        help='FITS files. Defaults to *fits and ../input/*fits.')
+
+    parser.add_argument('--output', default=None,
+                        help='File the headers are written to. Defaults to stdout.')
+
+    parser.add_argument('--index', default=None,
+                        help='JSON file the headers are indexed in.')
+
+    parser.add_argument('--threads', default=8, type=int,
+                        help='Number of files read at the same time.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def read_headers(filename):
+    '''
+    The spans of the HDUs of a FITS file with their headers, as pyfits
+    Header objects
+    '''
+    import pyfits
+    spans = fitsLayers.hdu_spans(filename, header=True)
+    fh = open(filename, 'rb')
+    for span in spans:
+        fh.seek(span['offset'])
+        span['header'] = pyfits.Header.fromstring(fh.read(span['header_size']))
+        del span['keys']
+    fh.close()
+    return spans
+
+
+def json_value(value):
+    if isinstance(value, (bool, int, long, float)) or value is None:
+        return value
+    return str(value)
+
+
+def dump_file(filename):
+    '''
+    The lines of data-fits_headers of a file and its entry of the index,
+    None if it could not be read
+    '''
+    lines = ['****   FILE  %s'%filename, ' ']
+    try:
+        spans = read_headers(filename)
+    except Exception:
+        return lines, None
+    for span in spans:
+        for k, v in span['header'].items():
+            lines.append('%s %s'%(k, v))
+    lines.append(' ')
+    index = [{'extname':span['extname'], 'offset':span['offset'],
+              'header_size':span['header_size'], 'size':span['size'],
+              'header':[[k, json_value(v)] for k, v in span['header'].items()]}
+             for span in spans]
+    return lines, index
+
+
+def dump_headers(files, output=None, index_file=None, threads=8):
+    '''
+    Write the headers of the files, in their order, to output (a file
+    name, stdout if None) and the index to index_file
+    '''
+    pool = ThreadPool(max(1, min(threads, len(files))))
+    results = pool.map(dump_file, files)
+    pool.close()
+    pool.join()
+
+    fh = open(output, 'w') if output else sys.stdout
+    for lines, index in results:
+        fh.write('\n'.join(lines)+'\n')
+    if output: fh.close()
+
+    if index_file:
+        index = dict([(f, entry) for f, (lines, entry) in zip(files, results)
+                      if entry is not None])
+        fh = open(index_file, 'w')
+        json.dump(index, fh, indent=1, sort_keys=True)
+        fh.close()
+    return results
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    files = args['files'] or glob('*fits') + glob('../input/*fits')
+    dump_headers(files, args['output'], args['index'], args['threads'])
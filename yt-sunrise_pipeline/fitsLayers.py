@@ -0,0 +1,256 @@
+'''
+Layered Sunrise input FITS files. A run directory that modifies some HDUs
+of the exported FITS file (see setupSunriseRun.py --cut_radius, --fmass,
+...) only stores those HDUs in a layer file. The rest is referenced from
+a hard link to the export, and initial.fits is spliced together HDU by
+HDU from a manifest right before sfrhist needs it and removed once it
+has run (see sunriseDriver.py).
+
+Usage:
+
+    python fitsLayers.py assemble input/initial.layers input/initial.fits
+    python fitsLayers.py verify input/initial.layers [full_copy.fits]
+'''
+import os, sys, argparse
+import hashlib
+import json
+
+
+block_size = 2880
+card_size = 80
+chunk_size = 16*1024*1024
+layers_version = 1
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Assemble or verify a layered Sunrise input FITS file.
+                                 ''')
+
+    parser.add_argument('command', choices=['assemble', 'verify'],
+                        help="'assemble' writes the FITS file described by the manifest, "\
+                            "'verify' checks the layers and compares their checksum with "\
+                            "that of a full copy if one is given.")
+
+    parser.add_argument('manifest', help='Layers manifest, e.g. input/initial.layers')
+
+    parser.add_argument('fits_file', nargs='?', default=None,
+                        help='Output file for assemble, full copy to compare with for verify.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def header_value(card):
+    '''
+    Value of a header card, as an int or a stripped string
+    '''
+    value = card[10:].split('/')[0].strip() if not card[10:].strip().startswith("'") \
+        else card[10:].strip()[1:].split("'")[0].strip()
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def hdu_spans(filename, header=False):
+    '''
+    Byte spans of the HDUs of a FITS file, read from the headers only.
+    Returns a list of dictionaries with the EXTNAME ('PRIMARY' for the
+    first HDU), offset and size (header plus padded data) of each HDU,
+    and with header also the header_size and the header keys.
+    '''
+    spans = []
+    fsize = os.path.getsize(filename)
+    fh = open(filename, 'rb')
+    offset = 0
+    while offset < fsize:
+        fh.seek(offset)
+        keys = {}
+        nblocks = 0
+        done = False
+        while not done:
+            block = fh.read(block_size)
+            if len(block) < block_size:
+                raise IOError('Truncated FITS header in %s at byte %i'%(filename, offset))
+            nblocks += 1
+            for i in range(0, block_size, card_size):
+                card = block[i:i+card_size]
+                key = card[:8].strip()
+                if key == 'END':
+                    done = True
+                    break
+                if card[8:10] == '= ' and key not in keys:
+                    keys[key] = header_value(card)
+        naxis = keys.get('NAXIS', 0)
+        ndata = 0
+        if naxis > 0:
+            ndata = 1
+            for n in range(1, naxis+1):
+                ndata *= keys['NAXIS%i'%n]
+        ndata = abs(keys['BITPIX'])//8*keys.get('GCOUNT', 1)*(keys.get('PCOUNT', 0)+ndata)
+        ndata = (ndata+block_size-1)//block_size*block_size
+        extname = keys.get('EXTNAME', 'PRIMARY' if offset == 0 else '')
+        size = nblocks*block_size+ndata
+        spans.append({'extname':extname, 'offset':offset, 'size':size})
+        if header:
+            spans[-1].update(header_size=nblocks*block_size, keys=keys)
+        offset += size
+    fh.close()
+    if offset != fsize:
+        raise IOError('%s is not a valid FITS file'%filename)
+    return spans
+
+
+def copy_span(fin, fout, offset, size, *md5s):
+    '''
+    Copy size bytes at offset of fin to fout (if not None), in chunks,
+    updating the md5s with them
+    '''
+    fin.seek(offset)
+    while size > 0:
+        data = fin.read(min(size, chunk_size))
+        if not data:
+            raise IOError('Unexpected end of %s'%fin.name)
+        if fout is not None: fout.write(data)
+        for md5 in md5s: md5.update(data)
+        size -= len(data)
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    fh = open(filename, 'rb')
+    copy_span(fh, None, 0, os.path.getsize(filename), md5)
+    fh.close()
+    return md5.hexdigest()
+
+
+def link_base(fits_file, base_file):
+    '''
+    Hard link the export to base_file, so that it is kept even if the export
+    is rewritten. Falls back to a symbolic link across file systems.
+    '''
+    if os.path.lexists(base_file): os.remove(base_file)
+    try:
+        os.link(os.path.realpath(fits_file), base_file)
+    except OSError:
+        os.symlink(os.path.abspath(fits_file), base_file)
+
+
+def extract_hdus(fits_file, layer_file, extnames):
+    '''
+    Write the primary HDU and the HDUs named in extnames of fits_file to
+    layer_file, byte by byte. Modify the HDUs of layer_file afterwards.
+    '''
+    spans = hdu_spans(fits_file)
+    fin, fout = open(fits_file, 'rb'), open(layer_file, 'wb')
+    for span in spans:
+        if span['offset'] == 0 or span['extname'] in extnames:
+            copy_span(fin, fout, span['offset'], span['size'])
+    fin.close()
+    fout.close()
+
+
+def write_manifest(manifest_file, base_file, layer_file):
+    '''
+    Describe the FITS file made of the HDUs of base_file, with those found
+    in layer_file (but its primary) taken from there instead
+    '''
+    layer_spans = dict([(s['extname'], s) for s in hdu_spans(layer_file)[1:]])
+    root = os.path.dirname(os.path.abspath(manifest_file))
+
+    fh = open(layer_file, 'rb')
+    hdus = []
+    for span in hdu_spans(base_file):
+        if span['offset'] > 0 and span['extname'] in layer_spans:
+            span = layer_spans.pop(span['extname'])
+            md5 = hashlib.md5()
+            copy_span(fh, None, span['offset'], span['size'], md5)
+            span = dict(span, source=os.path.relpath(layer_file, root), md5=md5.hexdigest())
+        else:
+            span = dict(span, source=os.path.relpath(base_file, root))
+        hdus.append(span)
+    fh.close()
+    if layer_spans:
+        raise ValueError('HDUs %s of %s are not in %s'%(layer_spans.keys(), layer_file, base_file))
+
+    manifest = {'version':layers_version, 'hdus':hdus,
+                'base':os.path.relpath(base_file, root),
+                'base_size':os.path.getsize(base_file)}
+    fh = open(manifest_file, 'w')
+    json.dump(manifest, fh, indent=1, sort_keys=True)
+    fh.close()
+    return manifest
+
+
+def read_manifest(manifest_file):
+    fh = open(manifest_file)
+    manifest = json.load(fh)
+    fh.close()
+    root = os.path.dirname(os.path.abspath(manifest_file))
+    for hdu in manifest['hdus']:
+        hdu['source'] = os.path.join(root, hdu['source'])
+    manifest['base'] = os.path.join(root, manifest['base'])
+    return manifest
+
+
+def assemble(manifest_file, fits_file=None):
+    '''
+    Splice the FITS file described by the manifest into fits_file, or only
+    checksum it if fits_file is None. The checksums of the layers are
+    checked on the way. Returns the md5 of the whole file.
+    '''
+    manifest = read_manifest(manifest_file)
+    if os.path.getsize(manifest['base']) != manifest['base_size']:
+        raise IOError('%s has changed since the layers were made'%manifest['base'])
+
+    fout = open(fits_file+'.tmp', 'wb') if fits_file else None
+    md5 = hashlib.md5()
+    files = {}
+    for hdu in manifest['hdus']:
+        if hdu['source'] not in files:
+            files[hdu['source']] = open(hdu['source'], 'rb')
+        if 'md5' in hdu:
+            hdu_md5 = hashlib.md5()
+            copy_span(files[hdu['source']], fout, hdu['offset'], hdu['size'], md5, hdu_md5)
+            if hdu_md5.hexdigest() != hdu['md5']:
+                raise IOError('Checksum of HDU %s in %s does not match'%(hdu['extname'], hdu['source']))
+        else:
+            copy_span(files[hdu['source']], fout, hdu['offset'], hdu['size'], md5)
+    for fh in files.itervalues(): fh.close()
+    if fout is not None:
+        fout.close()
+        os.rename(fits_file+'.tmp', fits_file)
+    return md5.hexdigest()
+
+
+def verify(manifest_file, full_copy=None):
+    '''
+    Check the layers and, if given, that they assemble into a file
+    identical to full_copy
+    '''
+    md5 = assemble(manifest_file)
+    if full_copy is None: return True
+    return md5 == file_md5(full_copy)
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    if args['command'] == 'assemble':
+        if args['fits_file'] is None:
+            print 'An output FITS file is needed to assemble'
+            sys.exit(1)
+        md5 = assemble(args['manifest'], args['fits_file'])
+        print 'Assembled %s from %s, md5 %s'%(args['fits_file'], args['manifest'], md5)
+    else:
+        if verify(args['manifest'], args['fits_file']):
+            print 'Layers of %s are valid'%args['manifest']
+        else:
+            print 'Layers of %s do not match %s'%(args['manifest'], args['fits_file'])
+            sys.exit(1)
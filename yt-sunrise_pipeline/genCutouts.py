@@ -0,0 +1,637 @@
+'''
+Cut out the region around the galaxy of every snapshot along the
+Most Massive Progenitor Branch (MMPB) into a compact HDF5 file, so that
+the following stages can read the raw snapshot once instead of once per
+stage.
+
+A cutout holds every particle and every leaf cell within
+max(rvir, export_radius) + margin of the MMPB center. The cells are stored
+as a depth-first octree refinement mask plus the leaf values. load_cutout
+turns a cutout back into two yt stream datasets, an octree dataset of the
+cells and a particle dataset, and --check compares them with the region
+of the snapshot they were cut from. The particles are deposited on the
+cells, and cell_sphere selects the cells of a sphere as on the snapshots.
+findGalaxyProps.py and the plots of genSunriseInput.py read the cutouts
+instead of the snapshots with --cutout_dir. The export to Sunrise still
+reads the snapshots, as it needs the cells and the star particles in one
+dataset. Plots on scales larger than the cutout (e.g. the 2 Mpc dark
+matter projection) only show what is inside it.
+
+Usage:
+
+    python genCutouts.py sim_dir --check
+'''
+import os, sys, argparse
+from glob import glob
+import numpy as np
+
+
+cutout_version = 1
+
+# Gas fields stored in the cutouts if the snapshot has them. Anything else
+# derived by yt from these (cell_mass, ...) is available on load too.
+gas_fields = ['density', 'metal_ia_density', 'metal_ii_density', 'metal_density',
+              'thermal_energy', 'temperature', 'H_nuclei_density',
+              'momentum_x', 'momentum_y', 'momentum_z',
+              'velocity_x', 'velocity_y', 'velocity_z']
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Cut out the particles and cells around the galaxy of every
+                                 snapshot along the Most Massive Progenitor Branch into compact
+                                 files that the following stages can read instead of the snapshot.
+                                 ''')
+
+    parser.add_argument('sim_dirs', nargs='+', help='Simulation directories to be analyzed.')
+
+    parser.add_argument('-s', '--snap_base', default='10MpcBox_csf512_',
+                        help='Base of the snapshots file names.')
+
+    parser.add_argument('-d', '--distance', default=100, type=float,
+                        help='Distance between the cameras and the center of the galaxy '\
+                            'that will be used by genSunriseInput.py (in [kpc]).')
+
+    parser.add_argument('-f', '--fov', default=50, type=float,
+                        help='Field of view of the cameras that will be used by '\
+                            'genSunriseInput.py (in [kpc]).')
+
+    parser.add_argument('--margin', default=10.0, type=float,
+                        help='Extra half-width around max(rvir, export_radius) in [kpc], '\
+                            'which covers the offset of the galaxy from the halo center.')
+
+    parser.add_argument('--particle_types', nargs='+', default=['stars', 'darkmatter'],
+                        help='Particle types to store in the cutouts.')
+
+    parser.add_argument( '--mmpb_file', default='sim_dir/analysis/catalogs/*_mmpb_props.npy',
+                        help='File containing the Most Massive Progenitor branch properties. '\
+                             'A python dictionary is expected as generated by findHostandMMPB.py.')
+
+    parser.add_argument('--out_dir',default='sim_dir/analysis/cutouts/',
+                        help='Directory where the cutouts will be placed.')
+
+    parser.add_argument('--force', action='store_true',
+                        help='Write the cutouts even if they are up to date.')
+
+    parser.add_argument('--check', action='store_true',
+                        help='Load every cutout back and compare its gas and particle '\
+                            'totals with the region of the snapshot it was cut from.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def cutout_file(cutout_dir, snapshot):
+    '''
+    Name of the cutout of snapshot
+    '''
+    return os.path.join(cutout_dir, os.path.basename(snapshot)+'_cutout.h5')
+
+
+def cutout_cube(center, half_width, domain_left_edge, dx0):
+    '''
+    The cube covering center +- half_width that is aligned with the root
+    cells of size dx0 and 2**m root cells wide, so that the cells of the
+    snapshot nest in a single root oct. Returns its left edge and m.
+    '''
+    center = np.asarray(center, dtype='float')
+    left = domain_left_edge + np.floor((center-half_width-domain_left_edge)/dx0)*dx0
+    nroot = np.ceil((center+half_width-left)/dx0).max()
+    m = max(1, int(np.ceil(np.log2(nroot))))
+    return left, m
+
+
+def morton_keys(ijk, nbits):
+    '''
+    Interleave the bits of the integer coordinates ijk (n, 3), with x the
+    most significant in every triplet, as yt orders the children of an oct
+    '''
+    ijk = np.asarray(ijk, dtype=np.uint64)
+    keys = np.zeros(ijk.shape[0], dtype=np.uint64)
+    for b in range(nbits-1, -1, -1):
+        for a in range(3):
+            keys = (keys << np.uint64(1)) | ((ijk[:,a] >> np.uint64(b)) & np.uint64(1))
+    return keys
+
+
+def octree_mask(levels, ijk):
+    '''
+    Depth-first refinement mask of the octree with the given leaves, at
+    levels below a single root oct (level 0 are the children of the root)
+    and integer coordinates ijk at their level. Cells of the octree that
+    are neither leaves nor refined are empty leaves.
+
+    Returns the mask (1 for refined, starting with the root oct) and, for
+    every leaf of the octree in depth-first order, the index of the given
+    leaf it holds or -1 if it is empty.
+    '''
+    levels = np.asarray(levels, dtype='int64')
+    ijk = np.asarray(ijk, dtype='int64')
+    max_level = levels.max()
+
+    cell_levels, cell_ijk, cell_refined, cell_leaf = [], [], [], []
+    parents = np.zeros((1, 3), dtype='int64') # the root oct
+    offsets = np.array([[i, j, k] for i in range(2) for j in range(2) for k in range(2)])
+    for level in range(max_level+1):
+        # Children of the refined cells of the level above
+        children = (2*parents[:,np.newaxis,:]+offsets[np.newaxis,:,:]).reshape(-1, 3)
+        nside = 2**(level+1)
+        keys = (children[:,0]*nside+children[:,1])*nside+children[:,2]
+
+        deeper = levels > level
+        refined = np.unique((ijk[deeper] >> (levels[deeper]-level)[:,np.newaxis]).dot([nside*nside, nside, 1]))
+        here = np.argwhere(levels == level)[:,0]
+        leaf_keys = (ijk[here]*[nside*nside, nside, 1]).sum(axis=1)
+
+        is_refined = np.in1d(keys, refined)
+        order = np.argsort(leaf_keys)
+        pos = np.searchsorted(leaf_keys[order], keys)
+        pos[pos == len(here)] = 0
+        is_leaf = np.zeros(keys.size, dtype=bool) if len(here) == 0 else \
+            leaf_keys[order][pos] == keys
+        if np.any(is_refined & is_leaf):
+            raise ValueError('Leaf cells overlap refined cells at level %i'%level)
+        if is_refined.sum() != refined.size or is_leaf.sum() != len(here):
+            raise ValueError('Cells at level %i are not inside a refined cell'%level)
+        leaf = np.where(is_leaf, here[order][pos] if len(here) else -1, -1)
+
+        cell_levels.append(np.ones(keys.size, dtype='int64')*level)
+        cell_ijk.append(children)
+        cell_refined.append(is_refined)
+        cell_leaf.append(leaf)
+        parents = children[is_refined]
+
+    cell_levels = np.concatenate(cell_levels)
+    cell_ijk = np.concatenate(cell_ijk)
+    cell_refined = np.concatenate(cell_refined)
+    cell_leaf = np.concatenate(cell_leaf)
+
+    # A cell comes right before its children in depth-first order
+    keys = morton_keys(cell_ijk << (max_level-cell_levels)[:,np.newaxis], max_level+1)
+    order = np.lexsort((cell_levels, keys))
+    mask = np.concatenate([[1], cell_refined[order]]).astype(np.uint8)
+    leaves = cell_leaf[order][~cell_refined[order]]
+    return mask, leaves
+
+
+def write_cutout(ds, filename, center, half_width, particle_types=['stars', 'darkmatter'],
+                 **attrs):
+    '''
+    Write the particles and leaf cells of ds within center +- half_width
+    (in kpc) to filename. attrs are stored as attributes of the file.
+    '''
+    import h5py
+
+    center = ds.arr(center, 'kpc')
+    dx0 = (ds.domain_width/ds.domain_dimensions).in_units('kpc').value[0]
+    domain_left_edge = ds.domain_left_edge.in_units('kpc').value
+    cube_left, m = cutout_cube(center.value, half_width, domain_left_edge, dx0)
+    cube_width = dx0*2**m
+
+    box = ds.box(center-ds.arr(half_width, 'kpc'), center+ds.arr(half_width, 'kpc'))
+
+    # Place the cells in the octree of the cube
+    pos = np.array([box['index', ax].in_units('kpc').value for ax in 'xyz']).transpose()
+    dx = box['index', 'dx'].in_units('kpc').value
+    levels = np.rint(np.log2(dx0/dx)).astype('int64')+m-1
+    ijk = np.floor((pos-cube_left)/dx[:,np.newaxis]).astype('int64')
+    inside = np.all((ijk >= 0) & (ijk < (2**(levels+1))[:,np.newaxis]), axis=1)
+    if not np.all(inside):
+        print 'Dropping %i cells outside of the cutout cube (periodic wrap?)'%(~inside).sum()
+    mask, leaves = octree_mask(levels[inside], ijk[inside])
+    filled = leaves >= 0
+    cell_idx = np.argwhere(inside)[:,0][leaves[filled]]
+
+    fh = h5py.File(filename+'.tmp', 'w')
+    fh.attrs['cutout_version'] = cutout_version
+    fh.attrs['center'] = center.value
+    fh.attrs['half_width'] = half_width
+    fh.attrs['cube_left_edge'] = cube_left
+    fh.attrs['cube_width'] = cube_width
+    fh.attrs['current_redshift'] = ds.current_redshift
+    fh.attrs['current_time'] = ds.current_time.in_units('Myr').value
+    fh.attrs['cosmological_simulation'] = ds.cosmological_simulation
+    for p in ['omega_matter', 'omega_lambda', 'hubble_constant']:
+        fh.attrs[p] = getattr(ds, p)
+    for key, value in attrs.iteritems():
+        fh.attrs[key] = value
+
+    grp = fh.create_group('octree')
+    grp.create_dataset('mask', data=mask, compression='gzip')
+    for name in gas_fields:
+        if ('gas', name) not in ds.derived_field_list: continue
+        values = box['gas', name]
+        data = np.zeros(leaves.size, dtype=values.dtype)
+        data[filled] = values.value[cell_idx]
+        dset = grp.create_dataset(name, data=data, compression='gzip')
+        dset.attrs['units'] = str(values.units)
+
+    for ptype in particle_types:
+        grp = fh.create_group('particles/'+ptype)
+        fields = [f for t, f in ds.field_list if t == ptype]
+        if (ptype, 'particle_age') in ds.derived_field_list and 'particle_age' not in fields:
+            fields.append('particle_age')
+        for name in fields:
+            values = box[ptype, name]
+            if name.startswith('particle_position'): values = values.in_units('kpc')
+            dset = grp.create_dataset(name, data=values.value, compression='gzip')
+            dset.attrs['units'] = str(values.units)
+        print '%i %s particles'%(box[ptype, 'particle_mass'].size, ptype)
+    fh.close()
+    os.rename(filename+'.tmp', filename)
+    print 'Wrote %i cells (%i octs) to %s'%(filled.sum(), (mask.size-1)/8+1, filename)
+
+
+def set_cosmology(ds, attrs):
+    '''
+    Give a stream dataset the cosmology and redshift of the snapshot in
+    attrs, which the yt stream loaders leave out, and check that its
+    comoving units follow
+    '''
+    ds.cosmological_simulation = attrs['cosmological_simulation']
+    ds.current_redshift = attrs['current_redshift']
+    for p in ['omega_matter', 'omega_lambda', 'hubble_constant']:
+        setattr(ds, p, attrs[p])
+    ds.set_units()
+    if not ds.cosmological_simulation: return
+    kpccm = ds.quan(1.0, 'kpccm/h').in_units('kpc').value
+    expected = 1.0/(1.0+ds.current_redshift)/ds.hubble_constant
+    if not np.isclose(kpccm, expected, rtol=1e-12):
+        raise ValueError('%s: 1 kpccm/h is %g kpc instead of %g'
+                         %(ds.parameter_filename, kpccm, expected))
+
+
+class LeafCells(object):
+    '''
+    The leaf cells of a cutout, by level (2**level cells across the cube)
+    and integer coordinates at that level, and the particle deposits of
+    yt on them. yt 3 cannot deposit on a stream octree of one cell per oct.
+    '''
+
+    def __init__(self, pos, dx, left, width):
+        self.left, self.width = left, width
+        self.ncells = dx.size
+        levels, ijk = self.index(pos, dx)
+        self.levels = {}
+        for level in np.unique(levels):
+            idx = np.argwhere(levels == level)[:,0]
+            keys = self.keys(level, ijk[idx])
+            order = np.argsort(keys)
+            self.levels[level] = (keys[order], idx[order])
+
+    def index(self, pos, dx):
+        levels = np.rint(np.log2(self.width/dx)).astype('int64')
+        ijk = np.floor((pos-self.left)/dx[:,np.newaxis]).astype('int64')
+        return levels, ijk
+
+    def keys(self, level, ijk):
+        n = 2**level
+        return (ijk[:,0]*n+ijk[:,1])*n+ijk[:,2]
+
+    def lookup(self, level, ijk):
+        '''
+        Index of the leaf at level and ijk, -1 where there is none
+        '''
+        found = -np.ones(len(ijk), dtype='int64')
+        if level not in self.levels: return found
+        keys, idx = self.levels[level]
+        inside = np.all((ijk >= 0) & (ijk < 2**level), axis=1)
+        k = self.keys(level, ijk)
+        pos = np.searchsorted(keys, k).clip(0, keys.size-1)
+        hit = inside & (keys[pos] == k)
+        found[hit] = idx[pos[hit]]
+        return found
+
+    def find(self, pos, dx):
+        '''
+        Index of the leaf of each cell at pos of width dx (in kpc)
+        '''
+        levels, ijk = self.index(pos, dx)
+        found = -np.ones(dx.size, dtype='int64')
+        for level in np.unique(levels):
+            these = levels == level
+            found[these] = self.lookup(level, ijk[these])
+        return found
+
+    def locate(self, positions):
+        '''
+        Index and level of the leaf holding each of the particle positions,
+        -1 for those outside of the leaves
+        '''
+        found = -np.ones(positions.shape[0], dtype='int64')
+        levels = np.zeros(positions.shape[0], dtype='int64')
+        for level in sorted(self.levels, reverse=True):
+            todo = np.argwhere(found < 0)[:,0]
+            dx = self.width/2.0**level
+            ijk = np.floor((positions[todo]-self.left)/dx).astype('int64')
+            found[todo] = self.lookup(level, ijk)
+            levels[todo] = level
+        return found, levels
+
+    def deposit(self, positions, weights, method='cic'):
+        '''
+        Sum of the weights of the particles at positions by leaf: of the
+        particles in the leaf ('sum'), or cloud in cell within the oct of
+        the leaf of each particle ('cic'), as yt deposits on octrees
+        '''
+        leaf, levels = self.locate(positions)
+        inside = leaf >= 0
+        if method == 'sum':
+            return np.bincount(leaf[inside], weights[inside], minlength=self.ncells)
+        values = np.zeros(self.ncells)
+        for level in np.unique(levels[inside]):
+            these = inside & (levels == level)
+            dx = self.width/2.0**level
+            rpos = (positions[these]-self.left)/dx
+            oct_left = 2*(np.floor(rpos).astype('int64')//2)
+            rpos = np.clip(rpos-oct_left, 0.5001, 1.4999)
+            for corner in np.ndindex(2, 2, 2):
+                corner = np.array(corner)
+                fraction = np.where(corner, rpos-0.5, 1.5-rpos).prod(axis=1)
+                target = self.lookup(level, oct_left+corner)
+                hit = target >= 0
+                values += np.bincount(target[hit], weights[these][hit]*fraction[hit],
+                                      minlength=self.ncells)
+        return values
+
+
+def add_deposit_fields(cells, particles):
+    '''
+    Deposit the particles of a cutout on its cells as the deposit fields of
+    the snapshot: <ptype>_mass and <ptype>_density of the particles in a
+    cell, and <ptype>_cic and the mass weighted <ptype>_cic_velocity_<ax>
+    '''
+    ad = cells.all_data()
+    left = cells.domain_left_edge.in_units('kpc').value
+    width = cells.domain_width.in_units('kpc').value[0]
+    pos = np.array([ad['index', ax].in_units('kpc').value for ax in 'xyz']).transpose()
+    dx = ad['index', 'dx'].in_units('kpc').value
+    volume = ad['index', 'cell_volume'].in_units('kpc**3').value
+    leaves = LeafCells(pos, dx, left, width)
+
+    deposits = {}
+    pad = particles.all_data()
+    for ptype in particles.particle_types_raw:
+        positions = np.array([pad[ptype, 'particle_position_'+ax].in_units('kpc').value
+                              for ax in 'xyz']).transpose()
+        mass = pad[ptype, 'particle_mass'].in_units('Msun').value
+        deposits[ptype+'_mass'] = (leaves.deposit(positions, mass, 'sum'), 'Msun')
+        deposits[ptype+'_density'] = (deposits[ptype+'_mass'][0]/volume, 'Msun/kpc**3')
+        cic = leaves.deposit(positions, mass, 'cic')
+        deposits[ptype+'_cic'] = (cic/volume, 'Msun/kpc**3')
+        for ax in 'xyz':
+            if (ptype, 'particle_velocity_'+ax) not in particles.field_list: continue
+            velocity = pad[ptype, 'particle_velocity_'+ax].in_units('km/s').value
+            top = leaves.deposit(positions, mass*velocity, 'cic')
+            top[cic > 0] /= cic[cic > 0]
+            deposits[ptype+'_cic_velocity_'+ax] = (top, 'km/s')
+
+    for name, (values, unit) in deposits.iteritems():
+        def _deposit(field, data, values=values, unit=unit):
+            shape = data['index', 'dx'].shape
+            dx = data['index', 'dx'].in_units('kpc').value.ravel()
+            pos = np.array([data['index', ax].in_units('kpc').value.ravel()
+                            for ax in 'xyz']).transpose()
+            leaf = leaves.find(pos, dx)
+            return data.ds.arr(np.where(leaf >= 0, values[leaf], 0.0).reshape(shape), unit)
+        cells.add_field(('deposit', name), function=_deposit, units=unit,
+                        sampling_type='cell', force_override=True)
+
+
+def load_cutout(filename):
+    '''
+    Load a cutout as two yt stream datasets, an octree dataset of the
+    cells and a particle dataset, with the cosmology, redshift, time and
+    field names of the snapshot it was cut from. The particles are also
+    deposited on the cells (see add_deposit_fields). The particle dataset
+    is None if the cutout has no particles, and leaves out empty types.
+    '''
+    import h5py, yt
+
+    fh = h5py.File(filename, 'r')
+    attrs = dict(fh.attrs.items())
+    mask = fh['octree/mask'][:]
+    cell_data, particle_data, units = {}, {}, {}
+    for name, dset in fh['octree'].iteritems():
+        if name == 'mask': continue
+        # Mesh fields are (n, 1) arrays, 1D arrays are taken for particles
+        cell_data['stream', str(name)] = (dset[:][:,np.newaxis], dset.attrs['units'])
+        units[str(name)] = dset.attrs['units']
+    for ptype, grp in fh['particles'].iteritems():
+        if grp['particle_mass'].size == 0: continue
+        for name, dset in grp.iteritems():
+            particle_data[str(ptype), str(name)] = (dset[:], dset.attrs['units'])
+    fh.close()
+
+    left = attrs['cube_left_edge']
+    bbox = np.array([left, left+attrs['cube_width']]).transpose()
+    code_units = dict(length_unit=(1.0, 'kpc'), mass_unit=(1.0, 'Msun'),
+                      time_unit=(1.0, 'Myr'), velocity_unit=(1.0, 'km/s'))
+    # One cell per leaf of the mask, and no cells for the refined ones
+    cells = yt.load_octree(octree_mask=mask, data=cell_data, bbox=bbox,
+                           sim_time=attrs['current_time'], periodicity=(False, False, False),
+                           over_refine_factor=0, partial_coverage=0, **code_units)
+    particles = None
+    if particle_data:
+        particles = yt.load_particles(particle_data, bbox=bbox, sim_time=attrs['current_time'],
+                                      periodicity=(False, False, False), **code_units)
+
+    for ds in [cells, particles]:
+        if ds is None: continue
+        ds.parameter_filename = filename
+        set_cosmology(ds, attrs)
+
+    # The stream octree index has no max_level, which spheres need
+    dx = cells.all_data()['index', 'dx'].in_units('code_length').value.min()
+    dx0 = (cells.domain_width/cells.domain_dimensions).in_units('code_length').value.min()
+    cells.index.max_level = int(np.rint(np.log2(dx0/dx)))
+
+    # Make the stored gas fields available under their usual names
+    for name, unit in units.iteritems():
+        if ('gas', name) in cells.derived_field_list: continue
+        def _alias(field, data, name=name):
+            return data['stream', name]
+        cells.add_field(('gas', name), function=_alias, units=unit, sampling_type='cell')
+    if particles is not None:
+        add_deposit_fields(cells, particles)
+    return cells, particles
+
+
+def cell_sphere(ds, center, radius):
+    '''
+    The sphere of ds, keeping on the cells of a cutout only those with
+    their centers inside it as the snapshots do. yt selects the cells it
+    overlaps on octrees without over refinement, like those of the cutouts.
+    '''
+    sphere = ds.sphere(center, radius)
+    if getattr(ds, 'over_refine_factor', 1) > 0:
+        return sphere
+    radius = float(sphere.radius.in_units('kpc'))
+    return sphere.cut_region(["obj['index', 'radius'].in_units('kpc') <= %.17g"%radius])
+
+
+def check_cutout(ds, filename, rtol=1e-6):
+    '''
+    Compare the cutout in filename, loaded back with load_cutout, with the
+    region of ds it was cut from: the integrals of the gas fields and the
+    mass-weighted center of the gas, and the number, the mass and the
+    mass-weighted center of every type of particles. Returns the
+    differences, as lines to print.
+    '''
+    import h5py
+
+    fh = h5py.File(filename, 'r')
+    attrs = dict(fh.attrs.items())
+    gas_names = [n for n in fh['octree'] if n != 'mask']
+    ptypes = [str(p) for p in fh['particles']]
+    fh.close()
+
+    center, half_width = ds.arr(attrs['center'], 'kpc'), ds.arr(attrs['half_width'], 'kpc')
+    box = ds.box(center-half_width, center+half_width)
+    cells, particles = load_cutout(filename)
+    cad = cells.all_data()
+    pad = particles.all_data() if particles else None
+
+    def particle_values(region, ptype, name, unit):
+        if region is None or ptype not in region.ds.particle_types_raw:
+            return np.zeros(0)
+        return region[ptype, name].in_units(unit).value
+
+    def totals(region, ptype_region):
+        t = {}
+        volume = region['index', 'cell_volume'].in_units('kpc**3').value
+        for name in gas_names:
+            values = region['gas', name]
+            t['gas', name] = (values.value*volume).sum()
+        mass = region['gas', 'density'].in_units('Msun/kpc**3').value*volume
+        for ax in 'xyz':
+            t['gas', 'center_'+ax] = (mass*region['index', ax].in_units('kpc').value).sum()
+        for ptype in ptypes:
+            m = particle_values(ptype_region, ptype, 'particle_mass', 'Msun')
+            t[ptype, 'count'] = m.size
+            t[ptype, 'mass'] = m.sum()
+            for ax in 'xyz':
+                pos = particle_values(ptype_region, ptype, 'particle_position_'+ax, 'kpc')
+                t[ptype, 'center_'+ax] = (m*pos).sum()
+        return t
+
+    source, cutout = totals(box, box), totals(cad, pad)
+    differences = []
+    for key in sorted(source):
+        if not np.isclose(cutout[key], source[key], rtol=rtol, atol=0):
+            differences.append('%s %s: %.8g in the cutout, %.8g in the snapshot'
+                               %(key[0], key[1], cutout[key], source[key]))
+    return differences
+
+
+def cutout_is_current(filename, snapshot, half_width):
+    '''
+    Whether filename is a complete cutout of at least half_width
+    of the current version of snapshot
+    '''
+    import h5py
+
+    if not os.path.exists(filename): return False
+    try:
+        fh = h5py.File(filename, 'r')
+        attrs = dict(fh.attrs.items())
+        fh.close()
+    except IOError:
+        return False
+    return attrs.get('cutout_version') == cutout_version and \
+        attrs.get('snapshot_mtime') == os.path.getmtime(snapshot) and \
+        attrs.get('half_width') >= half_width
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    import yt
+
+    print '\nStarting '+ sys.argv[0]
+    print 'Parsed arguments: '
+    print args
+    print
+
+    # Get parsed values
+    sim_dirs, snap_base = args['sim_dirs'], args['snap_base']
+    print 'Analyzing ', sim_dirs
+
+    out_dir = args['out_dir']
+    modify_outdir = 0
+    if  'sim_dir' in out_dir:
+        out_dir = out_dir.replace('sim_dir','')
+        modify_outdir = 1
+
+    mmpb_file = args['mmpb_file']
+    modify_mmpb_file = 0
+    if  'sim_dir' in mmpb_file:
+        mmpb_file = mmpb_file.replace('sim_dir','')
+        modify_mmpb_file = 1
+
+    export_radius = max(1.2*args['distance'], 1.2*args['fov'])
+    margin, particle_types = args['margin'], args['particle_types']
+
+    # Loop over simulation directories
+    for sim_dir in sim_dirs:
+
+        # Set paths and file names
+        sim_dir = os.path.expandvars(sim_dir)
+        sim_dir = os.path.abspath(sim_dir)
+
+        if modify_outdir:  out_dir = sim_dir+'/'+out_dir
+        if modify_mmpb_file: mmpb_file = sim_dir+'/'+mmpb_file
+
+        if not os.path.exists(out_dir): os.makedirs(out_dir)
+
+        # Get the MMPB properties
+        mmpb_files = glob(mmpb_file)
+        if len(mmpb_files) > 1:
+            print 'More than one file matches %s, '\
+                'the supplied file name for the MMPB properties. '\
+                'Set which file you want to use with --mmpb_file'\
+                % (mmpb_file)
+            sys.exit()
+        else:
+            mmpb_file = mmpb_files[0]
+            mmpb_props = np.load(mmpb_file)[()]
+
+        # Generate data series
+        snaps = glob(sim_dir+'/'+snap_base+'*')
+        ts = yt.DatasetSeries(snaps)
+
+        for ds in ts.piter():
+
+            scale = round(1.0/(ds.current_redshift+1.0),4)
+            if scale not in mmpb_props['scale']:
+                continue
+            idx = np.argwhere(mmpb_props['scale'] == scale)[0][0]
+
+            halo_center = ds.arr([mmpb_props['x'][idx], mmpb_props['y'][idx],
+                                  mmpb_props['z'][idx]], 'Mpccm/h') # halo props are in Rockstar units
+            halo_rvir = ds.arr(mmpb_props['rvir'][idx], 'kpccm/h').in_units('kpc').value[()]
+            half_width = max(halo_rvir, export_radius) + margin
+
+            snapshot = os.path.abspath(ds.parameter_filename)
+            filename = cutout_file(out_dir, snapshot)
+            if not args['force'] and cutout_is_current(filename, snapshot, half_width):
+                print 'Cutout %s is up to date, skipping'%filename
+            else:
+                print '\nCutting out %.1f kpc around the MMPB center of %s'\
+                    %(half_width, os.path.basename(snapshot))
+                write_cutout(ds, filename, halo_center.in_units('kpc').value, half_width,
+                             particle_types=particle_types, snapshot=snapshot,
+                             snapshot_mtime=os.path.getmtime(snapshot),
+                             rvir=halo_rvir, scale=scale)
+
+            if args['check']:
+                differences = check_cutout(ds, filename)
+                for d in differences:
+                    print 'MISMATCH in %s: %s'%(filename, d)
+                print 'Cutout %s %s the snapshot'%(filename, 'differs from' if differences
+                                                   else 'matches')
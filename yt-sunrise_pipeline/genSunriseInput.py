@@ -6,9 +6,15 @@ the fov to a FITS file in a format that Sunrise understands.
 by Miguel Rocha  - miguel@scitechanalytics.com
 '''
 import os, sys, argparse
+import hashlib
 from glob import glob
 import numpy as np
+import pyfits
 from collections import OrderedDict
+from plotWriter import PlotWriter
+import sunriseCameras
+from starAggregation import aggregate_stars, leaf_cell_ids
+from genCutouts import load_cutout, cell_sphere
 
 
 if __name__ != "__main__":
@@ -16,6 +22,17 @@ if __name__ != "__main__":
     from yt.analysis_modules.halo_finding.halo_objects import RockstarHaloList 
     yt.enable_parallelism()
 
+# Replaced in __main__ by a pool of writer threads, see --plot_threads
+plot_writer = PlotWriter(nthreads=0)
+
+# Preview particle filters registered with yt, and their fractions
+preview_filters = {}
+
+# Density (Msun/kpc**3) and temperature (K) ranges, and number of bins per
+# axis, of the phase plots
+phase_ranges = [(1e-2, 1e12), (1e0, 1e10)]
+phase_bins = 144
+
 
 def parse():
     '''
@@ -51,12 +68,51 @@ def parse():
                         help='File containing the galaxy properties. A python dictionary is expected '\
                              'as generated by findGalaxyProps.py.')
 
+    parser.add_argument('--n_isotropic', default=0, type=int,
+                        help='Number of additional cameras spread isotropically (Fibonacci '\
+                            'sphere) around the galaxy, named Iso_00000... Iso_00000 is '\
+                            'closest to face on.')
+
     parser.add_argument('--cams_to_plot', nargs='+', default=['face','edge','45'],
                         help='Cameras for which to make slice and projection plots ')
 
     parser.add_argument( '--max_level', default=None, type=int,
                          help='Max level to refine when exporting the oct-tree structure.')
 
+    parser.add_argument( '--cell_budget', default=None, type=float,
+                         help='Maximum number of leaf cells to export. The deepest max_level '\
+                             'that fits in this budget is chosen from the oct-tree index.')
+
+    parser.add_argument( '--star_budget', default=None, type=float,
+                         help='Maximum number of star particles to export. Only checked and '\
+                             'reported, as max_level does not change the number of stars.')
+
+    parser.add_argument('--export_region', default='cube', choices=['cube', 'frusta'],
+                        help="Region to export. 'cube' uses a half-width of 1.2*max(distance, fov), "\
+                            "'frusta' shrinks it to the union of the camera frusta.")
+
+    parser.add_argument('--frustum_depth', default=None, type=float,
+                        help='Depth along the line of sight around the galaxy center that '\
+                            'the camera frusta cover (in [kpc]). Defaults to the fov.')
+
+    parser.add_argument('--scatter_margin', default=10.0, type=float,
+                        help='Margin added around the camera frusta to keep the cells '\
+                            'needed for scattering (in [kpc]).')
+
+    parser.add_argument('--aggregate_age', default=None, type=float,
+                        help='Merge star particles older than this age (in [years]) into '\
+                            'age/metallicity binned super-particles per leaf cell.')
+
+    parser.add_argument('--aggregate_bins', nargs=2, default=[8, 4], type=int,
+                        help='Number of logarithmic age and metallicity bins used '\
+                            'when aggregating star particles.')
+
+    parser.add_argument('--cutout_dir', default=None,
+                        help='Directory with the cutouts written by genCutouts.py, e.g. '\
+                            'sim_dir/analysis/cutouts/. If given the plots are made from the '\
+                            'cutouts. The export still reads the snapshots, as the Sunrise '\
+                            'exporter needs the cells and the star particles in one dataset.')
+
     parser.add_argument('--out_dir',default='sim_dir/analysis/sunrise_analysis/',
                         help='Directory where the output will be placed. A sub directory will be created '\
                             'for each snapshot') 
@@ -65,102 +121,84 @@ def parse():
                         help='Directory where to find the rockstar output, used to annotate halos '\
                             'on plots. If not found or set to None halos will not be annotated.')
 
+    parser.add_argument('--phase_zlim', nargs=2, default=None, type=float,
+                        help='Colour limits of the phase plots. The binned data is cached '\
+                            'next to the plots, so these can be changed without re-reading '\
+                            'the snapshot.')
+
+    parser.add_argument('--plot_threads', default=2, type=int,
+                        help='Number of background threads encoding and writing the plots. '\
+                            'Use 0 to write them inline.')
+
+    parser.add_argument('--preview',action='store_true',
+                        help='Quick look mode: make the plots at low resolution from a random '\
+                            'subsample of the particles, in a yt_plots_preview directory, '\
+                            'and do not export. Useful to check the cameras.')
+
+    parser.add_argument('--preview_fraction', default=0.05, type=float,
+                        help='Fraction of the particles deposited in preview mode. The '\
+                            'subsample is the same on every run.')
+
+    parser.add_argument('--preview_pixels', default=200, type=int,
+                        help='Number of pixels on a side of the preview images.')
+
     parser.add_argument('--no_plots',action='store_true',
                         help='Do not generate projection plots.') 
 
     parser.add_argument('--no_export',action='store_true',
                         help='Do not export data to fits for Sunrise.') 
 
+    parser.add_argument('--force_export', '--force-export', action='store_true',
+                        help='Export data to fits even if an up to date export is found '\
+                            'for the snapshot.') 
+
     args = vars(parser.parse_args())
     return args
 
 
-def generate_cameras(normal_vector, distance=100.0, fov=50.0):
+def generate_cameras(normal_vector, distance=100.0, fov=50.0, n_isotropic=0):
     '''
-    Set camera positions and orientations
+    Set camera positions and orientations, see sunriseCameras.generate_cameras
     '''
-    from yt.utilities.orientation import Orientation
-
     print "\nGenerating cameras"
-    
-    north = np.array([0.,1.,0.])
-    orient = Orientation(normal_vector=normal_vector, north_vector=north)
-    R=np.linalg.inv(orient.inv_mat)
-
-    camera_set = OrderedDict([
-            ['face',([0.,0.,1.],[0.,-1.,0],True)], #up is north=+y
-            ['edge',([0.,1.,0.],[0.,0.,-1.],True)],#up is along z
-            ['45',([0.,0.7071,0.7071],[0., 0., -1.],True)],
-            ['Z-axis',([0.,0.,1.],[0.,-1.,0],False)], #up is north=+y
-            ['Y-axis',([0.,1.,0.],[0.,0.,-1.],False)],#up is along z
-            ])  
-    segments = 10
-    np.random.seed(0)
-    ts = np.random.random(segments)*np.pi*2
-    ps = np.random.random(segments)*np.pi-np.pi/2.0
-    for i,(theta, phi) in enumerate(zip(ts,ps)):
-        pos = [np.cos(theta),0.,np.sin(phi)]
-        vc  = [np.cos(np.pi/2.-theta),0.,np.sin(np.pi/2.-phi)] 
-        camera_set['Random_%03i'%(i)]=(pos,vc,False)
-
-    i=0    
-    cameras = OrderedDict()
-    for name,(normal,north,do_rot)  in camera_set.iteritems():
-        orient = Orientation(normal_vector=normal, north_vector=north)
-        if do_rot:
-            drot = R.copy()
-        else:
-            drot = np.identity(3)
-        sunrise_pos = np.dot(orient.normal_vector, drot)
-        sunrise_up  = L.copy()
-        if np.all(np.abs(sunrise_up-sunrise_pos)<1e-3):
-            sunrise_up[0] *= 0.5 
-        sunrise_direction = -1.0*sunrise_pos
-        sunrise_afov = 2.0*np.arctan((fov/2.0)/distance)
-        norm = lambda x: x/np.sqrt(np.sum(x*x))
-        if np.all(np.abs(norm(sunrise_up)-norm(sunrise_pos))<1e-3):
-            sunrise_up[0]*=0.5
-            sunrise_up = norm(sunrise_up)
-        line = (distance*sunrise_pos, distance*sunrise_direction, sunrise_up,
-                sunrise_afov, fov, distance) 
-        cameras[name] = line
-        i+=1
-
-    print "Successfully generated cameras\n"
+    names, rows = sunriseCameras.generate_cameras(normal_vector, distance=distance,
+                                                  fov=fov, n_isotropic=n_isotropic)
+    cameras = sunriseCameras.rows_to_dict(names, rows, fov, distance)
+    print "Successfully generated %i cameras\n"%len(cameras)
     return cameras
 
 
 def write_cameras(prefix, cameras):
     print "Writing cameras to ",  prefix+'.cameras'
-    fn = prefix+'.cameras'
-    campos = ()
-    for name,row in cameras.iteritems():
-        campos += (tuple(row[1])+tuple(row[0])+tuple(row[2])+tuple([row[3]]),)
-    campos = np.array(campos)
-    np.savetxt(fn, campos)   
-    fn = prefix+'.camnames'
-    fh = open(fn,'w')
-    fh.write('\n'.join([c for c in cameras.keys()]))
-    fh.close()
+    names, rows = sunriseCameras.dict_to_rows(cameras)
+    sunriseCameras.write_cameras(prefix+'.cameras', rows)
+    sunriseCameras.write_camnames(prefix+'.camnames', names)
 
 
 def plot_particles(prefix, ds, center, cameras, 
                    dm_particles='darkmatter', star_particles='stars',
-                   halo_file=None, cams_to_plot=['face','edge','45']):
+                   halo_file=None, cams_to_plot=['face','edge','45'],
+                   preview_fraction=None, preview_pixels=None):
     """
     Project the stars and DM densities on the fov of cams_to_plot. 
     Also make slice plots of the density and the LOS velocity of the stars.
     Finally project on 200 kpc and 1 Mpc scales the dark matter density 
     along the normal axis of the first camera on cams_to_plot, circling
-    halos.
+    halos. If preview_fraction is set only that fraction of the particles
+    is deposited, on images of preview_pixels on a side.
 
     """
+    if preview_fraction is not None:
+        star_particles = add_preview_particles(ds, star_particles, preview_fraction)
+        dm_particles = add_preview_particles(ds, dm_particles, preview_fraction)
+    preview = dict(preview_fraction=preview_fraction, preview_pixels=preview_pixels)
+
     camnames = cameras.keys()
     cams = [cameras[n] for n in camnames]
 
     if halo_file:
         try:
-            halo_list = RockstarHaloList(ds, halo_file) 
+            halo_list = HaloOverlay(ds, RockstarHaloList(ds, halo_file))
         except TypeError:
             halo_list = None
     else:
@@ -170,33 +208,34 @@ def plot_particles(prefix, ds, center, cameras,
         if name in cams_to_plot:
             offaxisprojection(prefix+'_%s_fov'%name, ds, cam, center, 
                               particle_type=star_particles,
-                              halo_list=halo_list)    
+                              halo_list=halo_list, **preview)    
             offaxisprojection(prefix+'_%s_fov'%name, ds, cam, center,
                               particle_type=star_particles,
-                              halo_list=halo_list, slice=True)
+                              halo_list=halo_list, slice=True, **preview)
             offaxisprojection(prefix+'_%s_fov'%name, ds, cam, center,
                               particle_type=star_particles, 
                               halo_list=halo_list,
-                              field=star_particles+'_Vlos', slice=True)
+                              field=star_particles+'_Vlos', slice=True, **preview)
             offaxisprojection(prefix+'_%s_fov'%name, ds, cam, center,
                               particle_type=dm_particles,
-                              halo_list=halo_list)
+                              halo_list=halo_list, **preview)
 
     offaxisprojection(prefix+'_'+camnames[0]+'_fov', ds, cams[0], center, 
                       particle_type=dm_particles,
-                      halo_list=halo_list)
+                      halo_list=halo_list, **preview)
     offaxisprojection(prefix+'_'+camnames[0]+'_200Kpc', ds, cams[0], center,
                       particle_type=dm_particles,
-                      fov=200, halo_list=halo_list, min_mass=1e9)
+                      fov=200, halo_list=halo_list, min_mass=1e9, **preview)
     offaxisprojection(prefix+'_'+camnames[0]+'_2Mpc', ds, cams[0], center,
                       particle_type=dm_particles,
                       fov=ds.arr(2.0, 'Mpc').in_units('kpc'),
-                      halo_list=halo_list, min_mass=1e10)
+                      halo_list=halo_list, min_mass=1e10, **preview)
    
 
 def offaxisprojection(prefix, ds, camera, center, field='cic',
                       particle_type='darkmatter', fov=None,
-                      slice=False, halo_list=None, min_mass=1e8):
+                      slice=False, halo_list=None, min_mass=1e8,
+                      preview_fraction=None, preview_pixels=None):
 
     center = center.in_units('kpc')
     normal, distance, up, width = get_camprops(camera)
@@ -210,6 +249,8 @@ def offaxisprojection(prefix, ds, camera, center, field='cic',
     box = ds.box(LeftEdge, RightEdge)
 
     weight = ('deposit', particle_type+'_cic')
+    if preview_fraction is not None:
+        weight = ('deposit', particle_type+'_cic_estimate')
  
     if field == 'cic': 
         field = weight
@@ -236,22 +277,136 @@ def offaxisprojection(prefix, ds, camera, center, field='cic',
                                    depth=(2*distance.value, distance.units),
                                    north_vector=up, 
                                    weight_field=weight)
-    if halo_list:
-        p.annotate_hop_circles(halo_list, annotate=True, 
-                               fixed_radius=(1.0, 'kpc'),
-                               max_number=int(1e9),
-                               min_mass=min_mass, min_size=1e-99,
-                               width=(2*width.value, width.units))
-
     del(box)    
+    if preview_pixels is not None:
+        p.set_buff_size(preview_pixels)
     if yt.is_root():
-        p.save(prefix)
+        if halo_list is not None:
+            depth = 2*width if slice else 2*distance
+            halo_list.annotate(p, center, normal, up, width.value, depth.value,
+                               min_mass=min_mass)
+        if preview_fraction is not None:
+            stamp_preview(p, preview_fraction, preview_pixels)
+        plot_writer.save(p, prefix)
+
+
+def add_preview_particles(ds, particle_type, fraction):
+    '''
+    Add to ds a particle type holding a deterministic random subsample of
+    about fraction of the particle_type particles, selected by hashing their
+    ids. Its cic density divided by fraction is added as the *_cic_estimate
+    deposit field. Returns the name of the new particle type.
+    '''
+    ptype = particle_type+'_preview'
+    if ptype not in preview_filters:
+        def _preview(pfilter, data):
+            ids = data[(pfilter.filtered_type, 'particle_index')]
+            return preview_hash(np.asarray(ids)) < fraction
+        yt.add_particle_filter(ptype, function=_preview, filtered_type=particle_type,
+                               requires=['particle_index'])
+        preview_filters[ptype] = fraction
+    elif preview_filters[ptype] != fraction:
+        raise ValueError('%s already registered with a fraction of %g'\
+                             %(ptype, preview_filters[ptype]))
+    ds.add_particle_filter(ptype)
+
+    def _cic_estimate(field, data):
+        return data[('deposit', ptype+'_cic')]/fraction
+    ds.add_field(('deposit', ptype+'_cic_estimate'), function=_cic_estimate,
+                 units='g/cm**3', force_override=True,
+                 display_name=r'$\rm{%s\ CIC\ Density}$'%particle_type)
+    return ptype
+
+
+def preview_hash(ids):
+    '''
+    Map integer ids to [0, 1) with a multiplicative (Knuth) hash, so that
+    the same particles are picked in every snapshot and on every run.
+    '''
+    ids = np.asarray(ids).astype(np.uint64)
+    h = (ids*np.uint64(2654435761)) & np.uint64(0xffffffff)
+    return h/2.0**32
+
+
+def stamp_preview(p, preview_fraction, preview_pixels, particles=True):
+    '''
+    Label every panel of p as a preview
+    '''
+    text = 'PREVIEW %ipx'%preview_pixels
+    if particles:
+        text += ', %.3g%% of particles'%(100.0*preview_fraction)
+    p._setup_plots()
+    for f in p.plots:
+        ax = p.plots[f].axes
+        ax.text(0.03, 0.03, text, transform=ax.transAxes, color='w',
+                fontsize=10, ha='left', va='bottom')
 
 
-def plot_gas(prefix, ds, center, cameras, cams_to_plot=['face','edge','45']):
+class HaloOverlay(object):
+    '''
+    Halo positions and masses of a snapshot held in a KD-tree, so that only
+    the halos in view of a plot are looked at when circling them.
+    '''
+
+    def __init__(self, ds, halo_list):
+        from scipy.spatial import cKDTree
+        self.ids = np.array([halo.id for halo in halo_list])
+        self.masses = np.array([float(halo.total_mass()) for halo in halo_list])
+        pos = np.array([np.asarray(halo.center_of_mass()) for halo in halo_list])
+        self.positions = ds.arr(pos.reshape(-1, 3), 'code_length').in_units('kpc').value
+        self.tree = cKDTree(self.positions) if len(self.positions) else None
+
+    def in_view(self, center, normal, up, width, depth, min_mass=None):
+        '''
+        Indices of the halos above min_mass inside the camera window of the
+        given width and depth (in [kpc]) around center, and their positions
+        in the (east, north, normal) frame of the camera.
+        '''
+        from yt.utilities.orientation import Orientation
+        if self.tree is None:
+            return np.array([], dtype='int64'), np.zeros((0, 3))
+        center = center.in_units('kpc').value
+        radius = np.sqrt(2*(width/2.0)**2 + (depth/2.0)**2)
+        idx = np.array(self.tree.query_ball_point(center, radius), dtype='int64')
+        if min_mass is not None:
+            idx = idx[self.masses[idx] >= min_mass]
+        orient = Orientation(normal_vector=np.array(normal, dtype='float64'), 
+                             north_vector=np.array(up, dtype='float64'))
+        basis = np.array([np.asarray(v, dtype='float64') for v in orient.unit_vectors])
+        rel = np.dot(self.positions[idx]-center, basis.T)
+        inside = np.all(np.abs(rel) < [width/2.0, width/2.0, depth/2.0], axis=1)
+        return idx[inside], rel[inside]
+
+    def annotate(self, p, center, normal, up, width, depth, min_mass=None, radius=1.0):
+        '''
+        Circle (radius in [kpc]) and label the halos in view on every panel
+        of the off-axis plot p, drawing the circles as a single collection.
+        '''
+        from matplotlib.collections import EllipseCollection
+        idx, rel = self.in_view(center, normal, up, width, depth, min_mass=min_mass)
+        if idx.size == 0:
+            return
+        p._setup_plots()
+        for field in p.plots.keys():
+            ax = p.plots[field].axes
+            x0, x1, y0, y1 = ax.images[0].get_extent()
+            scale = (x1-x0)/width
+            xy = np.array([x0 + (rel[:,0]+width/2.0)*scale, 
+                           y0 + (rel[:,1]+width/2.0)*(y1-y0)/width]).T
+            size = np.ones(idx.size)*2*radius*scale
+            ax.add_collection(EllipseCollection(size, size, np.zeros(idx.size), units='xy',
+                                                offsets=xy, transOffset=ax.transData,
+                                                facecolors='none', edgecolors='white'))
+            for (x, y), halo_id in zip(xy, self.ids[idx]):
+                ax.text(x, y, '%i'%halo_id, color='white', clip_on=True)
+
+
+def plot_gas(prefix, ds, center, cameras, cams_to_plot=['face','edge','45'],
+             phase_zlim=None, preview_fraction=None, preview_pixels=None):
     """
     Make projection and slice plots of the gas density. Also make a couple of
-    phase plots.
+    phase plots. In preview mode (preview_fraction set) the images are made
+    at preview_pixels and the phase plots, which need every cell, are skipped.
     """
 
     field = 'density'
@@ -264,44 +419,165 @@ def plot_gas(prefix, ds, center, cameras, cams_to_plot=['face','edge','45']):
                                        width=(width, 'kpc'),
                                        depth=(2*distance, 'kpc'),
                                        north_vector=up)
+            if preview_pixels is not None:
+                p.set_buff_size(preview_pixels)
             if yt.is_root():
-                p.save(prefix+'_%s_fov'%name)
+                if preview_fraction is not None:
+                    stamp_preview(p, preview_fraction, preview_pixels, particles=False)
+                plot_writer.save(p, prefix+'_%s_fov'%name)
 
             p=yt.OffAxisSlicePlot(ds, normal, 'metal_ia_density', center, 
                                   width=(width, 'kpc'), north_vector=up)
+            if preview_pixels is not None:
+                p.set_buff_size(preview_pixels)
             if yt.is_root():
-                p.save(prefix+'_%s_fov'%name)
-
-    sph = ds.sphere(center, (20.0, 'kpc'))
-
-    def _MetalMass(field, data):
-        return (data['metal_ia_density']*data['cell_volume']).in_units('Msun')
-    sph.ds.add_field(('gas', 'MetalMass'), function=_MetalMass, units='Msun')         
+                if preview_fraction is not None:
+                    stamp_preview(p, preview_fraction, preview_pixels, particles=False)
+                plot_writer.save(p, prefix+'_%s_fov'%name)
+
+    if preview_fraction is not None: return
+
+    radius = 20.0
+    x_field, y_field = ('density', 'Msun/kpc**3'), ('Temperature', 'K')
+    weight_fields = [('cell_mass', 'Msun'), ('MetalMass', 'Msun')]
+    cache_file = prefix+'_phase.npz'
+    key = phase_cache_key(ds, center, radius, x_field, y_field, weight_fields,
+                          phase_ranges[0], phase_ranges[1], phase_bins)
+    if not phase_cache_matches(cache_file, key):
+        sph = cell_sphere(ds, center, (radius, 'kpc'))
+
+        def _MetalMass(field, data):
+            return (data['metal_ia_density']*data['cell_volume']).in_units('Msun')
+        sph.ds.add_field(('gas', 'MetalMass'), function=_MetalMass, units='Msun')         
+
+        def _Temperature(field, data):
+            te = data['thermal_energy']
+            hd = data['H_nuclei_density']
+            temp = (2.0*te/(3.0*hd*yt.physical_constants.kb)).in_units('K')
+            return temp
+        sph.ds.add_field(('gas', 'Temperature'), function=_Temperature, units='K')
+
+        x_edges, y_edges, hists, outside = phase_histograms(sph, x_field, y_field, weight_fields,
+                                                            phase_ranges[0], phase_ranges[1],
+                                                            phase_bins)
+        if outside['cells']:
+            print 'WARNING: %i cells (%.2g of the %s) are outside of the phase '\
+                'plot ranges %s and %s'%(outside['cells'], outside['fraction'],
+                                         weight_fields[0][0], phase_ranges[0], phase_ranges[1])
+        if yt.is_root():
+            np.savez(cache_file, x_edges=x_edges, y_edges=y_edges, key=key,
+                     center=center.in_units('kpc').value, radius=radius,
+                     n_outside=outside['cells'], **hists)
+    if yt.is_root():
+        plot_phase(cache_file, prefix, zlim=phase_zlim)
     
-    def _Temperature(field, data):
-        te = data['thermal_energy']
-        hd = data['H_nuclei_density']
-        temp = (2.0*te/(3.0*hd*yt.physical_constants.kb)).in_units('K')
-        return temp
-    sph.ds.add_field(('gas', 'Temperature'), function=_Temperature, units='K')
 
-    
-    p = yt.PhasePlot(sph, "density", "Temperature", "cell_mass", weight_field=None)
-    p.set_unit('density', 'Msun/kpc**3')
-    p.set_unit('cell_mass', 'Msun')
-    if yt.is_root:
-        p.save(prefix)
-    
-    p = yt.PhasePlot(sph, "density", "Temperature", "MetalMass", weight_field=None)
-    p.set_unit('density', 'Msun/kpc**3')
-    if yt.is_root:
-        p.save(prefix)
-    
+def phase_histograms(data_source, x_field, y_field, weight_fields, 
+                     x_range=(1e0, 1e12), y_range=(1e1, 1e9), n_bins=128):
+    '''
+    Accumulate logarithmically binned 2D histograms of x_field vs y_field for
+    all weight_fields reading the cells of data_source only once, chunk by
+    chunk. Fields are given as (name, units) tuples.
+    Returns the bin edges, a dictionary of histograms by weight name, and
+    the number of cells outside of the ranges with the fraction of the
+    first weight they hold.
+    '''
+    x_edges = np.logspace(np.log10(x_range[0]), np.log10(x_range[1]), n_bins+1)
+    y_edges = np.logspace(np.log10(y_range[0]), np.log10(y_range[1]), n_bins+1)
+    hists = dict((w, np.zeros(n_bins*n_bins)) for w, units in weight_fields)
+    n_outside, w_outside, w_total = 0, 0.0, 0.0
+    for chunk in data_source.chunks([], 'io'):
+        x = chunk[x_field[0]].in_units(x_field[1]).value
+        y = chunk[y_field[0]].in_units(y_field[1]).value
+        ix = np.searchsorted(x_edges, x, side='right')-1
+        iy = np.searchsorted(y_edges, y, side='right')-1
+        inside = (ix >= 0) & (ix < n_bins) & (iy >= 0) & (iy < n_bins)
+        bins = ix[inside]*n_bins + iy[inside]
+        n_outside += (~inside).sum()
+        for k, (w, units) in enumerate(weight_fields):
+            weight = chunk[w].in_units(units).value
+            hists[w] += np.bincount(bins, weights=weight[inside], minlength=n_bins*n_bins)
+            if k == 0:
+                w_outside += weight[~inside].sum()
+                w_total += weight.sum()
+    for w in hists:
+        hists[w] = hists[w].reshape(n_bins, n_bins)
+    outside = {'cells':int(n_outside), 'fraction':w_outside/w_total if w_total > 0 else 0.0}
+    return x_edges, y_edges, hists, outside
+
+
+def phase_cache_key(ds, center, radius, x_field, y_field, weight_fields, x_range,
+                    y_range, n_bins):
+    '''
+    Hash the snapshot, the sphere (radius in [kpc]), the fields and the
+    binning of the phase histograms into a key that identifies the cache
+    '''
+    snap = os.path.abspath(ds.parameter_filename)
+    stat = os.stat(snap)
+    inputs = [('snapshot', snap),
+              ('snapshot_size', stat.st_size),
+              ('snapshot_mtime', int(stat.st_mtime)),
+              ('center', ['%.3f'%x for x in center.in_units('kpc').value]),
+              ('radius', '%.3f'%radius),
+              ('x_field', x_field), ('y_field', y_field),
+              ('weight_fields', list(weight_fields)),
+              ('x_range', tuple(x_range)), ('y_range', tuple(y_range)),
+              ('n_bins', n_bins)]
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+
+def phase_cache_matches(cache_file, key):
+    '''
+    Check if the phase histograms cached in cache_file were made with the
+    given key, see phase_cache_key
+    '''
+    if not os.path.exists(cache_file):
+        return False
+    cache = np.load(cache_file)
+    return 'key' in cache.files and str(cache['key']) == key
 
-def export_fits(ds, center, export_radius, prefix, star_particles, max_level=None):
+
+def plot_phase(cache_file, prefix, zlim=None, x_name='density', y_name='Temperature',
+               x_label=r'$\rm{Density\ (M_{\odot}/kpc^{3})}$', 
+               y_label=r'$\rm{Temperature\ (K)}$'):
+    '''
+    Plot every histogram stored in cache_file as a phase diagram. Only the
+    cache is read, so the colour limits can be changed without data access.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import LogNorm
+
+    cache = np.load(cache_file)
+    x_edges, y_edges = cache['x_edges'], cache['y_edges']
+    for name in cache.files:
+        if name in ['x_edges', 'y_edges', 'center', 'radius', 'key', 'n_outside']: continue
+        hist = np.ma.masked_less_equal(cache[name], 0.0)
+        if hist.count() == 0: continue
+        vmin, vmax = zlim if zlim else (hist.min(), hist.max())
+        fig = Figure(figsize=(10, 8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        mesh = ax.pcolormesh(x_edges, y_edges, hist.T, norm=LogNorm(vmin, vmax))
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlim(x_edges[0], x_edges[-1])
+        ax.set_ylim(y_edges[0], y_edges[-1])
+        ax.set_xlabel(x_label)
+        ax.set_ylabel(y_label)
+        fig.colorbar(mesh).set_label(r'$\rm{%s\ (M_{\odot})}$'%name.replace('_', '\ '))
+        plot_writer.savefig(fig, '%s_2d-Profile_%s_%s_%s.png'%(prefix, x_name, y_name, name))
+
+
+def export_fits(ds, center, export_radius, prefix, star_particles, max_level=None,
+                cell_budget=None, star_budget=None, aggregate_age=None,
+                aggregate_bins=(8, 4)):
     '''
     Convert the contents of a dataset to a FITS file format that Sunrise
-    understands.
+    understands. If cell_budget is given, max_level is lowered to the
+    deepest level whose predicted number of leaf cells fits in the budget.
+    If aggregate_age is given, star particles older than it are merged 
+    into super-particles per leaf cell.
     '''
 
     print "\nExporting data in %s to FITS for Sunrise"%ds.parameter_filename.split('/')[-1]
@@ -311,6 +587,29 @@ def export_fits(ds, center, export_radius, prefix, star_particles, max_level=Non
     width = export_radius.in_units('kpc')
     info = {}
 
+    if cell_budget is not None:
+        level_counts = export_level_counts(ds, center, width)
+        budget_level = select_max_level(level_counts, cell_budget)
+        if max_level is None or budget_level < max_level:
+            max_level = budget_level
+        nleafs, nrefined = predict_export_cells(level_counts, max_level)
+        print 'Leaf cells per level in the export region: ', level_counts
+        print 'Using max_level = %i, predicted %i leaf and %i refined cells '\
+            '(budget %i)'%(max_level, nleafs, nrefined, cell_budget)
+        info['export_level_counts'] = level_counts
+        info['export_cell_budget'] = cell_budget
+        info['export_predicted_nleafs'] = nleafs
+        info['export_predicted_nrefined'] = nrefined
+
+    if star_budget is not None:
+        region = ds.box(center-width, center+width)
+        nstars = region[star_particles, 'particle_mass'].size
+        if nstars > star_budget:
+            print 'WARNING: %i star particles in the export region, more than '\
+                'the budget of %i'%(nstars, star_budget)
+        info['export_star_budget'] = star_budget
+        info['export_predicted_nstars'] = nstars
+
     fle, fre, ile, ire, nrefined, nleafs, nstars = \
         sunrise_octree_exporter.export_to_sunrise(ds, filename, star_particles, 
                                                   center, width, max_level=max_level)
@@ -325,11 +624,146 @@ def export_fits(ds, center, export_radius, prefix, star_particles, max_level=Non
     info['export_nleafs']=nleafs
     info['export_nstars']=nstars
 
+    if aggregate_age is not None:
+        pd, h = pyfits.getdata(filename, extname='PARTICLEDATA', header=True)
+        pd = np.array(pd)
+        cell_ids = leaf_cell_ids(ds, center, width, pd['position'], max_level)
+        pd, stats = aggregate_stars(pd, cell_ids, aggregate_age, *aggregate_bins)
+        pyfits.update(filename, pd, header=h, extname='PARTICLEDATA')
+        print 'Aggregated stars older than %1.1e years: %i -> %i particles'\
+            %(aggregate_age, nstars, pd.size)
+        info['export_nstars'] = pd.size
+        info['export_nstars_unaggregated'] = nstars
+        info['export_aggregate_age'] = aggregate_age
+        info['export_aggregate_bins'] = tuple(aggregate_bins)
+        for k, v in stats.iteritems():
+            info['export_aggregate_'+k] = v
+
     print "Successfully generated FITS for snapshot %s"%ds.parameter_filename.split('/')[-1]
     print info,'\n'
     return info
 
 
+def export_level_counts(ds, center, width):
+    '''
+    Count the leaf cells at each refinement level inside the export region.
+    Only the oct-tree index is used, no field data are read.
+    '''
+    center = center.in_units('code_length')
+    width = width.in_units('code_length')
+    region = ds.box(center-width, center+width)
+    levels = region['index', 'grid_level'].astype('int64')
+    return np.bincount(levels)
+
+
+def predict_export_cells(level_counts, max_level):
+    '''
+    Predict the number of leaf and refined cells of the exported oct-tree
+    when cells deeper than max_level are merged into their level max_level
+    parents.
+    '''
+    level_counts = np.asarray(level_counts, dtype='float64')
+    levels = np.arange(level_counts.size)
+    deep = levels >= max_level
+    nleafs = level_counts[~deep].sum() + \
+        (level_counts[deep]/8.0**(levels[deep]-max_level)).sum()
+    nroots = (level_counts/8.0**levels).sum()
+    nrefined = (nleafs-nroots)/7.0
+    return int(round(nleafs)), int(round(nrefined))
+
+
+def select_max_level(level_counts, cell_budget):
+    '''
+    Deepest max_level for which the predicted number of leaf cells fits in
+    cell_budget. Level 0 is returned if no level fits.
+    '''
+    max_level = 0
+    for level in range(len(level_counts)):
+        nleafs, nrefined = predict_export_cells(level_counts, level)
+        if nleafs > cell_budget: break
+        max_level = level
+    return max_level
+
+
+def frusta_half_width(camdata, depth, margin=0.0):
+    '''
+    Half-width of the smallest cube centered on the galaxy that contains
+    the frusta of all cameras in camdata (rows as written to the .cameras
+    file), each clipped to depth around the galaxy center, plus margin.
+    '''
+    camdata = np.atleast_2d(camdata)
+    direction, pos, up = camdata[:,0:3], camdata[:,3:6], camdata[:,6:9]
+    afov = camdata[:,9]
+    norm = lambda x: x/np.sqrt(np.sum(x*x, axis=-1))[:,None]
+    direction = norm(direction)
+    up = norm(up - np.sum(up*direction, axis=1)[:,None]*direction)
+    right = np.cross(direction, up)
+    distance = np.sqrt(np.sum(pos*pos, axis=1))
+    corners = []
+    for s in [np.maximum(distance-depth/2.0, 0.0), distance+depth/2.0]:
+        half = s*np.tan(afov/2.0)
+        for a in [-1.0, 1.0]:
+            for b in [-1.0, 1.0]:
+                corners.append(pos + s[:,None]*direction + \
+                               (a*half)[:,None]*up + (b*half)[:,None]*right)
+    return np.abs(np.array(corners)).max() + margin
+
+
+# Bump whenever export_fits changes what ends up in the FITS file,
+# so that cached exports are redone.
+exporter_version = '1'
+
+
+def export_cache_key(ds, center, export_radius, star_particles, max_level, **options):
+    '''
+    Hash the inputs of export_fits into a key that identifies the exported
+    FITS file. Extra export options can be passed as keyword arguments.
+    '''
+    snap = os.path.abspath(ds.parameter_filename)
+    stat = os.stat(snap)
+    inputs = [('snapshot', snap),
+              ('snapshot_size', stat.st_size),
+              ('snapshot_mtime', int(stat.st_mtime)),
+              ('center', ['%.3f'%x for x in center.in_units('kpc').value]),
+              ('export_radius', '%.3f'%export_radius.in_units('kpc').value),
+              ('star_particles', star_particles),
+              ('max_level', max_level),
+              ('exporter_version', exporter_version),
+              ('yt_version', yt.__version__)]
+    inputs += sorted(options.items())
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+
+def valid_fits(filename):
+    '''
+    Cheap sanity check of a FITS file: it must start with a primary header
+    and be made of whole 2880 byte blocks.
+    '''
+    if not os.path.exists(filename):
+        return False
+    size = os.path.getsize(filename)
+    if size == 0 or size % 2880:
+        return False
+    with open(filename, 'rb') as fh:
+        return fh.read(9) == 'SIMPLE  ='
+
+
+def cached_export(prefix, key):
+    '''
+    Return the export info stored for prefix if its FITS file was exported
+    with the given key and still looks valid, otherwise return None.
+    '''
+    key_file = prefix+'_export.key'
+    info_file = prefix+'_export_info.npy'
+    if not os.path.exists(key_file) or not os.path.exists(info_file):
+        return None
+    if open(key_file).read().strip() != key:
+        return None
+    if not valid_fits(prefix+'.fits'):
+        return None
+    return np.load(info_file)[()]
+
+
 def get_camprops(cam):
     '''
     Get the properties of the given camera 
@@ -370,6 +804,7 @@ if __name__ == "__main__":
     from yt.analysis_modules.sunrise_export import sunrise_octree_exporter
     from yt.analysis_modules.halo_finding.halo_objects import RockstarHaloList  
     yt.enable_parallelism()
+    plot_writer = PlotWriter(nthreads=args['plot_threads'])
     
     if yt.is_root():
         print '/nStarting '+ sys.argv[0]
@@ -401,10 +836,32 @@ if __name__ == "__main__":
 
     cam_dist, cam_fov = float(args['distance']), float(args['fov'])  
     star_particles, dm_particles = args['star_particles'], args['dm_particles']
-    cams_to_plot = args['cams_to_plot']
+    cams_to_plot, phase_zlim = args['cams_to_plot'], args['phase_zlim']
+    n_isotropic = args['n_isotropic']
     max_level = args['max_level']
+    cell_budget, star_budget = args['cell_budget'], args['star_budget']
+    aggregate_age, aggregate_bins = args['aggregate_age'], args['aggregate_bins']
+    export_region = args['export_region']
+    frustum_depth, scatter_margin = args['frustum_depth'], args['scatter_margin']
+    if frustum_depth is None: frustum_depth = cam_fov
     no_plots, no_export = args['no_plots'], args['no_export']
-       
+    force_export = args['force_export']
+    cutout_dir = args['cutout_dir']
+    preview = args['preview']
+    preview_fraction, preview_pixels = None, None
+    if preview:
+        if not 0 < args['preview_fraction'] <= 1:
+            print 'The preview fraction must be in (0, 1], got %g'%args['preview_fraction']
+            sys.exit()
+        preview_fraction, preview_pixels = args['preview_fraction'], args['preview_pixels']
+        print 'Preview mode: plotting %g of the particles on %ix%i images, not exporting'\
+            %(preview_fraction, preview_pixels, preview_pixels)
+        no_plots, no_export = False, True
+        if cutout_dir:
+            print 'Preview mode subsamples the particles of the snapshots, '\
+                'it can not be used with --cutout_dir'
+            sys.exit()
+
     # Loop over simulation directories    
     for sim_dir in sim_dirs:
         
@@ -431,13 +888,24 @@ if __name__ == "__main__":
             galprops_file = galprops_files[0]
             galprops = np.load(galprops_file)[()] 
 
-        # Generate data series
+        # Generate data series, and the one of the cells of the cutouts if
+        # the plots are made from them
         snaps = glob(sim_dir+'/'+snap_base+'*')
         ts = yt.DatasetSeries(snaps)
+        plot_ts = ts
+        if cutout_dir and not no_plots:
+            cutouts = glob(cutout_dir.replace('sim_dir', sim_dir+'/')+'/'+
+                           snap_base+'*_cutout.h5')
+            plot_ts = [load_cutout(cutout)[0] for cutout in sorted(cutouts)]
+            missing = set(galprops['scale']) - \
+                set([round(1.0/(c.current_redshift+1.0),4) for c in plot_ts])
+            if missing:
+                print 'WARNING: no cutouts in %s for the scales %s, their cameras and '\
+                    'plots are not made'%(cutout_dir, sorted(missing))
 
         # Loop over snapshot to generate cameras and projection plots, 
         # parallelization happens while generating the plots.
-        for ds in reversed(ts): 
+        for ds in reversed(plot_ts): 
 
             scale = round(1.0/(ds.current_redshift+1.0),4)
             if scale not in galprops['scale']: continue
@@ -452,7 +920,8 @@ if __name__ == "__main__":
             except TypeError:
                 L_sum = gas_L
             L = L_sum/np.sqrt(np.sum(L_sum*L_sum))
-            cameras = generate_cameras(L, distance=cam_dist, fov=cam_fov)    
+            cameras = generate_cameras(L, distance=cam_dist, fov=cam_fov,
+                                       n_isotropic=n_isotropic)
     
             # Write cameras to file
             scale_dir = out_dir+'a'+str(scale)+'/'
@@ -464,7 +933,7 @@ if __name__ == "__main__":
             # Make plots
             if not no_plots:
                 print "\nGenerating plots for snapshot %s"%ds.parameter_filename.split('/')[-1]
-                plots_dir = scale_dir+'/yt_plots/'
+                plots_dir = scale_dir+('/yt_plots_preview/' if preview else '/yt_plots/')
                 if yt.is_root():
                     if not os.path.exists(plots_dir): os.makedirs(plots_dir)
 
@@ -479,8 +948,14 @@ if __name__ == "__main__":
                                dm_particles=dm_particles, 
                                star_particles=star_particles,
                                halo_file=halo_file,
-                               cams_to_plot=cams_to_plot)
-                plot_gas(plots_dir+prefix, ds, gal_center, cameras, cams_to_plot=cams_to_plot)
+                               cams_to_plot=cams_to_plot,
+                               preview_fraction=preview_fraction,
+                               preview_pixels=preview_pixels)
+                plot_gas(plots_dir+prefix, ds, gal_center, cameras, cams_to_plot=cams_to_plot,
+                         phase_zlim=phase_zlim, preview_fraction=preview_fraction,
+                         preview_pixels=preview_pixels)
+                plot_writer.flush()
+                plot_writer.report()
                 print "Successfully generated plots for snapshot %s\n"%ds.parameter_filename.split('/')[-1]
 
 
@@ -504,10 +979,57 @@ if __name__ == "__main__":
                     continue
                
                 export_radius = ds.arr(max(1.2*cam_dist, 1.2*cam_fov), 'kpc')
-                export_info = export_fits(ds, gal_center, export_radius, 
-                                          scale_dir+prefix, star_particles, 
-                                          max_level=max_level)
+
+                # Shrink the export region to what the cameras can see
+                if export_region == 'frusta':
+                    camdata = sunriseCameras.read_cameras(scale_dir+prefix+'.cameras')
+                    full_radius = export_radius
+                    frusta_radius = frusta_half_width(camdata, frustum_depth, scatter_margin)
+                    export_radius = ds.arr(min(frusta_radius, full_radius.value), 'kpc')
+
+                # Skip the export if the FITS file is up to date
+                export_key = export_cache_key(ds, gal_center, export_radius,
+                                              star_particles, max_level,
+                                              cell_budget=cell_budget,
+                                              star_budget=star_budget,
+                                              aggregate_age=aggregate_age,
+                                              aggregate_bins=aggregate_bins)
+                key_file = scale_dir+prefix+'_export.key'
+                if not force_export and cached_export(scale_dir+prefix, export_key) is not None:
+                    print 'Export for snapshot %s is up to date, skipping (use --force_export '\
+                        'to export anyway)'%ds.parameter_filename.split('/')[-1]
+                    continue
+                if os.path.exists(key_file): os.remove(key_file)
+
+                export_info = export_fits(ds, gal_center, export_radius,
+                                          scale_dir+prefix, star_particles,
+                                          max_level=max_level,
+                                          cell_budget=cell_budget,
+                                          star_budget=star_budget,
+                                          aggregate_age=aggregate_age,
+                                          aggregate_bins=aggregate_bins)
                 export_info['sim_name'] = prefix.split('_')[0]
                 export_info['scale'] = scale
                 export_info['halo_id'] = prefix.split('_')[1].replace('halo','')
+                export_info['export_key'] = export_key
+                export_info['export_region'] = export_region
+                if export_region == 'frusta':
+                    full_counts = export_level_counts(ds, gal_center, full_radius)
+                    level = export_info['export_max_level']
+                    if level is None: level = full_counts.size-1
+                    full_nleafs = predict_export_cells(full_counts, level)[0]
+                    reduction = float(full_nleafs)/export_info['export_nleafs']
+                    print 'Frusta export region: half-width %.1f kpc instead of %.1f kpc, '\
+                        '%.2f times fewer leaf cells'%(export_radius.value, full_radius.value,
+                                                       reduction)
+                    export_info['export_full_radius'] = full_radius.value
+                    export_info['export_frustum_depth'] = frustum_depth
+                    export_info['export_scatter_margin'] = scatter_margin
+                    export_info['export_cell_reduction'] = reduction
                 np.save(scale_dir+prefix+'_export_info.npy', export_info)
+
+                # The key is written last so an interrupted export is never reused
+                with open(key_file, 'w') as fh:
+                    fh.write(export_key+'\n')
+
+    plot_writer.close()
@@ -0,0 +1,155 @@
+'''
+Make aux.fits, mcrx.fits with the camera images and the grid structure
+replaced by placeholders, without copying mcrx.fits first.
+
+The HDUs of mcrx.fits are copied byte by byte, except CAMERA<i> and
+CAMERA<i>-NONSCATTER, which become 2x2 images of ones with their
+headers, and GRIDSTRUCTURE, which becomes a single row of ones. The
+file is written in one pass, so the IO is the size of aux.fits and
+not that of mcrx.fits. --check compares it with aux.fits made the old
+way, by copying mcrx.fits and updating the HDUs with pyfits.
+
+Usage:
+
+    python mcrxAux.py mcrx.fits aux.fits
+'''
+import os, sys, argparse
+import shutil
+import StringIO
+import numpy as np
+import pyfits as pf
+
+import fitsLayers
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Make aux.fits from the mcrx.fits of a Sunrise run.
+                                 ''')
+
+    parser.add_argument('mcrx_file', help='mcrx.fits file of a Sunrise run.')
+
+    parser.add_argument('aux_file', nargs='?', default='aux.fits', help='Output file.')
+
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Compare with aux.fits made by copying and updating mcrx.fits.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def camera_extnames(ncameras):
+    return [ext%i for i in range(ncameras) for ext in ['CAMERA%i', 'CAMERA%i-NONSCATTER']]
+
+
+def placeholder_hdu(header):
+    return pf.ImageHDU(np.ones((2,2), dtype='f8'), header=header)
+
+
+def gridstructure_hdu(hdu):
+    '''
+    The GRIDSTRUCTURE table with a single row of ones. Only the first row
+    of the table is read.
+    '''
+    img = hdu.data
+    cols = []
+    for i in range(len(img.names)):
+        col = pf.Column(name=img.names[i], format=img.formats[i], array=[img[0][i]])
+        cols.append(col)
+    dat = pf.FITS_rec.from_columns(cols)
+    dat[0] = np.ones(1, dtype=img.dtype)[0]
+    return pf.BinTableHDU(dat, header=hdu.header.copy())
+
+
+def hdu_bytes(hdu):
+    '''
+    The HDU as it is written to a file, as an extension
+    '''
+    primary = StringIO.StringIO()
+    pf.PrimaryHDU().writeto(primary)
+    buf = StringIO.StringIO()
+    pf.HDUList([pf.PrimaryHDU(), hdu]).writeto(buf)
+    return buf.getvalue()[len(primary.getvalue()):]
+
+
+def make_aux(mcrx_file, aux_file):
+    '''
+    Write aux.fits from mcrx.fits in a single pass
+    '''
+    spans = fitsLayers.hdu_spans(mcrx_file)
+    mcrx = pf.open(mcrx_file, memmap=True)
+    placeholders = camera_extnames(mcrx['MCRX'].header['N_CAMERA'])
+
+    fin, fout = open(mcrx_file, 'rb'), open(aux_file+'.tmp', 'wb')
+    for i, span in enumerate(spans):
+        if span['extname'] in placeholders:
+            print span['extname']
+            fout.write(hdu_bytes(placeholder_hdu(mcrx[i].header.copy())))
+            placeholders.remove(span['extname'])
+        elif span['extname'] == 'GRIDSTRUCTURE':
+            fout.write(hdu_bytes(gridstructure_hdu(mcrx[i])))
+        else:
+            fitsLayers.copy_span(fin, fout, span['offset'], span['size'])
+    fin.close()
+    fout.close()
+    mcrx.close()
+    os.rename(aux_file+'.tmp', aux_file)
+
+
+def make_aux_reference(mcrx_file, aux_file):
+    '''
+    aux.fits the way runSunrise.sh used to make it
+    '''
+    shutil.copy(mcrx_file, aux_file)
+    fh = pf.open(mcrx_file)
+    cams = fh['MCRX'].header['N_CAMERA']
+    for extname in camera_extnames(cams):
+        try:
+            img, h = pf.getdata(aux_file, extname, header=True)
+            pf.update(aux_file, np.ones((2,2), dtype='f8'), extname=extname, header=h)
+        except KeyError:
+            pass
+    extname = 'GRIDSTRUCTURE'
+    img, h = pf.getdata(aux_file, extname, header=True)
+    cols = []
+    for i in range(len(img.names)):
+        col = pf.Column(name=img.names[i], format=img.formats[i], array=[img[0][i]])
+        cols.append(col)
+    dat = pf.FITS_rec.from_columns(cols)
+    dat[0] = np.ones(1, dtype=img.dtype)[0]
+    pf.update(aux_file, dat, extname=extname, header=h)
+    fh.close()
+
+
+def check(mcrx_file, aux_file):
+    '''
+    Whether aux_file is identical to the one made the old way
+    '''
+    reference_file = aux_file+'.reference'
+    make_aux_reference(mcrx_file, reference_file)
+    same = fitsLayers.file_md5(aux_file) == fitsLayers.file_md5(reference_file)
+    if not same:
+        for hdu, ref in zip(pf.open(aux_file), pf.open(reference_file)):
+            if hdu.header.tostring() != ref.header.tostring():
+                print 'Header of %s differs'%hdu.name
+            elif hdu.data is not None and \
+                    np.array(hdu.data).tostring() != np.array(ref.data).tostring():
+                print 'Data of %s differs'%hdu.name
+    os.remove(reference_file)
+    print '%s is %s the reference'%(aux_file, 'identical to' if same else 'different from')
+    return same
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    make_aux(args['mcrx_file'], args['aux_file'])
+    print 'Wrote', args['aux_file']
+
+    if args['check'] and not check(args['mcrx_file'], args['aux_file']):
+        sys.exit(1)
@@ -0,0 +1,320 @@
+'''
+Calzetti et al. (2000) attenuation of mcrx.fits for several E(B-V) at once.
+
+The camera image cubes of mcrx.fits are read once, a slab of wavelengths
+at a time from a memory map, attenuated for all E(B-V) with one broadcast
+multiplication and streamed to mcrx-<E(B-V)>.fits. The other HDUs are
+copied byte by byte. With --integrated, the L_lambda_out, _scatter and
+_nonscatter columns of INTEGRATED_QUANTITIES are attenuated as well.
+
+Each output file is identical to the one written for its E(B-V) alone.
+The attenuation curve (R_V = 4.05) is written out here and not taken
+from the per-value mcrx_calzetti.py of impression, so the pipeline keeps
+running that script (see sunriseDriver.py --calzetti_onepass) until
+--check, which runs it for each E(B-V) and compares its output with
+this one HDU by HDU, shows they agree.
+
+Usage:
+
+    python mcrxCalzetti.py mcrx.fits 0.00 0.07 0.14 0.21 0.28 0.35
+    python mcrxCalzetti.py mcrx.fits 0.14 --output_pattern mcrx-%s.fits --check
+'''
+import os, sys, argparse
+import re
+import subprocess
+import numpy as np
+
+import fitsLayers
+
+
+calzetti_rv = 4.05
+
+# Table columns of mcrx.fits that are attenuated, one row per wavelength
+column_pattern = re.compile('^L_lambda_(out|scatter|nonscatter)[0-9]+$')
+
+# Binary table formats as numpy types
+tform_types = {'L':'i1', 'B':'u1', 'I':'>i2', 'J':'>i4', 'K':'>i8',
+               'E':'>f4', 'D':'>f8', 'C':'>c8', 'M':'>c16', 'A':'S1'}
+
+image_types = {8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Apply the Calzetti attenuation to mcrx.fits for
+                                 several values of E(B-V) in one pass.
+                                 ''')
+
+    parser.add_argument('mcrx_file', help='mcrx.fits file of a Sunrise run.')
+
+    parser.add_argument('ebv', nargs='+', help='Values of E(B-V), as they appear in the '\
+                            'output file names.')
+
+    parser.add_argument('--output_pattern', default='mcrx-%s.fits',
+                        help='Output file of each E(B-V), next to mcrx_file.')
+
+    parser.add_argument('--slab_mb', default=256.0, type=float,
+                        help='Size of the wavelength slabs read from each camera cube, in MB.')
+
+    parser.add_argument('--integrated', action='store_true', default=False,
+                        help='Also attenuate the L_lambda columns of INTEGRATED_QUANTITIES.')
+
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Compare the outputs with those of the mcrx_calzetti.py script '\
+                            'of impression, run for each E(B-V).')
+
+    parser.add_argument('--impression', default=os.environ.get('IMPRESSION', ''),
+                        help='Impression dir of the script --check compares with. Defaults '\
+                            'to $IMPRESSION.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def calzetti_k(wavelength):
+    '''
+    Calzetti et al. (2000) k(lambda) for wavelengths in microns, with
+    R_V = 4.05. The curve is extrapolated outside 0.12-2.2 microns and
+    kept from going negative in the infrared.
+    '''
+    wavelength = np.asarray(wavelength, dtype='f8')
+    x = 1.0/wavelength
+    k = np.where(wavelength >= 0.63,
+                 2.659*(-1.857+1.040*x)+calzetti_rv,
+                 2.659*(-2.156+1.509*x-0.198*x**2+0.011*x**3)+calzetti_rv)
+    return np.clip(k, 0.0, None)
+
+
+def attenuation(wavelength, ebvs):
+    '''
+    Factors the flux is multiplied by, shape (len(ebvs), len(wavelength)),
+    for wavelengths in meters
+    '''
+    k = calzetti_k(np.asarray(wavelength, dtype='f8')*1e6)
+    ebvs = np.array([float(ebv) for ebv in ebvs])
+    return 10.0**(-0.4*ebvs[:, None]*k[None, :])
+
+
+def table_dtype(keys):
+    '''
+    Numpy type of the rows of a binary table HDU
+    '''
+    fields = []
+    for i in range(1, keys['TFIELDS']+1):
+        tform = str(keys['TFORM%i'%i])
+        repeat, code = re.match('^([0-9]*)([A-Z])', tform).groups()
+        repeat = int(repeat) if repeat else 1
+        if code == 'A':
+            fields.append((str(keys['TTYPE%i'%i]), 'S%i'%repeat))
+        elif code in tform_types:
+            fields.append((str(keys['TTYPE%i'%i]), tform_types[code], (repeat,)))
+        else:
+            raise ValueError('Unsupported table format %s'%tform)
+    return np.dtype(fields)
+
+
+def read_wavelengths(mcrx_file, spans):
+    '''
+    Wavelengths (m) of the LAMBDA table of mcrx.fits
+    '''
+    span = [s for s in spans if s['extname'] == 'LAMBDA'][0]
+    data = np.memmap(mcrx_file, dtype=table_dtype(span['keys']), mode='r',
+                     offset=span['offset']+span['header_size'],
+                     shape=(span['keys']['NAXIS2'],))
+    return np.array(data['lambda']).reshape(-1).astype('f8')
+
+
+def camera_cube(span, nlambda):
+    '''
+    Whether an HDU is a camera image cube with one plane per wavelength
+    '''
+    keys = span['keys']
+    return span['extname'].startswith('CAMERA') and keys.get('NAXIS') == 3 \
+        and keys['NAXIS3'] == nlambda and keys['BITPIX'] < 0 \
+        and 'BSCALE' not in keys and 'BZERO' not in keys
+
+
+def attenuated_columns(span, nlambda):
+    '''
+    Columns of a table HDU that are attenuated
+    '''
+    keys = span['keys']
+    if span['extname'] != 'INTEGRATED_QUANTITIES' or keys.get('NAXIS2') != nlambda:
+        return []
+    dtype = table_dtype(keys)
+    return [name for name in dtype.names if column_pattern.match(name)
+            and dtype[name].base.kind == 'f' and dtype[name].shape in [(), (1,)]]
+
+
+def write_all(fouts, data):
+    for fout in fouts:
+        fout.write(data)
+
+
+def copy_to_all(fin, fouts, offset, size):
+    '''
+    Copy size bytes at offset of fin to all fouts, reading them once
+    '''
+    fin.seek(offset)
+    while size > 0:
+        data = fin.read(min(size, fitsLayers.chunk_size))
+        if not data:
+            raise IOError('Unexpected end of %s'%fin.name)
+        write_all(fouts, data)
+        size -= len(data)
+
+
+def attenuate_cube(mcrx_file, span, factors, fouts, slab_bytes):
+    '''
+    Stream the attenuated cube of the span to each of fouts, a slab of
+    wavelengths at a time
+    '''
+    keys = span['keys']
+    dtype = np.dtype(image_types[keys['BITPIX']])
+    shape = (keys['NAXIS3'], keys['NAXIS2'], keys['NAXIS1'])
+    cube = np.memmap(mcrx_file, dtype=dtype, mode='r',
+                     offset=span['offset']+span['header_size'], shape=shape)
+    plane_bytes = shape[1]*shape[2]*dtype.itemsize
+    nplanes = max(1, int(slab_bytes//max(plane_bytes*len(fouts), 1)))
+    for l0 in range(0, shape[0], nplanes):
+        slab = cube[l0:l0+nplanes]
+        attenuated = (slab[None, :, :, :]*factors[:, l0:l0+nplanes, None, None]).astype(dtype)
+        for fout, data in zip(fouts, attenuated):
+            fout.write(data.tostring())
+    del cube
+    return shape[0]*plane_bytes
+
+
+def attenuate_table(mcrx_file, span, factors, fouts, columns):
+    '''
+    Write the table of the span with the columns attenuated to each of fouts
+    '''
+    keys = span['keys']
+    dtype = table_dtype(keys)
+    fin = open(mcrx_file, 'rb')
+    fin.seek(span['offset']+span['header_size'])
+    table = np.frombuffer(fin.read(dtype.itemsize*keys['NAXIS2']), dtype=dtype)
+    fin.close()
+    for fout, factor in zip(fouts, factors):
+        attenuated = table.copy()
+        for name in columns:
+            column = attenuated[name]
+            factor_column = factor.reshape((-1,)+(1,)*(column.ndim-1))
+            attenuated[name] = (column*factor_column).astype(column.dtype)
+        fout.write(attenuated.tostring())
+    return dtype.itemsize*keys['NAXIS2']
+
+
+def attenuate(mcrx_file, ebvs, output_files, slab_mb=256.0, integrated=False):
+    '''
+    Write the attenuated mcrx_file of each E(B-V) to its output file in a
+    single pass over mcrx_file
+    '''
+    spans = fitsLayers.hdu_spans(mcrx_file, header=True)
+    wavelength = read_wavelengths(mcrx_file, spans)
+    factors = attenuation(wavelength, ebvs)
+    nlambda = len(wavelength)
+
+    fin = open(mcrx_file, 'rb')
+    fouts = [open(f+'.tmp', 'wb') for f in output_files]
+    for span in spans:
+        columns = []
+        if integrated and 'TFIELDS' in span['keys']:
+            columns = attenuated_columns(span, nlambda)
+        if not camera_cube(span, nlambda) and not columns:
+            copy_to_all(fin, fouts, span['offset'], span['size'])
+            continue
+        print ' '.join(['attenuating', span['extname']]+columns)
+        copy_to_all(fin, fouts, span['offset'], span['header_size'])
+        if columns:
+            nbytes = attenuate_table(mcrx_file, span, factors, fouts, columns)
+        else:
+            nbytes = attenuate_cube(mcrx_file, span, factors, fouts, slab_mb*1024*1024)
+        # The padding of the data to the FITS block size
+        data_offset = span['offset']+span['header_size']
+        copy_to_all(fin, fouts, data_offset+nbytes, span['size']-span['header_size']-nbytes)
+    fin.close()
+    for fout, output_file in zip(fouts, output_files):
+        fout.close()
+        os.rename(output_file+'.tmp', output_file)
+
+
+def impression_script(impression):
+    return os.path.join(os.path.expandvars(impression), 'export', 'input', 'mcrx_calzetti.py')
+
+
+def compare_hdus(output_file, reference_file):
+    '''
+    Differences between the HDUs of two FITS files, as lines to print,
+    with the largest relative difference of the data that differ
+    '''
+    import pyfits
+    differences = []
+    out, ref = pyfits.open(output_file), pyfits.open(reference_file)
+    if len(out) != len(ref):
+        differences.append('%i HDUs instead of %i'%(len(out), len(ref)))
+    for hdu, ref_hdu in zip(out, ref):
+        if hdu.header.tostring() != ref_hdu.header.tostring():
+            differences.append('header of %s'%hdu.name)
+        if hdu.data is None or ref_hdu.data is None:
+            if (hdu.data is None) != (ref_hdu.data is None):
+                differences.append('data of %s'%hdu.name)
+            continue
+        names = hdu.data.dtype.names or [None]
+        for n in names:
+            a = hdu.data if n is None else hdu.data.field(n)
+            b = ref_hdu.data if n is None else ref_hdu.data.field(n)
+            if np.shape(a) == np.shape(b) and np.array_equal(a, b): continue
+            label = hdu.name if n is None else '%s.%s'%(hdu.name, n)
+            if np.shape(a) != np.shape(b) or np.asarray(a).dtype.kind not in 'fiuc':
+                differences.append('data of %s'%label)
+                continue
+            a, b = np.asarray(a, dtype='f8'), np.asarray(b, dtype='f8')
+            scale = np.maximum(np.abs(b), np.finfo('f8').tiny)
+            differences.append('data of %s, max relative difference %.3g'
+                               %(label, np.nanmax(np.abs(a-b)/scale)))
+    out.close()
+    ref.close()
+    return differences
+
+
+def check(mcrx_file, ebvs, output_files, impression):
+    '''
+    Compare the output files with those of the mcrx_calzetti.py script of
+    impression, run for each E(B-V). Returns whether they are all equal.
+    '''
+    script = impression_script(impression)
+    if not os.path.exists(script):
+        print 'ERROR: no %s to compare with, set --impression'%script
+        return False
+    ok = True
+    for ebv, output_file in zip(ebvs, output_files):
+        reference_file = output_file+'.reference'
+        subprocess.check_call([sys.executable, script, mcrx_file, ebv, reference_file])
+        differences = compare_hdus(output_file, reference_file)
+        os.remove(reference_file)
+        for d in differences:
+            print 'MISMATCH in %s: %s'%(output_file, d)
+        print '%s %s the output of %s'%(output_file, 'differs from' if differences else
+                                        'is identical to', script)
+        ok = ok and not differences
+    return ok
+
+
+if __name__ == "__main__":
+
+    args = parse()
+    mcrx_file = args['mcrx_file']
+    out_dir = os.path.dirname(os.path.abspath(mcrx_file))
+    output_files = [out_dir+'/'+args['output_pattern']%ebv for ebv in args['ebv']]
+
+    print 'Attenuating %s for E(B-V) = %s'%(mcrx_file, ' '.join(args['ebv']))
+    attenuate(mcrx_file, args['ebv'], output_files, args['slab_mb'], args['integrated'])
+    print 'Wrote', ' '.join(output_files)
+
+    if args['check'] and not check(mcrx_file, args['ebv'], output_files, args['impression']):
+        sys.exit(1)
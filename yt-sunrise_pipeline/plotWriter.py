@@ -0,0 +1,209 @@
+'''
+Hand rendered plots to a pool of background threads that encode and write
+them to disk, so that the analysis does not sit idle during PNG encoding
+and filesystem writes. The figures are drawn on the calling thread, as
+matplotlib (pyplot, mathtext) is not thread safe: the writers only get
+the pixels.
+
+Usage:
+
+    writer = PlotWriter(nthreads=2, maxsize=8)
+    writer.save(p, prefix)          # yt plot window, phase plot, ...
+    writer.savefig(fig, filename)   # matplotlib figure
+    writer.flush()                  # e.g. at the end of each snapshot
+    writer.close()
+'''
+import os, sys, time
+import threading
+import Queue
+import StringIO
+import traceback
+import numpy as np
+
+
+class PlotWriter(object):
+    '''
+    Pool of writer threads fed through a bounded queue. Submitting blocks
+    when the queue is full, which bounds the memory held by pending plots.
+    Time spent by the workers and time the caller spent waiting on the
+    pool are accumulated separately, see report().
+    '''
+
+    def __init__(self, nthreads=2, maxsize=8):
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.nwritten = 0
+        self.write_time = 0.0
+        self.wait_time = 0.0
+        self.start_time = time.time()
+        self.nthreads = nthreads
+        self.threads = []
+        for i in range(nthreads):
+            thread = threading.Thread(target=self._work, name='PlotWriter-%i'%i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            func, args, kwargs = job
+            t0 = time.time()
+            try:
+                func(*args, **kwargs)
+                ok = True
+            except Exception:
+                ok = False
+                error = traceback.format_exc()
+            with self.lock:
+                self.write_time += time.time()-t0
+                if ok:
+                    self.nwritten += 1
+                else:
+                    self.errors.append(error)
+            self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) in a writer thread
+        '''
+        if not self.threads:
+            return func(*args, **kwargs)
+        t0 = time.time()
+        self.queue.put((func, args, kwargs))
+        self.wait_time += time.time()-t0
+
+    def save(self, p, *args, **kwargs):
+        '''
+        Save a yt plot. Its figures are drawn here, as neither yt data access
+        nor matplotlib drawing is thread safe, and only encoded and written
+        in the background, so p can be modified right after. Plots whose
+        figures cannot be reached (e.g. yt 2 PlotCollections) are saved
+        here entirely.
+        '''
+        plots = getattr(p, 'plots', None)
+        if not self.threads or not isinstance(plots, dict) or \
+                not all([hasattr(plot, 'figure') for plot in plots.values()]):
+            return p.save(*args, **kwargs)
+        if hasattr(p, '_setup_plots'):
+            p._setup_plots()
+        for plot in plots.values():
+            plot.save = self._plot_saver(plot.figure)
+        try:
+            return p.save(*args, **kwargs)
+        finally:
+            for plot in plots.values():
+                del plot.save
+
+    def _plot_saver(self, fig):
+        '''
+        Replacement of the save method of a yt PlotMPL, see save
+        '''
+        try:
+            from yt.funcs import matplotlib_style_context
+        except ImportError:
+            matplotlib_style_context = None
+
+        def save(name, mpl_kwargs=None, canvas=None):
+            kwargs = dict(mpl_kwargs or {})
+            kwargs.pop('papertype', None)
+            if not os.path.splitext(name)[1]:
+                name += '.png'
+            # yt draws its plots with its own matplotlib style
+            if matplotlib_style_context is None:
+                self.savefig(fig, name, **kwargs)
+            else:
+                with matplotlib_style_context():
+                    self.savefig(fig, name, **kwargs)
+            return name
+        return save
+
+    def savefig(self, fig, filename, **kwargs):
+        '''
+        Save and then close a matplotlib figure. The figure is drawn here and
+        only the image is handed to the writers: encoded to PNG there, or
+        already encoded here for the other formats.
+        '''
+        from matplotlib import rcParams
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fmt = kwargs.pop('format', None) or os.path.splitext(filename)[1][1:].lower()
+        if not fmt:
+            fmt = rcParams['savefig.format']
+            filename = '%s.%s'%(filename, fmt)
+        if not self.threads:
+            fig.savefig(filename, format=fmt, **kwargs)
+        elif fmt == 'png':
+            canvas = fig.canvas
+            if not isinstance(canvas, FigureCanvasAgg):
+                canvas = FigureCanvasAgg(fig)
+            dpi = kwargs.get('dpi', rcParams['savefig.dpi'])
+            if dpi == 'figure' or dpi is None: dpi = fig.dpi
+            metadata = kwargs.pop('metadata', None)
+            raw = StringIO.StringIO()
+            fig.savefig(raw, format='raw', **kwargs)
+            width, height = int(canvas.renderer.width), int(canvas.renderer.height)
+            rgba = np.frombuffer(raw.getvalue(), np.uint8).reshape(height, width, 4)
+            self.submit(_write_png, rgba, filename, dpi, metadata)
+        else:
+            encoded = StringIO.StringIO()
+            fig.savefig(encoded, format=fmt, **kwargs)
+            self.submit(_write_bytes, encoded.getvalue(), filename)
+        _close(fig)
+
+    def flush(self):
+        '''
+        Wait until every submitted plot has been written. Errors raised
+        by the writers are printed here.
+        '''
+        t0 = time.time()
+        self.queue.join()
+        self.wait_time += time.time()-t0
+        with self.lock:
+            errors, self.errors = self.errors, []
+        for error in errors:
+            print >> sys.stderr, 'ERROR: plot writer failed with\n', error
+
+    def report(self):
+        '''
+        Print the time spent writing plots next to the analysis time
+        '''
+        elapsed = time.time()-self.start_time
+        print 'Plot writer: %i plots written, %.1f s encoding/writing in %i threads, '\
+            '%.1f s of analysis (%.1f s waiting on writers)'\
+            %(self.nwritten, self.write_time, self.nthreads,
+              elapsed-self.wait_time, self.wait_time)
+
+    def close(self):
+        '''
+        Flush and stop the writer threads
+        '''
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+def _close(fig):
+    if getattr(fig, 'number', None) is not None:
+        import matplotlib.pyplot as plt
+        plt.close(fig)
+
+
+def _write_png(rgba, filename, dpi, metadata=None):
+    from matplotlib import _png, __version__
+    info = {'Software':'matplotlib version'+__version__+', http://matplotlib.org'}
+    info.update(metadata or {})
+    with open(filename, 'wb') as fh:
+        _png.write_png(rgba, fh, dpi, metadata=info)
+
+
+def _write_bytes(data, filename):
+    with open(filename, 'wb') as fh:
+        fh.write(data)
@@ -6,11 +6,21 @@ necessary to submit.
 by Miguel Rocha  - miguel@scitechanalytics.com
 '''
 import os, sys, argparse
+import re
+import time
+import itertools
+import multiprocessing
 from glob import glob
 import numpy as np
 import shutil
 import pyfits  
 import pdb
+import sunriseCameras
+import sunriseCost
+import sunriseExecutor
+import stageStore
+import sunriseManifest
+import fitsLayers
 
 def parse():
     '''
@@ -85,6 +95,67 @@ def parse():
                         help='Modify the ISM temperature as a function of the original temperature. '\
                             'Format:1e0,0.9,1e3,1.0,1e4,1.5,1e5,2.0,1e6')
     
+    parser.add_argument('--copy_fits', action='store_true', default=False,
+                        help='Copy the whole input FITS file to the run directory when its '\
+                            'data is modified, instead of storing only the modified HDUs '\
+                            'and assembling initial.fits right before running Sunrise.')
+
+    parser.add_argument('--verify_layers', action='store_true', default=False,
+                        help='Check that the layered input FITS file is identical to a '\
+                            'full modified copy (which is made and removed).')
+
+    parser.add_argument('--sweep_parameter_sets', nargs='+', default=[],
+                        help='Sweep mode: set up one run per entry, with that parameter set '\
+                            'added to --parameter_set. Combine sets with commas, as in '\
+                            '--sweep_parameter_sets allrays6 allrays7 allrays7,skipir')
+
+    parser.add_argument('--sweep_mcrx', nargs='+', default=[],
+                        help='Sweep mode: mcrx.config option values to sweep over, in the '\
+                            'style --sweep_mcrx=nrays_ir:1e6:1e7. All the sweeps are combined.')
+
+    parser.add_argument('--sweep_sfrhist', nargs='+', default=[],
+                        help='Sweep mode: sfrhist.config option values to sweep over, in the '\
+                            'style --sweep_sfrhist=multiphase:true:false')
+
+    parser.add_argument('--sweep_broadband', nargs='+', default=[],
+                        help='Sweep mode: broadband.config option values to sweep over, in the '\
+                            'style --sweep_broadband=redshift:1.0:2.0')
+
+    parser.add_argument('--sweep_pbs', nargs='+', default=[],
+                        help='Sweep mode: PBS option values to sweep over, in the '\
+                            'style --sweep_pbs=NHOURS:8:24')
+
+    parser.add_argument('--processes', default=None, type=int,
+                        help='Number of processes setting up the runs of a sweep. '\
+                            'Defaults to the number of CPUs.')
+
+    parser.add_argument('--cost_model', default=None,
+                        help='Cost model fitted by sunriseCost.py to completed runs. The '\
+                            'predicted cost of each run is saved in input/cost_prediction.npy '\
+                            'and sets the wall clock requests (NHOURS, PBS_NHOURS, WCL) '\
+                            'of its scripts.')
+
+    parser.add_argument('--cost_margin', default=1.5, type=float,
+                        help='Factor applied to the predicted run time for the wall clock requests.')
+
+    parser.add_argument('--stage_store', default=None,
+                        help='Directory of the sfrhist outputs shared by runs with the same '\
+                            'sfrhist inputs, see stageStore.py. Defaults to sunrise_stages '\
+                            'in the input dir of each snapshot.')
+
+    parser.add_argument('--no_stage_store', action='store_true', default=False,
+                        help='Run sfrhist in every run directory.')
+
+    parser.add_argument('--manifest', default=None,
+                        help='Manifest database the runs are recorded in, see '\
+                            'sunriseManifest.py. Defaults to sunrise_manifest.db in input_dir.')
+
+    parser.add_argument('--benchmark_configs', default=0, type=int,
+                        help='Only render the config files of this many runs (cycling '\
+                            'through the sweep, if any) in memory, with the cached '\
+                            'renderer and the reference one, check that they agree '\
+                            'and print the time each took.')
+
     parser.add_argument('--dryrun', action='store_true', default=False,
                         help='Do not create any files just evaluate all possible.')
     
@@ -98,7 +169,11 @@ def parse():
                         help='Skip IDL dependent blackbox step')
     
     parser.add_argument('--submit', action='store_true', default=False,
-                        help='Submit job automatically using qsub')
+                        help='Run the runs set up on this node once they are all set up, '\
+                            'with sunriseExecutor.py and its defaults.')
+
+    parser.add_argument('--queue_state', default='sunrise_queue.json',
+                        help='Queue state file of the runs started with --submit.')
     
     parser.add_argument('--impression_dir', default='$IMPRESSION',
                         help="Path to Chris Moody's impression package" )
@@ -120,7 +195,8 @@ def parse():
     args = vars(parser.parse_args())
     
     #check parameters in parameters_set
-    for pset in args['parameter_set']:
+    sweep_psets = [p for psets in args['sweep_parameter_sets'] for p in psets.split(',')]
+    for pset in args['parameter_set']+sweep_psets:
         if pset not in parameter_sets.keys():
             parser.error("parameter_set must be: ".join(
                     parameter_sets.keys()))
@@ -259,7 +335,9 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
               dryrun=False, min_age=None, max_age=None, fmass=None, fism_temp=None, 
               fmetallicity=None, random_cameras=None, skip_calzetti=False, 
               limit_cameras=None, cut_radius=None, skip_idl=False, fovcam=None, 
-              short_broadband=False, moviecam=False):
+              short_broadband=False, moviecam=False, full_copy=False,
+              verify_layers=False, cost_model=None, cost_margin=1.5,
+              stage_store=None, manifest=None):
     """
     Setup sunrise run directory with all input files (i.e. config files, FITS file etc ..)
     under the input subdir. Generate the runSunrise.sh script used to run Sunrise and
@@ -292,7 +370,6 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
 
     cfgs = ['mcrx', 'broadband', 'sfrhist', 'pbs']
     for config,paramlines in [(cfg, args[cfg]) for cfg in cfgs]:
-        if config == "pbs":continue #dont add pbs constants to the run name
         for line in paramlines:
             line = line.strip().replace('\n','')
             key,value = line.split(':')
@@ -308,7 +385,7 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
             os.makedirs(run_dir)
         else:
             print 'run_dir %s already exists -- skipping'%run_dir
-            return
+            return None
 
     # Make short name
     short = make_short(info, ['mcrx','broadband','sfrhist',
@@ -344,26 +421,42 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
     # Make input/output/sunrise dirs
     scale = float(info['scale'])
     center = info['export_center']
-    if dryrun: return
-    copy_fits = min_age is not None or max_age is not None \
-        or fism_temp is not None or cut_radius is not None
-    make_paths(run_dir, fits_file, sunrise_dir, copy_fits=copy_fits)
+    if dryrun: return run_name, short, run_dir
+    modified = []
+    if min_age is not None or max_age is not None or cut_radius is not None \
+            or fmass is not None or fmetallicity is not None:
+        modified.append('PARTICLEDATA')
+    if fism_temp is not None:
+        modified.append('GRIDDATA')
+    modifications = dict(cut_radius=cut_radius, min_age=min_age, max_age=max_age,
+                         fmass=fmass, fmetallicity=fmetallicity, fism_temp=fism_temp)
+    if full_copy:
+        make_paths(run_dir, fits_file, sunrise_dir, copy_fits=len(modified) > 0)
+    else:
+        make_paths(run_dir, fits_file, sunrise_dir, layers=modified)
 
     # Modify data if required
-    if cut_radius is not None:
-        modify_cut_radius(run_dir, cut_radius, center)
-    if min_age is not None or max_age is not None:
-        modify_ages(run_dir, min_age, max_age)
-    if fmass is not None:
-        modify_mass(run_dir, fmass)
-    if fmetallicity:
-        modify_metallicity(run_dir,fmetallicity)
-    if fism_temp:
-        modify_ism_temp(run_dir,fism_temp)
+    if modified and full_copy:
+        apply_modifications(run_dir, center, **modifications)
+    elif modified:
+        layer_file = run_dir+'/input/initial.layer.fits'
+        apply_modifications(run_dir, center, initial=layer_file, **modifications)
+        fitsLayers.write_manifest(run_dir+'/input/initial.layers',
+                                  run_dir+'/input/base.fits', layer_file)
+        if verify_layers:
+            full = run_dir+'/input/initial.full.fits'
+            shutil.copy(fits_file, full)
+            apply_modifications(run_dir, center, initial=full, **modifications)
+            if not fitsLayers.verify(run_dir+'/input/initial.layers', full):
+                raise RuntimeError('Layered initial.fits of %s differs from a full copy'%run_dir)
+            os.remove(full)
+            print 'Layered initial.fits matches a full copy'
  
     # Copy cameras and export info file     
     shutil.copy(fits_file.replace('.fits', '.cameras'), run_dir+'/input/cameras' )
     shutil.copy(fits_file.replace('.fits', '.camnames'), run_dir+'/input/camnames')
+    if os.path.exists(fits_file.replace('.fits', '.cameras.npy')):
+        shutil.copy(fits_file.replace('.fits', '.cameras.npy'), run_dir+'/input/cameras.npy')
     shutil.copy(fits_file.replace('.fits', '_export_info.npy'), 
                 run_dir+'/input/export_info.npy')
 
@@ -375,9 +468,46 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
                        limit_cameras=limit_cameras,
                        halo_id=info['halo_id'] )
 
+    # Predict the cost of the run and set the wall clock requests from it
+    resources = None
+    if cost_model is not None:
+        mcrx_text = render_template(parse_template(imp_dir+'/export/input/mcrx.config'), mcrx)
+        ncameras = len(sunriseCameras.read_cameras(run_dir+'/input/cameras'))
+        features = sunriseCost.run_features(info, ncameras, sunriseCost.read_config(mcrx_text))
+        prediction = sunriseCost.predict(sunriseCost.load_model(cost_model), features)
+        resources = sunriseCost.resources(prediction, cost_margin)
+        prediction['resources'] = resources
+        np.save(run_dir+'/input/cost_prediction.npy', prediction)
+        if 'total_time' in prediction:
+            print 'Predicted run time %.1f h, requesting %s h'\
+                %(prediction['total_time']/3600.0, resources['NHOURS'])
+
     make_configs(run_dir, imp_dir, blackbox_dir, run_name, short, mcrx,
                  sfrhist, broadband, pbs, scale, center, skip_calzetti,
-                 skip_idl=skip_idl, short_broadband=short_broadband)
+                 skip_idl=skip_idl, short_broadband=short_broadband,
+                 resources=resources)
+
+    # Share sfrhist.fits with the runs of the same sfrhist inputs
+    if stage_store is not None and os.path.exists(run_dir+'/input/sfrhist.config'):
+        inputs = stageStore.stage_inputs('sfrhist', fits_file, run_dir+'/input/sfrhist.config',
+                                         run_dir, modifications, sunrise_dir)
+        stage_dir = stageStore.stage_dir(stage_store, inputs)
+        fh = open(run_dir+'/input/sfrhist.stage','w')
+        fh.write(stage_dir+'\n')
+        fh.close()
+        print 'sfrhist stage shared in', stage_dir
+
+    # Record the run in the manifest, runSunrise.sh updates it
+    if manifest is not None:
+        parameters = {'parameter_set':parameter_set_names, 'mcrx':mcrx, 'sfrhist':sfrhist,
+                      'broadband':broadband, 'pbs':pbs, 'modifications':modifications,
+                      'cameras':{'ffov':ffov, 'fovcam':fovcam, 'random_cameras':random_cameras,
+                                 'limit_cameras':limit_cameras, 'moviecam':moviecam}}
+        sunriseManifest.add_run(manifest, run_dir, run_name, short, fits_file, parameters,
+                                sunriseManifest.input_hash(fits_file, parameters))
+        fh = open(run_dir+'/input/manifest','w')
+        fh.write(os.path.abspath(manifest)+'\n')
+        fh.close()
 
     # Copy misc files to the sync directory
 #    for misc_file in glob(fits_file.replace('.fits','*')):
@@ -394,13 +524,124 @@ def setup_run(fits_file, info_file, args,  mcrx=None, sfrhist=None,
 #        qsub = 'qsub -q gpu %s/input/pre_one_step.sh'%run_dir
 #    else:
 #        qsub = 'qsub -q gpu_long_free %s/input/pre_one_step.sh'%run_dir
-    if submit:
-        print 'WARNING: Job not submitted. Automatic submission not yet '\
-            'implemented for this system'
+    # Runs are submitted together once all are set up, see sunriseExecutor
+#    if submit:
 #        os.system(qsub)
 #    else:
 #        print qsub
 
+    return run_name, short, run_dir
+
+
+def setup_task(task):
+    '''
+    Set up the run of a (fits_file, info_file, in_dir, args, sunrise_dir,
+    impression_dir, blackbox_dir) task, see setup_run. Returns its
+    (run_name, short, run_dir), or None if it was skipped or failed
+    with --tolerant.
+    '''
+    fits_file, info_file, in_dir, args, sunrise_dir, impression_dir, blackbox_dir = task
+    mcrx, sfrhist, broadband, pbs = {},{},{},{}
+    stage_store = None
+    if not args['no_stage_store']:
+        stage_store = os.path.expandvars(args['stage_store'] or in_dir+'/sunrise_stages')
+    manifest = os.path.expandvars(args['manifest'] or
+                                  os.path.dirname(in_dir.rstrip('/'))+'/sunrise_manifest.db')
+    try:
+        return setup_run(fits_file, info_file, args, mcrx, sfrhist, broadband, 
+                         pbs, args['parameter_set'], in_dir, 
+                         sunrise_dir, impression_dir, blackbox_dir,
+                         args['overwrite'], args['submit'], args['ffov'], 
+                         args['dryrun'], args['min_age'], args['max_age'], 
+                         args['fmass'], args['fism_temp'], args['fmetallicity'], 
+                         args['random_cameras'], args['skip_calzetti'], 
+                         args['limit_cameras'], args['cut_radius'], 
+                         args['skip_idl'], args['fovcam'], 
+                         args['short_broadband'], args['moviecam'],
+                         args['copy_fits'], args['verify_layers'],
+                         args['cost_model'], args['cost_margin'], stage_store,
+                         manifest)
+    except:
+        if not args['tolerant']: raise
+        print 'WARNING: setting up a run for %s failed: %s'%(fits_file, sys.exc_info()[1])
+        return None
+
+
+def effective_config(parameter_set_names, configs):
+    '''
+    The config options a run ends up with for the given parameter sets and
+    --mcrx/--sfrhist/--broadband/--pbs style option lines, as setup_run
+    merges them
+    '''
+    cfgs = ['mcrx', 'sfrhist', 'broadband', 'pbs']
+    effective = dict([(cfg, {}) for cfg in cfgs])
+    for pset in parameter_set_names:
+        for configname, params in parameter_sets.get(pset, {}).iteritems():
+            effective[configname].update(params)
+    for cfg in cfgs:
+        for line in configs[cfg]:
+            key,value = line.strip().replace('\n','').split(':')
+            effective[cfg][key] = value
+    return tuple([(cfg, tuple(sorted(effective[cfg].items()))) for cfg in cfgs])
+
+
+def expand_sweep(args):
+    '''
+    Expand the sweep options into one copy of args per combination of the
+    swept parameter sets and option values, skipping combinations with
+    the same effective configuration as an earlier one
+    '''
+    psets = [p.split(',') for p in args['sweep_parameter_sets']] or [[]]
+    axes = []
+    for cfg in ['mcrx', 'sfrhist', 'broadband', 'pbs']:
+        for sweep in args['sweep_'+cfg]:
+            key, values = sweep.split(':', 1)
+            axes.append([(cfg, key+':'+value) for value in values.split(':')])
+
+    combos, seen = [], set()
+    for pset, lines in itertools.product(psets, itertools.product(*axes)):
+        combo = args.copy()
+        combo['parameter_set'] = args['parameter_set']+pset
+        for cfg in ['mcrx', 'sfrhist', 'broadband', 'pbs']:
+            combo[cfg] = list(args[cfg])
+        for cfg, line in lines:
+            combo[cfg].append(line)
+        config = effective_config(combo['parameter_set'], combo)
+        if config in seen:
+            print 'Skipping %s, same configuration as an earlier combination'\
+                %' '.join(combo['parameter_set']+[l for c, l in lines])
+            continue
+        seen.add(config)
+        combos.append(combo)
+    return combos
+
+
+def find_inputs(input_dir):
+    '''
+    The (snapshot dir, FITS file, export info file) of every snapshot
+    input dir made by genSunriseInput.py in input_dir. Files, such as the
+    default manifest sunrise_manifest.db, are not snapshot dirs.
+    '''
+    inputs = []
+    for dir in os.listdir(input_dir):
+        if not os.path.isdir(input_dir+'/'+dir): continue
+
+        # Change to this input dir and get the FITS file
+        this_in_dir = input_dir+'/'+dir+'/'
+        fits_file = glob(this_in_dir+'*.fits')
+        if len(fits_file) > 1: 
+            print 'WARNING: Multiple FITS files found in %s, using %s'%(this_in_dir, fits_file[0])
+        elif len(fits_file) == 0:
+            print 'WARNING: No input FITS file found in %s, skipping'%this_in_dir
+            continue
+        fits_file = fits_file[0]    
+        info_file = fits_file.replace('.fits','_export_info.npy')
+        if not os.path.exists(info_file):
+            print 'WARNING: No export_info file found in %s, skipping'%this_in_dir
+            continue
+        inputs.append((this_in_dir, fits_file, info_file))
+    return inputs
+
 
 def make_short(info, cfgs, configs, level=0, break_level=1):
     assert level != break_level
@@ -458,7 +699,13 @@ def abbr_function(config,key,value):
     return c,k,v
 
 
-def make_paths(run_dir, fits_file, sunrise_dir, copy_fits=False):
+def make_paths(run_dir, fits_file, sunrise_dir, copy_fits=False, layers=None):
+    '''
+    Make the run directories and link or copy the input FITS file. If the
+    names of the HDUs to be modified are given in layers, only those are
+    copied to input/initial.layer.fits and the export is hard linked as
+    input/base.fits, see fitsLayers.py.
+    '''
 
     empty_dirs = [run_dir, run_dir+'/input', run_dir+'/output']#, run_dir+'/sync']
     for path in empty_dirs:
@@ -474,12 +721,93 @@ def make_paths(run_dir, fits_file, sunrise_dir, copy_fits=False):
         os.symlink(target, source)
 
     #symlink to FITS file
-    if not copy_fits:
+    if layers:
+        fitsLayers.link_base(fits_file, run_dir+'/input/base.fits')
+        fitsLayers.extract_hdus(fits_file, run_dir+'/input/initial.layer.fits', layers)
+    elif not copy_fits:
         os.symlink(fits_file, run_dir+'/input/initial.fits')
     else:
         shutil.copy(fits_file, run_dir+'/input/initial.fits')
 
 
+def apply_modifications(run_dir, center, cut_radius=None, min_age=None, max_age=None,
+                        fmass=None, fmetallicity=None, fism_temp=None, initial=None):
+    '''
+    Same as calling modify_cut_radius, modify_ages, modify_mass,
+    modify_metallicity and modify_ism_temp in that order, but opening
+    initial.fits (or the given initial file) once. The columns are scaled
+    in place through a memory map, and PARTICLEDATA is only rewritten if
+    particles are removed.
+    '''
+    if initial is None: initial = run_dir+'/input/initial.fits'
+    hdus = pyfits.open(initial, mode='update', memmap=True)
+    try:
+        if cut_radius is not None or min_age is not None or max_age is not None \
+                or fmass is not None or fmetallicity:
+            pd = hdus['PARTICLEDATA'].data
+            keep = np.ones(len(pd), dtype=bool)
+            if cut_radius is not None:
+                cut_radius = float(cut_radius)
+                print 'Removing particles outside %1.1f kpc'%cut_radius
+                rad = np.sqrt(np.sum((pd['position'] - center)**2.0,axis=1))
+                keep &= rad < cut_radius
+            if min_age is not None or max_age is not None:
+                if min_age is None: min_age = -1.0
+                if max_age is None: max_age = np.inf
+                min_age, max_age = float(min_age), float(max_age)
+                print 'Updating particle min ages %1.1e years'%min_age
+                print 'Updating particle max ages %1.1e years'%max_age
+                age = pd['age']
+                keep &= (age > min_age) & (age < max_age)
+            if not np.all(keep):
+                pd = pd[keep]
+                hdus['PARTICLEDATA'].data = pd
+
+            if fmass is not None:
+                scale_by_age(pd, 'mass', fmass)
+            if fmetallicity:
+                scale_by_age(pd, 'metallicity', fmetallicity)
+        if fism_temp:
+            scale_ism_temp(hdus['GRIDDATA'].data, fism_temp)
+    finally:
+        hdus.close()
+
+
+def scale_by_age(pd, column, fraw):
+    '''
+    Scale column of the particles in each age interval in place,
+    fraw = 'age0,f0,age1,f1,...,ageN'
+    '''
+    fraw = np.array([float(x) for x in fraw.split(',')])
+    age_intervals = fraw[::2]
+    factors = fraw[1::2]
+    assert factors.shape[0] == age_intervals.shape[0]-1
+    age, values = pd['age'], pd[column]
+    for agea,ageb,fm in zip(age_intervals[:-1],age_intervals[1:],factors):
+        idx = (age >= agea) & (age <= ageb)
+        values[idx] *= float(fm)
+        out = (np.sum(idx),agea/1e6,ageb/1e6,fm)
+        print 'modified %i particles %1.1eMyr-%1.1eMyr by %1.1f '%out
+
+
+def scale_ism_temp(gd, fism_temp):
+    '''
+    Scale gas_temp_m of the cells in each temperature interval in place,
+    fism_temp = 'T0,f0,T1,f1,...,TN'
+    '''
+    fism_temp= np.array([float(x) for x in fism_temp.split(',')])
+    temp_intervals = fism_temp[::2]
+    fts = fism_temp[1::2]
+    assert fts.shape[0] == temp_intervals.shape[0]-1
+    temp_m, mass = gd['gas_temp_m'], gd['mass_gas']
+    for ta,tb,ft in zip(temp_intervals[:-1],temp_intervals[1:],fts):
+        ism_temp = temp_m/mass
+        idx = (ism_temp > ta) & (ism_temp < tb)
+        temp_m[idx] *= ft
+        out = (np.sum(idx),ta,tb,ft)
+        print 'modified %i cells %1.1fK-%1.1fK by %1.1f '%out
+
+
 def modify_cut_radius(run_dir, cut_radius, center):
     cut_radius = float(cut_radius)
     print 'Removing particles outside %1.1f kpc'%cut_radius
@@ -570,8 +898,10 @@ def modify_ism_temp(run_dir, fism_temp):
 def modify_cameras(run_dir,ffov=None,fovcam=None,limit_cameras=None,
                    random_cameras=None,halo_id=None,moviecam=False):
     camera_file = run_dir+'/input/cameras'
-    camdata = np.loadtxt(camera_file)
+    camdata = sunriseCameras.read_cameras(camera_file)
     shutil.move(camera_file, camera_file+'.old')    
+    if os.path.exists(camera_file+'.npy'):
+        shutil.move(camera_file+'.npy', camera_file+'.old.npy')
     if limit_cameras:
         camdata = camdata[:int(limit_cameras)]
     fidx = Ellipsis
@@ -591,93 +921,41 @@ def modify_cameras(run_dir,ffov=None,fovcam=None,limit_cameras=None,
         camdata[fidx,-1]*=ffov
     if random_cameras:
         #to calculate the new cameras
-        np.random.seed(int(halo_id))
         afov = camdata[0,-1]
         rad  = np.sqrt((camdata[0,0:3]**2.0).sum())
-        shape = list(camdata.shape) 
-        shape[0] += int(random_cameras)
-        rcamdata = np.zeros(shape,'float')
-        rcamdata[:camdata.shape[0],:]=camdata
-        for j in range(camdata.shape[0],shape[0]):
-            theta = np.random.random()*1.0*np.pi
-            phi   = np.random.random()*2.0*np.pi
-            x = rad*np.sin(theta)*np.cos(phi) 
-            y = rad*np.sin(theta)*np.sin(phi) 
-            z = rad*np.cos(theta)
-            rcamdata[j,0]=x
-            rcamdata[j,1]=y
-            rcamdata[j,2]=z
-            rcamdata[j,3]=-1.0*x
-            rcamdata[j,4]=-1.0*y
-            rcamdata[j,5]=-1.0*z
-            rcamdata[j,6]=np.random.random()
-            rcamdata[j,7]=np.random.random()
-            rcamdata[j,8]=np.random.random()
-            rcamdata[j,9]=afov
-        camdata = rcamdata     
-    np.savetxt(camera_file,camdata)    
+        rcamdata = sunriseCameras.random_cameras(int(random_cameras), rad, afov, halo_id)
+        camdata = np.concatenate([camdata, rcamdata])
+    sunriseCameras.write_cameras(camera_file, camdata)    
 
 
 def make_configs(run_dir, imp_dir, blackbox_dir, run_name, short, 
                  mcrx, sfrhist, broadband, pbs, scale, center,
                  skip_calzetti=False, skip_idl=False,
-                 short_broadband=False):
+                 short_broadband=False, resources=None):
     '''
     Generate the following configuration files:
       sfrhist.config
       broadbandz.config, broadband.config, 
       mcrx.config, mcrx_no_ir.config
 
-    And modify runSunrise.sh if necesary
+    And modify runSunrise.sh if necesary. resources override the default
+    wall clock values (see sunriseCost.resources)
 
     '''
-    files = glob(imp_dir+'/export/input/*config')
-    files += (os.path.expandvars('$AGORA_PIPE_INSTALL/scripts/runSunrise.sh')),
-#    files += ( os.path.expandvars('$AGORA_PIPE_INSTALL/scripts/runSunrise.pbs')),
-    files += (imp_dir+'/export/input/filters_redshifted'),
-    files += (imp_dir+'/export/input/filters_redshifted_short'),
-    files += (imp_dir+'/export/input/filters_restframe'),
-    files += (imp_dir+'/export/input/filters_restframe_short'),
-
     var_dicts = {'sfrhist':sfrhist, 'mcrx':mcrx, 'broadbandz':broadband,
-                 'broadband':broadband} #,'runSunrise':pbs}
+                 'broadband':broadband}
 
     sfrhist['translate_origin'] = str(center).strip('[]')
 
-    for config in files:
+    for config in config_files(imp_dir):
         config_base = os.path.basename(config)
-        config_type = config_base.replace('.config','')
-        if config_type.endswith('.sh'):
-            config_type = config_type.replace('.sh','')
-        if config_type.endswith('.pbs'):
-            config_type = config_type.replace('.pbs','')
+        config_type = template_type(config_base)
         config_dict = var_dicts.get(config_type,{})
-        lines = open(config).readlines()
-        text = ''
-        used_keys = [] #make sure all are used!
-        pad = 25
-        for line in lines:
-            if len(config_dict.keys())>0:
-                for k,v in config_dict.iteritems():
-                    if line.startswith(k) and k is not '':
-                        if v is None: break
-                        pad=line_padding(line)
-                        newline = k.ljust(pad)+' '
-                        newline+=str(v)
-                        text += newline+'\n'
-                        used_keys += k
-                        break
-                else:
-                    text += line
-            else:
-                text += line
+        text = render_template(parse_template(config), config_dict)
+        if config_type == 'runSunrise':
+            # The PBS options are $VARIABLES of the script, not config lines
+            config_dict = pbs_values(pbs)
 
-        for k,v in config_dict.iteritems():
-            if k in used_keys: continue
-            if k is '': continue
-            if v is None: continue
-            text += k.ljust(pad)+' '+str(v)+'\n'
-        
         if config_type == 'runSunrise':
             fh = open(run_dir+'/'+config_base,'w')
         else:    
@@ -686,19 +964,178 @@ def make_configs(run_dir, imp_dir, blackbox_dir, run_name, short,
         text = rep_text(text, run_dir, imp_dir, blackbox_dir,  
                         run_name, short, config_dict, (1.0/scale)-1.0,
                         skip_calzetti, short_broadband,
-                        skip_idl)
+                        skip_idl, resources)
         fh.write(text)
         fh.close()
 
 
+def pbs_values(pbs):
+    '''
+    The $VARIABLES of runSunrise.sh set by the pbs options. An NHOURS
+    without PBS_NHOURS or WCL sets them in the relation of the defaults,
+    as sunriseCost.resources does.
+    '''
+    values = dict([(k.upper(), v) for k,v in pbs.iteritems()])
+    if 'NHOURS' in values:
+        nhours = int(values['NHOURS'])
+        values.setdefault('PBS_NHOURS', str(nhours-1))
+        values.setdefault('WCL', str(nhours*3600-100))
+    return values
+
+
+def config_files(imp_dir):
+    '''
+    Config templates and filter lists written to every run
+    '''
+    files = glob(imp_dir+'/export/input/*config')
+    files += (os.path.expandvars('$AGORA_PIPE_INSTALL/scripts/runSunrise.sh')),
+#    files += ( os.path.expandvars('$AGORA_PIPE_INSTALL/scripts/runSunrise.pbs')),
+    files += (imp_dir+'/export/input/filters_redshifted'),
+    files += (imp_dir+'/export/input/filters_redshifted_short'),
+    files += (imp_dir+'/export/input/filters_restframe'),
+    files += (imp_dir+'/export/input/filters_restframe_short'),
+    return files
+
+
+def template_type(config_base):
+    config_type = config_base.replace('.config','')
+    if config_type.endswith('.sh'):
+        config_type = config_type.replace('.sh','')
+    if config_type.endswith('.pbs'):
+        config_type = config_type.replace('.pbs','')
+    return config_type
+
+
+# Parsed templates by file name, see parse_template
+templates = {}
+
+def parse_template(filename):
+    '''
+    Read a config template once per process. Returns a dictionary with its
+    lines and the per key order plans of render_template.
+    '''
+    stat = os.stat(filename)
+    template = templates.get(filename)
+    if template is None or template['stat'] != (stat.st_mtime, stat.st_size):
+        template = {'stat':(stat.st_mtime, stat.st_size),
+                    'lines':open(filename).readlines(), 'plans':{}}
+        templates[filename] = template
+    return template
+
+
+def template_plan(template, keys):
+    '''
+    For each line of the template, the first of keys (in order) the line
+    starts with and the padding of the line, or None. The matches are
+    found by looking up the line prefixes of every key length.
+    '''
+    plan = template['plans'].get(keys)
+    if plan is not None: return plan
+    order = {}
+    for i, k in enumerate(keys):
+        if k != '': order.setdefault(k, i)
+    lengths = sorted(set([len(k) for k in order]))
+    plan = []
+    for line in template['lines']:
+        matches = [line[:n] for n in lengths if line[:n] in order]
+        if matches:
+            k = min(matches, key=order.get)
+            plan.append((k, line_padding(line)))
+        else:
+            plan.append(None)
+    template['plans'][keys] = plan
+    return plan
+
+
+def render_template(template, config_dict):
+    '''
+    Set the values of config_dict in the template: lines starting with a
+    key are replaced by the key and its value (dropped if the value is
+    None) and the keys are then appended. Gives the same text as
+    render_template_reference.
+    '''
+    if not config_dict: return ''.join(template['lines'])
+    plan = template_plan(template, tuple(config_dict.keys()))
+    text = []
+    used_keys = set()
+    pad = 25
+    for line, match in zip(template['lines'], plan):
+        if match is None:
+            text.append(line)
+            continue
+        k, line_pad = match
+        v = config_dict[k]
+        if v is None: continue
+        pad = line_pad
+        text.append(k.ljust(pad)+' '+str(v)+'\n')
+        # The reference renderer collects the characters of the keys,
+        # so only single character keys are not appended again
+        used_keys.update(k)
+
+    for k,v in config_dict.iteritems():
+        if k in used_keys: continue
+        if k == '': continue
+        if v is None: continue
+        text.append(k.ljust(pad)+' '+str(v)+'\n')
+    return ''.join(text)
+
+
+def render_template_reference(config, config_dict):
+    '''
+    Line by line renderer that render_template replaces, kept to check
+    and benchmark it against (see --benchmark_configs)
+    '''
+    lines = open(config).readlines()
+    text = ''
+    used_keys = [] #make sure all are used!
+    pad = 25
+    for line in lines:
+        if len(config_dict.keys())>0:
+            for k,v in config_dict.iteritems():
+                if line.startswith(k) and k is not '':
+                    if v is None: break
+                    pad=line_padding(line)
+                    newline = k.ljust(pad)+' '
+                    newline+=str(v)
+                    text += newline+'\n'
+                    used_keys += k
+                    break
+            else:
+                text += line
+        else:
+            text += line
+
+    for k,v in config_dict.iteritems():
+        if k in used_keys: continue
+        if k is '': continue
+        if v is None: continue
+        text += k.ljust(pad)+' '+str(v)+'\n'
+    return text
+
+
 def rep_text(text, run_dir, imp_dir, blackbox_dir, run_name, 
              short, config_dict, redshift,
              skip_calzetti, short_broadband,
-             skip_idl):
+             skip_idl, resources=None):
     '''
     Replace environment vars in .sh and .pbs files
     '''
+    return substitute(text, rep_values(run_dir, imp_dir, blackbox_dir, run_name,
+                                       short, config_dict, redshift,
+                                       skip_calzetti, short_broadband,
+                                       skip_idl, resources))
+
+
+def rep_values(run_dir, imp_dir, blackbox_dir, run_name, short, config_dict,
+               redshift, skip_calzetti, short_broadband, skip_idl, resources=None):
+    '''
+    Values of the $VARIABLES of the templates: config_dict, resources
+    and defaults
+    '''
     rep_dict = config_dict.copy()
+    if resources:
+        for k,v in resources.iteritems():
+            rep_dict.setdefault(k,v)
 
     rep_dict.setdefault('SHORTNAME',short)
     rep_dict.setdefault('RUN_DIR',run_dir)
@@ -722,15 +1159,95 @@ def rep_text(text, run_dir, imp_dir, blackbox_dir, run_name,
     else:
         rep_dict.setdefault('FILTERSET','filters_restframe') 
         rep_dict.setdefault('FILTERSETZ','filters_redshifted') 
+    return rep_dict
 
+
+# Compiled $VARIABLE patterns by key order, see substitute
+substitution_patterns = {}
+
+def substitute(text, rep_dict):
+    '''
+    Replace $KEY by the value of each (upper cased) key of rep_dict in a
+    single pass. Where several keys match, as $FILTERSET and $FILTERSETZ,
+    the first one in the order of rep_dict wins, as it does when
+    replacing one key after the other. That is done instead when values
+    could themselves form a $KEY.
+    '''
+    if '$' not in text: return text
+    items = [(k.upper(), str(v)) for k,v in rep_dict.iteritems() if k != '']
+    if '$$' in text or any(['$' in k or '$' in v for k,v in items]):
+        return substitute_reference(text, rep_dict)
+    lookup = {}
+    for k,v in items: lookup.setdefault(k, v)
+    keys = tuple([k for k,v in items])
+    pattern = substitution_patterns.get(keys)
+    if pattern is None:
+        alternatives = []
+        for k in keys:
+            if k not in alternatives: alternatives.append(k)
+        pattern = re.compile(r'\$(%s)'%'|'.join([re.escape(k) for k in alternatives]))
+        substitution_patterns[keys] = pattern
+    pieces = pattern.split(text)
+    pieces[1::2] = [lookup[k] for k in pieces[1::2]]
+    return ''.join(pieces)
+
+
+def benchmark_configs(imp_dir, blackbox_dir, combos, nruns=1000):
+    '''
+    Render the configs of nruns runs, cycling through the sweep combos,
+    with render_template and substitute and with the reference renderer.
+    Raises an error if any text differs and prints the time each took.
+    '''
+    runs = []
+    for i in range(nruns):
+        combo = combos[i%len(combos)]
+        effective = dict(effective_config(combo['parameter_set'], combo))
+        mcrx, sfrhist, broadband = [dict(effective[cfg]) for cfg in
+                                    ['mcrx', 'sfrhist', 'broadband']]
+        sfrhist['translate_origin'] = '%.6f %.6f %.6f'%(0.1*i, 0.2*i, 0.3*i)
+        var_dicts = {'sfrhist':sfrhist, 'mcrx':mcrx, 'broadbandz':broadband,
+                     'broadband':broadband}
+        runs.append(('/sunrise_runs/run_%05i'%i, 'run_%05i'%i, 'r%05i'%i, var_dicts,
+                     pbs_values(dict(effective['pbs']))))
+
+    def render(reference):
+        texts = []
+        for run_dir, run_name, short, var_dicts, pbs in runs:
+            for config in config_files(imp_dir):
+                config_type = template_type(os.path.basename(config))
+                config_dict = var_dicts.get(config_type,{})
+                values = rep_values(run_dir, imp_dir, blackbox_dir, run_name, short,
+                                    pbs if config_type == 'runSunrise' else config_dict,
+                                    1.0, False, False, False)
+                if reference:
+                    text = render_template_reference(config, config_dict)
+                    texts.append(substitute_reference(text, values))
+                else:
+                    text = render_template(parse_template(config), config_dict)
+                    texts.append(substitute(text, values))
+        return texts
+
+    t0 = time.time()
+    reference = render(True)
+    t1 = time.time()
+    cached = render(False)
+    t2 = time.time()
+    if cached != reference:
+        raise RuntimeError('Rendered configs differ from the reference renderer')
+    print 'Rendered %i config files of %i runs, identical to the reference'\
+        %(len(cached), nruns)
+    print 'reference: %.3f s, cached: %.3f s (%.1fx)'\
+        %(t1-t0, t2-t1, (t1-t0)/max(t2-t1, 1e-9))
+
+
+def substitute_reference(text, rep_dict):
     for k,v in rep_dict.iteritems():
         if k == '': continue
         k = k.upper()
         text=text.replace('$'+k, str(v))
-
     return text
 
-        
+
 def line_padding(line):
     #figure out what the in-place line padding is
     step =0
@@ -771,7 +1288,15 @@ if __name__ == "__main__":
         input_dir = os.path.expandvars(input_dir)
         input_dir = os.path.abspath(input_dir)
 
-    tolerant = args['tolerant']    
+    sweep = any([args[s] for s in ['sweep_parameter_sets', 'sweep_mcrx', 'sweep_sfrhist',
+                                   'sweep_broadband', 'sweep_pbs']])
+    combos = expand_sweep(args) if sweep else [args]
+    processes = args['processes'] or multiprocessing.cpu_count()
+    tasks = []
+
+    if args['benchmark_configs']:
+        benchmark_configs(impression_dir, blackbox_dir, combos, args['benchmark_configs'])
+        sys.exit()
 
     # Loop over simulation directories    
     for sim_dir in sim_dirs:
@@ -786,52 +1311,32 @@ if __name__ == "__main__":
             print 'have you run genSunriseInput.py for this simulation?'
             print 'if yes, use the out_dir in genSunriseInput.py as input_dir here (default)'
             sys.exit()
-        in_dirs = os.listdir(input_dir)
 
-        # Loop over snapshot input directories and setup runs for each of them
-        for dir in in_dirs:
-            
-            print '\nSetting up run for snapthot dir', dir
-
-            # Change to this input dir and get the FITS file
-            this_in_dir = input_dir+'/'+dir+'/'
-            fits_file = glob(this_in_dir+'*.fits')
-            if len(fits_file) > 1: 
-                print 'WARNING: Multiple FITS files found in %s, using %s'%(this_in_dir, fits_file[0])
-            elif len(fits_file) == 0:
-                print 'WARNING: No input FITS file found in %s, skipping'%this_in_dir
-                continue
-            fits_file = fits_file[0]    
-            info_file = fits_file.replace('.fits','_export_info.npy')
-            if not os.path.exists(info_file):
-                print 'WARNING: No export_info file found in %s, skipping'%this_in_dir
-                continue
-            mcrx, sfrhist, broadband, pbs = {},{},{},{}
-         
-            if tolerant:
-                try:
-                    setup_run(fits_file, info_file, args, mcrx, sfrhist, broadband, 
-                              pbs, args['parameter_set'], this_in_dir, 
-                              sunrise_dir, impression_dir,  blackbox_dir,
-                              args['overwrite'], args['submit'], args['ffov'], 
-                              args['dryrun'], args['min_age'], args['max_age'], 
-                              args['fmass'], args['fism_temp'], args['fmetallicity'], 
-                              args['random_cameras'], args['skip_calzetti'], 
-                              args['limit_cameras'], args['cut_radius'], 
-                              args['skip_idl'], args['fovcam'], 
-                              args['short_broadband'], args['moviecam'])
-                except:
-                    pass
-            else:
-                setup_run(fits_file, info_file, args, mcrx, sfrhist, broadband, 
-                          pbs, args['parameter_set'], this_in_dir, 
-                          sunrise_dir, impression_dir, blackbox_dir,
-                          args['overwrite'], args['submit'], args['ffov'], 
-                          args['dryrun'], args['min_age'], args['max_age'], 
-                          args['fmass'], args['fism_temp'], args['fmetallicity'], 
-                          args['random_cameras'], args['skip_calzetti'], 
-                          args['limit_cameras'], args['cut_radius'], 
-                          args['skip_idl'], args['fovcam'], 
-                          args['short_broadband'], args['moviecam'])
-                        
-                        
+        # Set up a run for each snapshot input dir and config combination
+        for this_in_dir, fits_file, info_file in find_inputs(input_dir):
+            for combo in combos:
+                tasks.append((fits_file, info_file, this_in_dir, combo,
+                              sunrise_dir, impression_dir, blackbox_dir))
+
+    if sweep:
+        print '\nSetting up %i runs (%i configurations) in %i processes'\
+            %(len(tasks), len(combos), processes)
+        pool = multiprocessing.Pool(processes)
+        runs = pool.map(setup_task, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        runs = []
+        for task in tasks:
+            print '\nSetting up run for snapthot dir', os.path.basename(task[2].rstrip('/'))
+            runs.append(setup_task(task))
+
+    # Manifest of the runs
+    runs = [run for run in runs if run is not None]
+    print '\n%i runs set up'%len(runs)
+    for run_name, short, run_dir in runs:
+        print '%s  %s  %s'%(short, run_name, run_dir)
+
+    if args['submit'] and not args['dryrun']:
+        sunriseExecutor.execute([run_dir for run_name, short, run_dir in runs],
+                                args['queue_state'])
@@ -0,0 +1,256 @@
+'''
+Resource monitor of the stages of a Sunrise run. A thread samples the
+process tree of each running stage from /proc every interval seconds:
+the summed RSS, CPU time and IO bytes of its processes, and the memory
+used on the node. The samples go to output/stage_resources.tsv, and
+the peaks and totals of each stage to output/stage_resources.json when
+it finishes. The CPU time and the largest RSS of the stage then come
+from the rusage of its process, which includes every process it waited
+for.
+
+sunriseDriver.py monitors its stages with it (see --monitor_interval),
+sunriseCost.py takes the memory of mcrx from it and the manifest keeps
+the peak RSS and CPU time of each stage. Processes started through a
+launcher such as aprun run on other nodes and are not seen here, but
+the memory used on the node is.
+
+Usage:
+
+    monitor = StageMonitor(output_dir, interval=5.0)
+    monitor.start()
+    monitor.add('mcrx', pid)
+    summary = monitor.remove('mcrx', rusage)
+    monitor.close()
+
+    python stageMonitor.py run_dir/output
+'''
+import os, sys, argparse
+import json
+import time
+import threading
+
+
+page_mb = os.sysconf('SC_PAGE_SIZE')/1048576.0
+clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+
+timeseries_columns = ['time', 'stage', 'nprocs', 'rss_mb', 'cpu_s', 'read_mb', 'write_mb',
+                      'node_used_mb']
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Print the resources used by the stages of a Sunrise run.
+                                 ''')
+
+    parser.add_argument('output_dir', nargs='?', default='.',
+                        help='Output dir of the Sunrise run.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def children_map():
+    '''
+    Child pids of each pid on the node
+    '''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            stat = open('/proc/%s/stat'%entry).read()
+        except IOError:
+            continue
+        ppid = int(stat[stat.rindex(')')+2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def process_tree(pid, children):
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo += children.get(p, [])
+    return tree
+
+
+def process_sample(pid):
+    '''
+    RSS (MB), CPU time (s), and bytes read and written of a process, None
+    if it is gone. The IO bytes are 0 if /proc/<pid>/io is not readable.
+    '''
+    try:
+        stat = open('/proc/%i/stat'%pid).read()
+    except IOError:
+        return None
+    fields = stat[stat.rindex(')')+2:].split()
+    rss = int(fields[21])*page_mb
+    cpu = (int(fields[11])+int(fields[12]))/clock_ticks
+    read_bytes, write_bytes = 0, 0
+    try:
+        for line in open('/proc/%i/io'%pid):
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line.split()[1])
+            elif line.startswith('write_bytes:'):
+                write_bytes = int(line.split()[1])
+    except IOError:
+        pass
+    return rss, cpu, read_bytes, write_bytes
+
+
+def node_used_mb():
+    '''
+    Memory used on the node (MB), without buffers and caches
+    '''
+    info = {}
+    for line in open('/proc/meminfo'):
+        fields = line.split()
+        info[fields[0].rstrip(':')] = float(fields[1])/1024.0
+    if 'MemAvailable' in info:
+        return info['MemTotal']-info['MemAvailable']
+    return info['MemTotal']-info['MemFree']-info.get('Buffers', 0)-info.get('Cached', 0)
+
+
+class StageMonitor(object):
+    '''
+    Samples the process trees of the stages added to it in a thread
+    '''
+
+    def __init__(self, output_dir, interval=5.0):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stages = {}
+        self.summaries = {}
+        self.timeseries = open(os.path.join(output_dir, 'stage_resources.tsv'), 'w')
+        self.timeseries.write('# '+' '.join(timeseries_columns)+'\n')
+        self.thread = threading.Thread(target=self._work, name='StageMonitor')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set(): break
+            try:
+                self.sample()
+            except (IOError, OSError), e:
+                print 'WARNING: stage monitor sample failed:', e
+
+    def add(self, name, pid):
+        '''
+        Monitor the process tree of pid as the stage name
+        '''
+        with self.lock:
+            self.stages[name] = {'pid':pid, 'start':time.time(), 'node_start':node_used_mb(),
+                                 'processes':{}, 'peak_rss_mb':0.0, 'peak_node_used_mb':0.0,
+                                 'max_procs':0, 'nsamples':0}
+
+    def sample(self):
+        '''
+        Sample every monitored stage once
+        '''
+        now = time.time()
+        children = children_map()
+        node = node_used_mb()
+        lines = []
+        with self.lock:
+            for name, s in sorted(self.stages.iteritems()):
+                rss, nprocs = 0.0, 0
+                for pid in process_tree(s['pid'], children):
+                    sample = process_sample(pid)
+                    if sample is None: continue
+                    rss += sample[0]
+                    nprocs += 1
+                    s['processes'][pid] = sample[1:]
+                cpu, read_mb, write_mb = self.totals(s)
+                s['peak_rss_mb'] = max(s['peak_rss_mb'], rss)
+                s['peak_node_used_mb'] = max(s['peak_node_used_mb'], node)
+                s['max_procs'] = max(s['max_procs'], nprocs)
+                s['nsamples'] += 1
+                lines.append('%.1f %s %i %.1f %.2f %.1f %.1f %.1f\n'
+                             %(now, name, nprocs, rss, cpu, read_mb, write_mb, node))
+            self.timeseries.writelines(lines)
+            self.timeseries.flush()
+
+    def totals(self, s):
+        '''
+        CPU time and MB read and written by all the processes of a stage
+        seen so far, the gone ones at their last sample
+        '''
+        processes = s['processes'].values()
+        return (sum([p[0] for p in processes]),
+                sum([p[1] for p in processes])/1048576.0,
+                sum([p[2] for p in processes])/1048576.0)
+
+    def remove(self, name, rusage=None):
+        '''
+        Stop monitoring a stage whose process has been waited for, with its
+        rusage if known, and save its summary
+        '''
+        with self.lock:
+            s = self.stages.pop(name, None)
+        if s is None: return None
+        cpu, read_mb, write_mb = self.totals(s)
+        peak_rss = s['peak_rss_mb']
+        if rusage is not None:
+            cpu = rusage.ru_utime+rusage.ru_stime
+            peak_rss = max(peak_rss, rusage.ru_maxrss/1024.0)
+        elapsed = time.time()-s['start']
+        summary = {'peak_rss_mb':peak_rss, 'cpu_time':cpu, 'read_mb':read_mb,
+                   'write_mb':write_mb, 'elapsed':elapsed,
+                   'cpu_utilization':cpu/elapsed if elapsed > 0 else 0.0,
+                   'max_procs':s['max_procs'], 'nsamples':s['nsamples'],
+                   'peak_node_used_mb':s['peak_node_used_mb'] or None,
+                   'node_used_delta_mb':s['peak_node_used_mb']-s['node_start']
+                   if s['nsamples'] else None}
+        with self.lock:
+            self.summaries[name] = summary
+            self.save()
+        return summary
+
+    def save(self):
+        filename = os.path.join(self.output_dir, 'stage_resources.json')
+        fh = open(filename+'.tmp', 'w')
+        json.dump({'interval':self.interval, 'stages':self.summaries}, fh, indent=1,
+                  sort_keys=True)
+        fh.close()
+        os.rename(filename+'.tmp', filename)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.timeseries.close()
+
+
+def load_summary(output_dir):
+    '''
+    The per stage summaries of a run, empty if it was not monitored
+    '''
+    filename = os.path.join(output_dir, 'stage_resources.json')
+    if not os.path.exists(filename): return {}
+    return json.load(open(filename))['stages']
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    summaries = load_summary(args['output_dir'])
+    if not summaries:
+        print 'No stage_resources.json in', args['output_dir']
+        sys.exit(1)
+    print '%-20s %10s %10s %8s %10s %10s %10s'\
+        %('stage', 'time (s)', 'cpu (s)', 'cpu/t', 'rss (MB)', 'read (MB)', 'write (MB)')
+    for name, s in sorted(summaries.iteritems(), key=lambda x: -x[1]['elapsed']):
+        print '%-20s %10.1f %10.1f %8.2f %10.1f %10.1f %10.1f'\
+            %(name, s['elapsed'], s['cpu_time'], s['cpu_utilization'], s['peak_rss_mb'],
+              s['read_mb'], s['write_mb'])
@@ -0,0 +1,121 @@
+'''
+Store of stage outputs shared by Sunrise runs. Runs of a sweep that only
+differ in their mcrx or broadband options have identical sfrhist inputs,
+so their sfrhist.fits is computed once, kept in a stage directory named
+after the hash of those inputs and linked into each run.
+
+setupSunriseRun.py writes the stage directory of a run to
+input/sfrhist.stage. The sfrhist stage of sunriseDriver.py takes the lock
+of the stage directory, links sfrhist.fits from it if another run has
+made it, and otherwise runs sfrhist and moves its output there.
+'''
+import os
+import json
+import hashlib
+import shutil
+import fcntl
+
+
+store_version = 1
+
+
+def file_identity(filename):
+    '''
+    Identity of a (large) input file without reading it: its real path,
+    size and modification time
+    '''
+    filename = os.path.realpath(filename)
+    stat = os.stat(filename)
+    return [filename, stat.st_size, repr(stat.st_mtime)]
+
+
+def normalize_config(text, run_dir):
+    '''
+    The key value pairs of a Sunrise config, in order and without
+    comments, with the run directory replaced by $RUN_DIR
+    '''
+    pairs = []
+    for line in text.replace(run_dir, '$RUN_DIR').splitlines():
+        line = line.split('#')[0].split()
+        if line:
+            pairs.append([line[0], ' '.join(line[1:])])
+    return pairs
+
+
+def stage_inputs(stage, fits_file, config_file, run_dir, modifications, sunrise_dir):
+    '''
+    Description of everything the output of a stage depends on
+    '''
+    modifications = dict([(k, v) for k, v in modifications.iteritems() if v is not None])
+    return {'version':store_version, 'stage':stage,
+            'fits_file':file_identity(fits_file),
+            'config':normalize_config(open(config_file).read(), run_dir),
+            'modifications':sorted([(k, repr(v)) for k, v in modifications.iteritems()]),
+            'sunrise':os.path.realpath(sunrise_dir)}
+
+
+def stage_key(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+def stage_dir(store, inputs):
+    '''
+    Make the stage directory of inputs in the store and describe the
+    inputs in its key.json. Returns the directory.
+    '''
+    path = os.path.abspath(store)+'/%s-%s'%(inputs['stage'], stage_key(inputs))
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): raise
+    if not os.path.exists(path+'/key.json'):
+        fh = open(path+'/key.json.%i'%os.getpid(), 'w')
+        json.dump(inputs, fh, indent=1, sort_keys=True)
+        fh.close()
+        os.rename(path+'/key.json.%i'%os.getpid(), path+'/key.json')
+    return path
+
+
+class StageLock(object):
+    '''
+    Exclusive lock of a stage directory, the same flock(1) takes
+
+        with StageLock(path):
+            ...
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.fh = open(self.path+'/lock', 'w')
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.fh.close()
+
+
+def link_output(path, filename, output):
+    '''
+    Link the stage output filename into the run as output if the stage
+    has made it. Returns whether it did.
+    '''
+    stored = path+'/'+filename
+    if not os.path.exists(stored): return False
+    if os.path.lexists(output): os.remove(output)
+    os.symlink(stored, output)
+    return True
+
+
+def store_output(path, output, filename):
+    '''
+    Move a stage output made by a run into the stage directory and link it
+    back into the run
+    '''
+    stored = path+'/'+filename
+    shutil.move(output, stored+'.tmp')
+    os.rename(stored+'.tmp', stored)
+    os.symlink(stored, output)
@@ -0,0 +1,138 @@
+'''
+Merge old star particles of a Sunrise PARTICLEDATA table into
+super-particles, one per leaf cell, logarithmic age bin and logarithmic
+metallicity bin.
+
+Each super-particle keeps the mass, the metal mass, the momentum and the
+luminosity of the particles it replaces. The luminosity is approximated
+by the proxy mass*age**-lum_slope, and the age of a super-particle is the
+one whose proxy is the summed proxy of its particles.
+
+Used by genSunriseInput.py (see its --aggregate_age option)
+'''
+import numpy as np
+
+
+def leaf_cell_ids(ds, center, width, positions, max_level=None):
+    '''
+    Index of the exported leaf cell holding each of the given positions
+    (in [kpc]), found from the oct-tree index of the export region.
+    Positions outside the region get -1. Cells finer than max_level
+    count as the max_level cell they are in.
+    '''
+    region = ds.box(center.in_units('code_length')-width.in_units('code_length'),
+                    center.in_units('code_length')+width.in_units('code_length'))
+    levels = region['index', 'grid_level'].astype('int64')
+    if max_level is not None:
+        levels = np.minimum(levels, max_level)
+    cell_pos = np.array([region['index', ax].in_units('kpc').value for ax in 'xyz']).T
+    dle = ds.domain_left_edge.in_units('kpc').value
+    lo = (center-width).in_units('kpc').value
+    hi = (center+width).in_units('kpc').value
+    root_dx = (ds.domain_width/ds.domain_dimensions).in_units('kpc').value
+
+    positions = np.asarray(positions, dtype='float64')
+    ids = -np.ones(positions.shape[0], dtype='int64')
+    offset = 0
+    for level in np.unique(levels):
+        # The cells of a level are aligned to the domain left edge, index
+        # them from the first one of the region
+        dx = root_dx/2.0**level
+        i0 = np.floor((lo-dle)/dx).astype('int64')
+        nwide = np.floor((hi-dle)/dx).astype('int64')-i0+1
+        def keys(pos):
+            ijk = np.floor((pos-dle)/dx).astype('int64')-i0
+            inside = np.all((ijk >= 0) & (ijk < nwide), axis=1)
+            return (ijk[:,0]*nwide[1]+ijk[:,1])*nwide[2]+ijk[:,2], inside
+        cell_keys = np.unique(keys(cell_pos[levels == level])[0])
+        star_keys, inside = keys(positions)
+        idx = np.searchsorted(cell_keys, star_keys).clip(0, cell_keys.size-1)
+        found = inside & (cell_keys[idx] == star_keys) & (ids < 0)
+        ids[found] = offset+idx[found]
+        offset += cell_keys.size
+    return ids
+
+
+def luminosity_proxy(mass, age, lum_slope=0.8):
+    '''
+    Luminosity proxy mass*age**-lum_slope of star particles, ages in years
+    '''
+    return mass*np.maximum(age, 1.0)**-lum_slope
+
+
+def conserved_totals(pd, lum_slope=0.8):
+    '''
+    Total mass, metal mass and luminosity proxy of the particles of pd, and
+    their luminosity-weighted age
+    '''
+    lum = luminosity_proxy(pd['mass'], pd['age'], lum_slope)
+    return {'mass':pd['mass'].sum(),
+            'metal_mass':(pd['mass']*pd['metallicity']).sum(),
+            'luminosity':lum.sum(),
+            'lum_weighted_age':(lum*pd['age']).sum()/lum.sum() if lum.sum() > 0 else 0.0}
+
+
+def aggregate_stars(pd, cell_ids, min_age, nage_bins=8, nz_bins=4, lum_slope=0.8,
+                    rtol=1e-8):
+    '''
+    Merge the star particles in pd (a PARTICLEDATA record array) older than
+    min_age into one super-particle per leaf cell (cell_ids, -1 outside of
+    the export region), age bin and metallicity bin. Masses add up,
+    positions, velocities and metallicities are mass weighted and the age
+    keeps the summed luminosity proxy. Young stars and stars outside the
+    export region are kept as they are.
+
+    Returns the new particle array and a dictionary with the reduction, the
+    totals before and after aggregation, and whether the mass, metal mass
+    and luminosity proxy agree within rtol.
+    '''
+    before = conserved_totals(pd, lum_slope)
+    old = (pd['age'] > min_age) & (cell_ids >= 0)
+    if not old.any():
+        out, merged = pd, pd[:0]
+    else:
+        aged = pd[old]
+
+        # Group by cell, age bin and metallicity bin
+        log_age = np.log10(aged['age'])
+        age_edges = np.linspace(log_age.min(), log_age.max(), nage_bins+1)[1:-1]
+        log_z = np.log10(np.maximum(aged['metallicity'], 1e-10))
+        z_edges = np.linspace(log_z.min(), log_z.max(), nz_bins+1)[1:-1]
+        group = (cell_ids[old]*nage_bins + np.digitize(log_age, age_edges))*nz_bins + \
+            np.digitize(log_z, z_edges)
+        group, inverse = np.unique(group, return_inverse=True)
+
+        m = aged['mass']
+        msum = np.bincount(inverse, weights=m)
+        lsum = np.bincount(inverse, weights=luminosity_proxy(m, aged['age'], lum_slope))
+        first = np.unique(inverse, return_index=True)[1]
+        merged = aged[first].copy()
+        for name in pd.dtype.names:
+            col = aged[name]
+            if name in ['mass', 'creation_mass']:
+                merged[name] = np.bincount(inverse, weights=col)
+            elif name == 'age':
+                merged[name] = (lsum/msum)**(-1.0/lum_slope)
+            elif name == 'formation_time':
+                # formation_time+age is the time of the snapshot
+                now = np.bincount(inverse, weights=m*(col+aged['age']))/msum
+                merged[name] = now-(lsum/msum)**(-1.0/lum_slope)
+            elif col.dtype.kind == 'f':
+                if col.ndim == 1:
+                    merged[name] = np.bincount(inverse, weights=m*col)/msum
+                else:
+                    for j in range(col.shape[1]):
+                        merged[name][:,j] = np.bincount(inverse, weights=m*col[:,j])/msum
+        out = np.concatenate([pd[~old], merged])
+
+    after = conserved_totals(out, lum_slope)
+    stats = {'nstars_merged':int(old.sum()), 'nsuper':merged.size}
+    mismatched = []
+    for k in ['mass', 'metal_mass', 'luminosity', 'lum_weighted_age']:
+        stats[k] = (before[k], after[k])
+        if k != 'lum_weighted_age' and not np.isclose(after[k], before[k], rtol=rtol, atol=0):
+            mismatched.append(k)
+    stats['conserved'] = not mismatched
+    if mismatched:
+        print 'WARNING: star aggregation does not conserve the %s'%', '.join(mismatched)
+    return out, stats
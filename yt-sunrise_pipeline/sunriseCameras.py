@@ -0,0 +1,192 @@
+'''
+Build sets of Sunrise cameras as arrays, with one row per camera, and
+read/write them in the text format Sunrise reads. The text file is also
+saved as a binary .npy sidecar next to it, which is much faster to read
+back for sets of thousands of cameras.
+
+The columns of the camera rows, as in the .cameras files, are
+
+    0:3  distance*direction (towards the center)
+    3:6  distance*position  (from the center)
+    6:9  up vector
+    9    full angular field of view in radians
+
+Used by genSunriseInput.py and setupSunriseRun.py
+'''
+import os
+import numpy as np
+
+
+# Cameras fixed to the galaxy frame: (normal, north, rotate to galaxy frame)
+named_cameras = [
+    ['face',([0.,0.,1.],[0.,-1.,0],True)], #up is north=+y
+    ['edge',([0.,1.,0.],[0.,0.,-1.],True)],#up is along z
+    ['45',([0.,0.7071,0.7071],[0., 0., -1.],True)],
+    ['Z-axis',([0.,0.,1.],[0.,-1.,0],False)], #up is north=+y
+    ['Y-axis',([0.,1.,0.],[0.,0.,-1.],False)],#up is along z
+    ]
+
+
+def normalize(v):
+    '''
+    Normalize the rows of v
+    '''
+    v = np.asarray(v, dtype='float')
+    return v/np.sqrt(np.sum(v*v, axis=-1))[...,np.newaxis]
+
+
+def galaxy_rotation(normal_vector, north_vector=[0.,1.,0.]):
+    '''
+    Rotation from the camera frame of yt's Orientation to the simulation
+    frame, for a galaxy with angular momentum along normal_vector
+    '''
+    from yt.utilities.orientation import Orientation
+    orient = Orientation(normal_vector=normal_vector, north_vector=north_vector)
+    return np.linalg.inv(orient.inv_mat)
+
+
+def random_directions(n, seed=0):
+    '''
+    The directions of the random cameras generate_cameras has always used,
+    which are not isotropic. Kept so that Random_%03i cameras do not change.
+    '''
+    rs = np.random.RandomState(seed)
+    ts = rs.random_sample(n)*np.pi*2
+    ps = rs.random_sample(n)*np.pi-np.pi/2.0
+    return np.column_stack([np.cos(ts), np.zeros(n), np.sin(ps)])
+
+
+def fibonacci_directions(n):
+    '''
+    n nearly uniformly spaced directions on the unit sphere (Fibonacci
+    lattice), ordered from +z to -z
+    '''
+    i = np.arange(n)+0.5
+    z = 1.0-2.0*i/n
+    phi = np.pi*(1.0+np.sqrt(5.0))*i
+    r = np.sqrt(1.0-z*z)
+    return np.column_stack([r*np.cos(phi), r*np.sin(phi), z])
+
+
+def camera_rows(positions, up_vector, distance=100.0, fov=50.0):
+    '''
+    Cameras at distance along the unit vectors positions, looking at the
+    center, with up_vector as the up direction. Returns the (n, 10) array
+    of camera rows.
+    '''
+    positions = np.atleast_2d(np.asarray(positions, dtype='float'))
+    n = positions.shape[0]
+    ups = np.tile(np.asarray(up_vector, dtype='float'), (n, 1))
+
+    # Nudge up vectors parallel to the line of sight
+    parallel = np.all(np.abs(ups-positions) < 1e-3, axis=1)
+    ups[parallel,0] *= 0.5
+    parallel = np.all(np.abs(normalize(ups)-normalize(positions)) < 1e-3, axis=1)
+    ups[parallel,0] *= 0.5
+    ups[parallel] = normalize(ups[parallel])
+
+    rows = np.empty((n, 10))
+    rows[:,0:3] = -1.0*distance*positions
+    rows[:,3:6] = distance*positions
+    rows[:,6:9] = ups
+    rows[:,9] = 2.0*np.arctan((fov/2.0)/distance)
+    return rows
+
+
+def generate_cameras(normal_vector, distance=100.0, fov=50.0,
+                     n_random=10, n_isotropic=0):
+    '''
+    The named cameras, n_random Random_%03i cameras and n_isotropic
+    Iso_%05i cameras for a galaxy with angular momentum along
+    normal_vector, which is also the up vector of every camera. The
+    isotropic cameras are spread on a Fibonacci sphere whose pole is
+    face on. Returns the list of names and the (n, 10) camera rows.
+    '''
+    R = galaxy_rotation(normal_vector)
+
+    names = [name for name, cam in named_cameras]
+    normals = normalize([cam[0] for name, cam in named_cameras])
+    rotate = np.array([cam[2] for name, cam in named_cameras])
+    positions = normals.copy()
+    positions[rotate] = np.dot(normals[rotate], R)
+
+    positions = [positions]
+    if n_random:
+        names += ['Random_%03i'%i for i in range(n_random)]
+        positions.append(normalize(random_directions(n_random)))
+    if n_isotropic:
+        names += ['Iso_%05i'%i for i in range(n_isotropic)]
+        positions.append(np.dot(fibonacci_directions(n_isotropic), R))
+    positions = np.concatenate(positions)
+
+    return names, camera_rows(positions, normal_vector, distance=distance, fov=fov)
+
+
+def random_cameras(n, distance, afov, seed):
+    '''
+    n cameras at random positions at distance from the center, with random
+    up vectors, as added by setupSunriseRun --random_cameras. The random
+    stream is the same as that of the original one camera at a time loop.
+    '''
+    rs = np.random.RandomState(int(seed))
+    r = rs.random_sample((n, 5))
+    theta, phi = r[:,0]*1.0*np.pi, r[:,1]*2.0*np.pi
+    pos = np.column_stack([distance*np.sin(theta)*np.cos(phi),
+                           distance*np.sin(theta)*np.sin(phi),
+                           distance*np.cos(theta)])
+    rows = np.empty((n, 10))
+    rows[:,0:3] = pos
+    rows[:,3:6] = -1.0*pos
+    rows[:,6:9] = r[:,2:5]
+    rows[:,9] = afov
+    return rows
+
+
+def write_cameras(camera_file, rows):
+    '''
+    Write the camera rows as text for Sunrise and as a binary sidecar
+    '''
+    rows = np.atleast_2d(rows)
+    np.savetxt(camera_file, rows)
+    np.save(camera_file+'.npy', rows)
+
+
+def write_camnames(camnames_file, names):
+    '''
+    Write the camera names, one per line
+    '''
+    fh = open(camnames_file, 'w')
+    fh.write('\n'.join(names))
+    fh.close()
+
+
+def read_cameras(camera_file):
+    '''
+    Read the camera rows, from the binary sidecar if it is up to date
+    '''
+    sidecar = camera_file+'.npy'
+    if os.path.exists(sidecar) and \
+            os.path.getmtime(sidecar) >= os.path.getmtime(camera_file):
+        return np.load(sidecar)
+    return np.atleast_2d(np.loadtxt(camera_file))
+
+
+def rows_to_dict(names, rows, fov, distance):
+    '''
+    The cameras as the ordered dictionary genSunriseInput passes around,
+    name: (position, direction, up, afov, fov, distance)
+    '''
+    from collections import OrderedDict
+    cameras = OrderedDict()
+    for name, row in zip(names, rows):
+        cameras[name] = (row[3:6], row[0:3], row[6:9], row[9], fov, distance)
+    return cameras
+
+
+def dict_to_rows(cameras):
+    '''
+    Inverse of rows_to_dict
+    '''
+    rows = [np.concatenate([row[1], row[0], row[2], [row[3]]])
+            for row in cameras.itervalues()]
+    return cameras.keys(), np.array(rows)
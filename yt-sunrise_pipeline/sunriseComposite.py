@@ -0,0 +1,309 @@
+'''
+Composite images of a Sunrise run, made in one process instead of a chain
+of ImageMagick convert calls. The panels are loaded once, trimmed, resized
+and tiled as arrays, annotated with matplotlib and each composite is
+encoded once.
+
+    composite     output/images/composite.png: the RGB images and the
+                  candelized V, z, J and H images of cameras 0 and 1,
+                  with the name, redshift and magnitudes of the run
+    theory        output/compositeb.png: the gas, dark matter and gas
+                  phase plots, read from the members of sync/*plots.tar.gz
+                  without extracting them
+
+Usage:
+
+    python sunriseComposite.py composite run_dir/output --fullname $FULLNAME
+    python sunriseComposite.py theory run_dir/output --fullname $FULLNAME
+'''
+import os, sys, argparse
+import json
+import tarfile
+import fnmatch
+import StringIO
+from glob import glob
+import numpy as np
+
+
+# Rows of the composite, file names of the panels and the size each row
+# is fit into (None keeps it)
+composite_rows = [(['CAMERA0-BROADBAND_blur.png', 'CAMERA1-BROADBAND_blur.png'], (400, 800)),
+                  (['rowa2.png'], None),
+                  (['cam0_v.png', 'cam0_z.png', 'cam1_v.png', 'cam1_z.png'], None),
+                  (['cam0_j.png', 'cam0_h.png', 'cam1_j.png', 'cam1_h.png'], None),
+                  (['rowd.png'], None)]
+
+composite_filters = [('NUV', 'nuv'), ('U', 'bessel_u'), ('V', 'bessel_v'),
+                     ('J', 'wfcam_j'), ('z', 'wfcam_z')]
+
+# Rows of the theory composite, patterns of the tarball members, trimmed
+theory_rows = [(['*gas_cam00*png', '*gas_cam01*png'], (300, 800)),
+               (['*dm_cam00*png', '*dm_cam01*png'], (300, 800)),
+               (['*dm_2*png', '*phase_temp_gas*png'], (300, 800))]
+
+# Labels of the theory composite, at (x, y) pixels from the top left
+theory_labels = [((30, 9), 'gas'), ((330, 9), 'gas'),
+                 ((30, 290), 'dark matter'), ((330, 290), 'dark matter'),
+                 ((30, 570), 'dark matter 2mpc comoving'), ((340, 570), 'gas phase')]
+
+fontsize = 12
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Make the composite images of a Sunrise run.
+                                 ''')
+
+    parser.add_argument('command', choices=['composite', 'theory'],
+                        help="'composite' makes images/composite.png, 'theory' makes "\
+                            "compositeb.png.")
+
+    parser.add_argument('output_dir', nargs='?', default='.',
+                        help='Output dir of the Sunrise run.')
+
+    parser.add_argument('--fullname', default=os.environ.get('FULLNAME', ''),
+                        help='Full name of the run, e.g. <sim>_a0.500_... Defaults to '\
+                            '$FULLNAME.')
+
+    parser.add_argument('--tarball', default=None,
+                        help='Tarball of the theory plots. Defaults to '\
+                            '../sync/*plots.tar.gz of the output dir.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def redshift(fullname):
+    '''
+    Redshift of a run from the scale factor in its full name
+    '''
+    scale = fullname.split('_')[1].strip().strip('a')
+    return 1.0/float(scale)-1
+
+
+def load_png(source):
+    '''
+    RGB float image of a PNG file or file object
+    '''
+    import matplotlib.image as mpimg
+    image = mpimg.imread(source, format='png')
+    if image.dtype != np.float32 and image.dtype != np.float64:
+        image = image/255.0
+    if image.ndim == 2:
+        image = np.dstack([image]*3)
+    elif image.shape[2] == 4:
+        alpha = image[:, :, 3:]
+        image = image[:, :, :3]*alpha+(1.0-alpha)
+    return image[:, :, :3]
+
+
+def trim(image, fuzz=1e-3):
+    '''
+    Remove the borders of the color of the top left pixel, as convert -trim
+    '''
+    differs = np.any(np.abs(image-image[0, 0]) > fuzz, axis=2)
+    rows, cols = np.where(differs.any(axis=1))[0], np.where(differs.any(axis=0))[0]
+    if not len(rows): return image
+    return image[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+
+
+def resize(image, size):
+    '''
+    Resize an image to fit in size (width, height) keeping its aspect
+    ratio, as convert -resize WxH, with bilinear interpolation
+    '''
+    height, width = image.shape[:2]
+    scale = min(float(size[0])/width, float(size[1])/height)
+    new_width, new_height = max(int(round(width*scale)), 1), max(int(round(height*scale)), 1)
+    if (new_width, new_height) == (width, height): return image
+    y = np.clip((np.arange(new_height)+0.5)/scale-0.5, 0, height-1)
+    x = np.clip((np.arange(new_width)+0.5)/scale-0.5, 0, width-1)
+    y0, x0 = np.floor(y).astype(int), np.floor(x).astype(int)
+    y1, x1 = np.minimum(y0+1, height-1), np.minimum(x0+1, width-1)
+    wy, wx = (y-y0)[:, None, None], (x-x0)[None, :, None]
+    top = image[y0][:, x0]*(1-wx)+image[y0][:, x1]*wx
+    bottom = image[y1][:, x0]*(1-wx)+image[y1][:, x1]*wx
+    return top*(1-wy)+bottom*wy
+
+
+def append(images, horizontal=True, background=1.0):
+    '''
+    Tile images side by side (+append, top aligned) or one below the other
+    (-append, left aligned), filling the rest with the background
+    '''
+    images = [i for i in images if i is not None]
+    if not images: return None
+    if horizontal:
+        shape = (max([i.shape[0] for i in images]), sum([i.shape[1] for i in images]), 3)
+    else:
+        shape = (sum([i.shape[0] for i in images]), max([i.shape[1] for i in images]), 3)
+    tiled = np.empty(shape)
+    tiled[:] = background
+    offset = 0
+    for i in images:
+        if horizontal:
+            tiled[:i.shape[0], offset:offset+i.shape[1]] = i
+            offset += i.shape[1]
+        else:
+            tiled[offset:offset+i.shape[0], :i.shape[1]] = i
+            offset += i.shape[0]
+    return tiled
+
+
+def make_row(panels, size=None, trimmed=False):
+    row = append([trim(p) if trimmed and p is not None else p for p in panels])
+    if row is not None and size is not None:
+        row = resize(row, size)
+    return row
+
+
+def save_annotated(image, filename, texts):
+    '''
+    Draw the texts, (x, y, text, options) with x and y in pixels from the
+    top left, on the image and write it as a PNG
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.patheffects as patheffects
+
+    dpi = 100.0
+    height, width = image.shape[:2]
+    fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.figimage(np.clip(image, 0.0, 1.0), origin='upper')
+    for x, y, text, options in texts:
+        options = dict(options)
+        if options.pop('stroke', False):
+            options['path_effects'] = [patheffects.withStroke(linewidth=2,
+                                                              foreground=(0, 0, 0, 0.8))]
+        size = options.pop('fontsize', fontsize)
+        # One line at a time, as blank lines break the path effects
+        for k, line in enumerate(text.split('\n')):
+            if not line: continue
+            top = y+k*size*1.2*dpi/72.0
+            fig.text(float(x)/width, 1.0-top/height, line, transform=fig.transFigure,
+                     fontsize=size, va='top', **options)
+    fig.savefig(filename, dpi=dpi)
+
+
+def find_panel(name, dirs):
+    for d in dirs:
+        if os.path.exists(os.path.join(d, name)):
+            return os.path.join(d, name)
+    return None
+
+
+def run_magnitudes(output_dir):
+    '''
+    Magnitudes of composite_filters in cameras 0 and 1 of broadband.fits,
+    from magnitudes.json if it has them
+    '''
+    import sunrisePostprocess
+    filters = [f for name, f in composite_filters]
+    json_file = os.path.join(output_dir, 'magnitudes.json')
+    if os.path.exists(json_file):
+        entry = json.load(open(json_file)).get('broadband.fits')
+        if entry and entry['filters'] == filters and entry['cameras'] == [0, 1]:
+            return entry['mags']
+    broadband_file = os.path.join(output_dir, 'broadband.fits')
+    if not os.path.exists(broadband_file): return None
+    return sunrisePostprocess.magnitudes(broadband_file, filters, [0, 1])[0]
+
+
+def composite(output_dir, fullname):
+    '''
+    Make images/composite.png. Returns its file name, None if there are no
+    panels.
+    '''
+    images_dir = os.path.join(output_dir, 'images')
+    dirs = [images_dir, output_dir]
+    rows = []
+    for names, size in composite_rows:
+        panels = []
+        for name in names:
+            filename = find_panel(name, dirs)
+            if filename is None:
+                print 'WARNING: no panel', name
+            else:
+                panels.append(load_png(filename))
+        rows.append(make_row(panels, size))
+    image = append(rows, horizontal=False)
+    if image is None: return None
+
+    lines = ['%s'%fullname, 'z=%1.1f'%redshift(fullname)] if fullname else ['', '']
+    right = ['', '']
+    mags = run_magnitudes(output_dir)
+    mag = lambda i, j: '%.2f'%mags[i][j] if mags is not None and mags[i][j] is not None \
+        and np.isfinite(mags[i][j]) else ''
+    for j, (name, f) in enumerate(composite_filters):
+        lines.append('%s=%s'%(name, mag(0, j)))
+        right.append('%s=%s'%(name, mag(1, j)))
+    texts = [(0, 0, '\n'.join(lines), {'color':'white', 'stroke':True}),
+             (image.shape[1], 0, '\n'.join(right), {'color':'white', 'stroke':True,
+                                                     'ha':'right'})]
+    if not os.path.isdir(images_dir): os.makedirs(images_dir)
+    filename = os.path.join(images_dir, 'composite.png')
+    save_annotated(image, filename, texts)
+    return filename
+
+
+def tarball_panels(tarball, patterns):
+    '''
+    The first PNG member of the tarball matching each pattern, read from
+    the member stream
+    '''
+    found = {}
+    tar = tarfile.open(tarball, 'r|gz')
+    for member in tar:
+        name = os.path.basename(member.name)
+        for pattern in patterns:
+            if pattern not in found and member.isfile() and fnmatch.fnmatch(name, pattern):
+                found[pattern] = load_png(StringIO.StringIO(tar.extractfile(member).read()))
+                break
+        if len(found) == len(patterns): break
+    tar.close()
+    return found
+
+
+def theory(output_dir, fullname, tarball=None):
+    '''
+    Make compositeb.png from the theory plots. Returns its file name, None
+    if there is no tarball.
+    '''
+    if tarball is None:
+        tarballs = glob(os.path.join(output_dir, '..', 'sync', '*plots.tar.gz'))
+        if not tarballs:
+            print 'WARNING: no plots tarball in', os.path.join(output_dir, '..', 'sync')
+            return None
+        tarball = tarballs[0]
+    patterns = [p for names, size in theory_rows for p in names]
+    panels = tarball_panels(tarball, patterns)
+    for p in patterns:
+        if p not in panels: print 'WARNING: no panel', p, 'in', tarball
+    rows = [make_row([panels.get(p) for p in names], size, trimmed=True)
+            for names, size in theory_rows]
+    image = append(rows, horizontal=False)
+    if image is None: return None
+
+    title = '%s  z=%1.1f'%(fullname, redshift(fullname)) if fullname else ''
+    texts = [(0, 0, title, {})]+[(x, y, text, {}) for (x, y), text in theory_labels]
+    filename = os.path.join(output_dir, 'compositeb.png')
+    save_annotated(image, filename, texts)
+    return filename
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    if args['command'] == 'composite':
+        filename = composite(args['output_dir'], args['fullname'])
+    else:
+        filename = theory(args['output_dir'], args['fullname'], args['tarball'])
+    if filename is None:
+        sys.exit(1)
+    print 'Wrote', filename
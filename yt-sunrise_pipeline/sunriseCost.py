@@ -0,0 +1,298 @@
+'''
+Cost model of Sunrise runs. Predicts the time of the sfrhist, mcrx and
+broadband stages and the peak memory of mcrx from the size of the export
+(export_nleafs, export_nstars), the number of cameras and the number of
+rays, with log-linear models fitted to completed runs.
+
+The stage times of completed runs are read from the stage_timings.json
+of sunriseDriver.py and the memory of mcrx from the stage_resources.json
+of stageMonitor.py. Older runs are measured from the files runSunrise.sh
+left behind: the free samples that log-mcrx-mem got every 5 seconds
+during mcrx (which also give its peak memory) and the modification times
+of the stage outputs.
+
+Usage:
+
+    python sunriseCost.py fit cost_model.npy sim_dir/sunrise_runs/*
+    python sunriseCost.py predict cost_model.npy run_dir
+
+setupSunriseRun.py --cost_model cost_model.npy writes the prediction of
+each run to input/cost_prediction.npy and sets the wall clock requests
+of its scripts from it.
+'''
+import os, sys, argparse
+import math
+import json
+from glob import glob
+import numpy as np
+
+import sunriseCameras
+import stageMonitor
+
+
+# Features of the log-linear model of each stage
+stage_features = {
+    'sfrhist_time':['nleafs', 'nstars'],
+    'mcrx_time':['nleafs', 'nstars', 'ncameras', 'nrays'],
+    'mcrx_mem':['nleafs', 'nstars', 'ncameras'],
+    'broadband_time':['nleafs', 'ncameras'],
+    }
+
+# Features the time is proportional to, used when too few runs are
+# available to fit all the exponents
+stage_scaling = {
+    'sfrhist_time':['nstars'],
+    'mcrx_time':['nrays', 'ncameras'],
+    'mcrx_mem':['nleafs'],
+    'broadband_time':['ncameras'],
+    }
+
+time_stages = ['sfrhist_time', 'mcrx_time', 'broadband_time']
+memsample_interval = 5.0
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Fit the cost model of Sunrise runs to completed runs,
+                                 or predict the cost of a run with it.
+                                 ''')
+
+    parser.add_argument('command', choices=['fit', 'predict'],
+                        help="'fit' the model to the run_dirs, or 'predict' their cost.")
+
+    parser.add_argument('model', help='Cost model file, e.g. cost_model.npy')
+
+    parser.add_argument('run_dirs', nargs='+', help='Sunrise run directories.')
+
+    parser.add_argument('--margin', default=1.5, type=float,
+                        help='Factor applied to the predicted time for the wall clock requests.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def read_config(text):
+    '''
+    The key value lines of a Sunrise config as a dictionary
+    '''
+    config = {}
+    for line in text.splitlines():
+        line = line.split('#')[0].split()
+        if len(line) >= 2:
+            config[line[0]] = ' '.join(line[1:])
+    return config
+
+
+def nrays(mcrx_config):
+    '''
+    Total number of rays shot by mcrx
+    '''
+    n = 0.0
+    for k, v in mcrx_config.iteritems():
+        if k.startswith('nrays'):
+            try:
+                n += float(v)
+            except ValueError:
+                pass
+    return n
+
+
+def run_features(info, ncameras, mcrx_config):
+    '''
+    Features of the cost model from the export info, the number of cameras
+    and the mcrx config dictionary
+    '''
+    return {'nleafs':float(info['export_nleafs']),
+            'nstars':float(info['export_nstars']),
+            'ncameras':float(ncameras),
+            'nrays':nrays(mcrx_config)}
+
+
+def features_from_run(run_dir):
+    '''
+    Features of the cost model of a set up run
+    '''
+    info = np.load(run_dir+'/input/export_info.npy')[()]
+    ncameras = len(sunriseCameras.read_cameras(run_dir+'/input/cameras'))
+    mcrx_config = read_config(open(run_dir+'/input/mcrx.config').read())
+    return run_features(info, ncameras, mcrx_config)
+
+
+def read_memlog(filename):
+    '''
+    Number of free samples in a log-mcrx-mem file and the largest increase
+    of used memory (MB) over the first sample
+    '''
+    used = []
+    for line in open(filename):
+        fields = line.split()
+        if line.startswith('-/+ buffers/cache:'):
+            used[-1] = float(fields[2])
+        elif line.startswith('Mem:'):
+            used.append(float(fields[2]))
+    if not used: return 0, None
+    return len(used), max(used)-used[0]
+
+
+def stage_measurements(run_dir):
+    '''
+    Time (s) of the stages of a completed run and peak memory (MB) of mcrx,
+    None where they cannot be measured
+    '''
+    out = run_dir+'/output/'
+    measured = dict([(stage, None) for stage in stage_features])
+
+    def mtime(filename):
+        return os.path.getmtime(filename) if os.path.exists(filename) else None
+
+    started = mtime(run_dir+'/input/sfrhist.config-used')
+    sfrhist_done = mtime(out+'sfrhist.fits')
+    if started and sfrhist_done and sfrhist_done > started:
+        measured['sfrhist_time'] = sfrhist_done-started
+
+    if os.path.exists(out+'log-mcrx-mem') and mtime(out+'mcrx.fits'):
+        nsamples, mem = read_memlog(out+'log-mcrx-mem')
+        if nsamples > 1:
+            measured['mcrx_time'] = nsamples*memsample_interval
+        if mem:
+            measured['mcrx_mem'] = mem
+
+    mcrx_done = mtime(out+'log-mcrx')
+    broadbands = [mtime(f) for f in glob(out+'broadband*.fits')]
+    if mcrx_done and broadbands and max(broadbands) > mcrx_done:
+        measured['broadband_time'] = max(broadbands)-mcrx_done
+
+    # The stage timings of sunriseDriver.py, where available
+    if os.path.exists(out+'stage_timings.json'):
+        timings = json.load(open(out+'stage_timings.json'))
+        if 'sfrhist' in timings:
+            sfrhist = timings['sfrhist']
+            reran = sfrhist.get('status') == 'done' and not sfrhist.get('reused')
+            measured['sfrhist_time'] = sfrhist['elapsed'] if reran else None
+        if timings.get('mcrx', {}).get('status') == 'done':
+            measured['mcrx_time'] = timings['mcrx']['elapsed']
+        broadbands = [t for name, t in timings.iteritems()
+                      if name.startswith('broadband') and t.get('status') == 'done']
+        if broadbands:
+            measured['broadband_time'] = max([t['end'] for t in broadbands])-\
+                min([t['start'] for t in broadbands])
+
+    # The memory of mcrx sampled by stageMonitor.py: that of its processes,
+    # or that used on the node when mcrx runs elsewhere through a launcher
+    mcrx = stageMonitor.load_summary(out).get('mcrx')
+    if mcrx:
+        mem = max(mcrx['peak_rss_mb'], mcrx['node_used_delta_mb'] or 0.0)
+        if mem > 0:
+            measured['mcrx_mem'] = mem
+    return measured
+
+
+def design_matrix(features, names):
+    return np.array([[1.0]+[math.log(max(f[n], 1.0)) for n in names]
+                     for f in features])
+
+
+def fit_stage(stage, features, values):
+    '''
+    Fit log(value) = c0 + sum(c_i log(feature_i)). With fewer runs than
+    needed for that, only c0 is fitted with value proportional to the
+    stage_scaling features.
+    '''
+    names = stage_features[stage]
+    y = np.log(values)
+    if len(values) >= len(names)+2:
+        X = design_matrix(features, names)
+        coef = np.linalg.lstsq(X, y, rcond=None)[0]
+    else:
+        exponents = np.array([1.0 if n in stage_scaling[stage] else 0.0 for n in names])
+        X = design_matrix(features, names)
+        coef = np.concatenate([[np.mean(y-np.dot(X[:,1:], exponents))], exponents])
+    residuals = y-np.dot(design_matrix(features, names), coef)
+    scatter = np.sqrt(np.mean(residuals**2)) if len(values) > 1 else 0.0
+    return {'features':names, 'coef':coef, 'scatter':scatter, 'nruns':len(values)}
+
+
+def fit(run_dirs):
+    '''
+    Fit the model of each stage to the completed runs in run_dirs
+    '''
+    samples = []
+    for run_dir in run_dirs:
+        try:
+            samples.append((features_from_run(run_dir), stage_measurements(run_dir)))
+        except (IOError, OSError, KeyError), e:
+            print 'WARNING: skipping %s: %s'%(run_dir, e)
+
+    model = {}
+    for stage in stage_features:
+        data = [(f, m[stage]) for f, m in samples if m[stage]]
+        if not data:
+            print 'WARNING: no completed runs to fit %s'%stage
+            continue
+        model[stage] = fit_stage(stage, [f for f, v in data], [v for f, v in data])
+        print '%s: fit to %i runs, scatter %.2f dex'\
+            %(stage, len(data), model[stage]['scatter']/math.log(10))
+    return model
+
+
+def load_model(model_file):
+    return np.load(model_file)[()]
+
+
+def predict(model, features):
+    '''
+    Predicted stage times (s) and mcrx memory (MB), with their upper
+    estimates one scatter above, and the total time
+    '''
+    prediction = {'features':features}
+    total, total_upper = 0.0, 0.0
+    for stage, m in model.iteritems():
+        X = design_matrix([features], m['features'])[0]
+        value = math.exp(np.dot(X, m['coef']))
+        prediction[stage] = value
+        prediction[stage+'_upper'] = value*math.exp(m['scatter'])
+        if stage in time_stages:
+            total += value
+            total_upper += prediction[stage+'_upper']
+    if all([stage in model for stage in time_stages]):
+        prediction['total_time'] = total
+        prediction['total_time_upper'] = total_upper
+    return prediction
+
+
+def resources(prediction, margin=1.5, min_hours=1, max_hours=None):
+    '''
+    The wall clock values of the run scripts for a prediction, in the
+    relation of the defaults of setupSunriseRun (NHOURS 24, PBS_NHOURS 23,
+    WCL just short of 24 hours). Empty if the total time is not predicted.
+    '''
+    if 'total_time_upper' not in prediction: return {}
+    nhours = max(int(math.ceil(margin*prediction['total_time_upper']/3600.0))+1, min_hours+1)
+    if max_hours is not None:
+        nhours = min(nhours, max_hours)
+    return {'NHOURS':str(nhours), 'PBS_NHOURS':str(nhours-1),
+            'WCL':str(nhours*3600-100)}
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    if args['command'] == 'fit':
+        model = fit(args['run_dirs'])
+        np.save(args['model'], model)
+        print 'Saved cost model to', args['model']
+    else:
+        model = load_model(args['model'])
+        for run_dir in args['run_dirs']:
+            prediction = predict(model, features_from_run(run_dir))
+            print run_dir
+            for k in sorted(prediction.keys()):
+                if k == 'features': continue
+                print '    %-20s %12.1f'%(k, prediction[k])
+            for k, v in sorted(resources(prediction, args['margin']).iteritems()):
+                print '    %-20s %12s'%(k, v)
@@ -0,0 +1,479 @@
+'''
+Run the stages of a Sunrise run directory, as set up by setupSunriseRun.py:
+
+    sfrhist -> mcrx -> aux
+                    -> calzetti-<E(B-V)> -> broadband(z)-<E(B-V)>
+                    -> broadband, broadbandz -> headers, rgb, sed
+                                             -> mags -> composite
+                                             -> blackbox -> candelized -> composite
+    theory composite
+
+Stages whose dependencies are done are started as subprocesses, up to
+--jobs at a time, and the driver waits on the processes themselves. The
+output of each stage goes to output/log-<stage>, a failed stage skips the
+stages that depend on it, and the time of each stage is written to
+output/stage_timings.json and to the manifest (see sunriseManifest.py).
+The resources used by each stage are sampled by stageMonitor.py.
+runSunrise.sh sets up the environment and calls
+
+    python sunriseDriver.py run $RUN_DIR
+
+The Sunrise stages themselves run in 'task' subprocesses of this script.
+'''
+import os, sys, argparse
+import re
+import json
+import time
+import errno
+import shlex
+import shutil
+import subprocess
+import multiprocessing
+from glob import glob
+from collections import OrderedDict
+import numpy as np
+
+import fitsLayers
+import stageStore
+from stageMonitor import StageMonitor
+
+
+calzetti_ebv = ['%.2f'%(0.07*i) for i in range(6)]
+broadband_ebv = calzetti_ebv[1:]
+
+
+def default_launcher():
+    '''
+    aprun in a PBS job, nothing on a local node (see sunriseExecutor.py)
+    '''
+    if 'PBS_JOBID' in os.environ:
+        return 'aprun -n 1 -d 24'
+    return ''
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Run the stages of a Sunrise run directory.
+                                 ''')
+
+    parser.add_argument('command', choices=['run', 'list', 'task'],
+                        help="'run' the stages, 'list' them, or run a single Sunrise 'task' "\
+                            "(used by run).")
+
+    parser.add_argument('run_dir', nargs='?', default='.', help='Sunrise run directory.')
+
+    parser.add_argument('--jobs', default=None, type=int,
+                        help='Number of stages run at the same time. Defaults to the '\
+                            'number of CPUs.')
+
+    parser.add_argument('--launcher', default=default_launcher(),
+                        help='Command sfrhist and mcrx are launched with. Defaults to aprun '\
+                            'in a PBS job and to none on a local node.')
+
+    parser.add_argument('--monitor_interval', default=5.0, type=float,
+                        help='Seconds between the samples of the resources used by the '\
+                            'stages, 0 to not monitor them.')
+
+    parser.add_argument('--calzetti_onepass', action='store_true', default=False,
+                        help='Attenuate mcrx.fits for all E(B-V) in one pass with '\
+                            'mcrxCalzetti.py instead of running the mcrx_calzetti.py of '\
+                            'impression for each. Check first that their outputs agree '\
+                            '(mcrxCalzetti.py --check).')
+
+    parser.add_argument('--task', default=None, choices=['sfrhist', 'mcrx'],
+                        help='Task to run with the task command.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+# Shell stages, run with bash in the output dir with the environment set by runSunrise.sh
+rgb_script = '''
+python $IMPRESSION/plot/plot_rgb.py $OUTPUT_DIR/broadband.fits
+tar -zcvf rgb.tar.gz CAMERA*png
+'''
+
+sed_script = '''
+python $IMPRESSION/plot/plot_broadbands.py sed $OUTPUT_DIR/broadband.fits
+#mv sed*png sed.png
+'''
+
+blackbox_script = '''
+module load idl
+cd $BLACKBOX
+ls $OUTPUT_DIR/broadbandz*fits | sort > sim_filenames.cat
+timeout3 -t 1800 -d 10 -i 10 idl $BLACKBOX/sim_call.pro -queue
+cd $OUTPUT_DIR
+tar -zcvf images.tar.gz images/
+'''
+
+def env_flag(name):
+    return os.environ.get(name, 'True') == 'True'
+
+
+def stage(name, command, deps=[], log=None, mode='w', shell=False, required=True):
+    '''
+    A stage running command (a bash script if shell) in the output dir
+    once the deps are done. The run fails if a required stage fails.
+    '''
+    return {'name':name, 'command':command, 'deps':list(deps),
+            'log':log or 'log-'+name, 'mode':mode, 'shell':shell, 'required':required}
+
+
+def build_stages(run_dir, launcher, skip_calzetti=True, skip_idl=True, calzetti_onepass=False):
+    '''
+    The stages of a run, in the order they are preferably started
+    '''
+    script = os.path.abspath(__file__).replace('.pyc', '.py')
+    def task(name):
+        return [sys.executable, script, 'task', run_dir, '--task', name, '--launcher', launcher]
+    sunrise = os.environ.get('SUNRISE_DIR', run_dir+'/sunrise')+'/src/'
+    impression = os.environ.get('IMPRESSION', '')
+    pipeline = os.path.dirname(script)+'/'
+    inp = run_dir+'/input/'
+
+    stages = [stage('theory', [sys.executable, pipeline+'sunriseComposite.py', 'theory', '.'],
+                    required=False),
+              stage('sfrhist', task('sfrhist')),
+              stage('mcrx', task('mcrx'), ['sfrhist'], mode='a'),
+              stage('aux', [sys.executable, pipeline+'mcrxAux.py', 'mcrx.fits', 'aux.fits'],
+                    ['mcrx'])]
+    broadbands = []
+    for config in ['broadband', 'broadbandz']:
+        stages.append(stage(config, [sunrise+'broadband', inp+config+'.config'], ['mcrx']))
+        broadbands.append(config)
+    if not skip_calzetti:
+        if calzetti_onepass:
+            # All the attenuated mcrx files in one pass, see mcrxCalzetti.py
+            stages.append(stage('calzetti', [sys.executable, pipeline+'mcrxCalzetti.py',
+                                             'mcrx.fits']+calzetti_ebv, ['mcrx']))
+        else:
+            for bv in calzetti_ebv:
+                stages.append(stage('calzetti-'+bv,
+                                    [sys.executable, impression+'/export/input/mcrx_calzetti.py',
+                                     'mcrx.fits', bv, 'mcrx-%s.fits'%bv], ['mcrx']))
+        for bv in broadband_ebv:
+            for config in ['broadband', 'broadbandz']:
+                name = '%s-%s'%(config, bv)
+                stages.append(stage(name, [sunrise+'broadband', inp+name+'.config'],
+                                    ['calzetti' if calzetti_onepass else 'calzetti-'+bv]))
+                broadbands.append(name)
+    stages.append(stage('headers', [sys.executable, pipeline+'fitsHeaders.py', '--output',
+                                    'data-fits_headers', '--index', 'data-fits_headers.json'],
+                        broadbands+['aux'], required=False))
+    stages.append(stage('rgb', rgb_script, ['broadband'], shell=True, required=False))
+    stages.append(stage('sed', sed_script, ['broadband'], shell=True, required=False))
+    images = ['broadbandz']
+    if not skip_idl:
+        stages.append(stage('blackbox', blackbox_script, broadbands, shell=True, required=False))
+        images = ['blackbox']
+    stages.append(stage('candelized', [sys.executable, pipeline+'sunrisePostprocess.py',
+                                       'images', 'images'], images, required=False))
+    stages.append(stage('mags', [sys.executable, pipeline+'sunrisePostprocess.py', 'mags',
+                                 'broadband.fits', 'broadbandz.fits', '--output',
+                                 'magnitudes.json'], ['broadband', 'broadbandz'], required=False))
+    stages.append(stage('composite', [sys.executable, pipeline+'sunriseComposite.py',
+                                      'composite', '.'], ['rgb', 'mags', 'candelized'],
+                        required=False))
+    return stages
+
+
+def prepare(run_dir, skip_calzetti=True):
+    '''
+    Keep the configs used, clean the output dir and write the configs of
+    the broadbands of the attenuated mcrx files
+    '''
+    inp, out = run_dir+'/input/', run_dir+'/output/'
+    for config in glob(inp+'*.config')+glob(inp+'*.stub'):
+        shutil.copy(config, config+'-used')
+    for tmp in glob(out+'*tmp*'):
+        if os.path.isfile(tmp): os.remove(tmp)
+    if skip_calzetti: return
+    for bv in broadband_ebv:
+        for config in ['broadband', 'broadbandz']:
+            text = open(inp+config+'.config').read()
+            text = re.sub('mcrx.fits', 'mcrx-%s.fits'%bv, text)
+            text = re.sub(config+'.fits', '%s-%s.fits'%(config, bv), text)
+            fh = open(inp+'%s-%s.config'%(config, bv), 'w')
+            fh.write(text)
+            fh.close()
+
+
+class Recorder(object):
+    '''
+    Records the progress of the run in the manifest, if it has one
+    '''
+
+    def __init__(self, run_dir):
+        self.run_dir = os.path.abspath(run_dir)
+        self.manifest = None
+        if os.path.exists(run_dir+'/input/manifest'):
+            self.manifest = open(run_dir+'/input/manifest').read().strip()
+
+    def __call__(self, stage=None, status=None, returncode=None, resources=None):
+        if self.manifest is None: return
+        import sunriseManifest
+        try:
+            if stage is None:
+                sunriseManifest.update_run(self.manifest, self.run_dir, status)
+            else:
+                sunriseManifest.update_stage(self.manifest, self.run_dir, stage,
+                                             status, returncode, resources)
+        except Exception, e:
+            print 'WARNING: could not update the manifest %s: %s'%(self.manifest, e)
+
+
+def exit_code(wstatus):
+    if os.WIFSIGNALED(wstatus):
+        return -os.WTERMSIG(wstatus)
+    return os.WEXITSTATUS(wstatus)
+
+
+def run_stages(run_dir, stages, jobs, record=None, monitor=None):
+    '''
+    Start the stages whose dependencies are done, at most jobs at a time,
+    and wait for any of them to finish. Returns the timings of the stages.
+    '''
+    out = run_dir+'/output/'
+    pending = OrderedDict([(s['name'], s) for s in stages])
+    names = set(pending.keys())
+    for s in stages:
+        s['deps'] = [d for d in s['deps'] if d in names]
+    status, timings, running = {}, OrderedDict(), {}
+    record = record or (lambda *args, **kwargs: None)
+
+    while pending or running:
+        for name, s in pending.items():
+            if any([status.get(d) in ['failed', 'skipped'] for d in s['deps']]):
+                del pending[name]
+                status[name] = 'skipped'
+                timings[name] = {'status':'skipped'}
+                print 'Skipping %s, a stage it depends on failed'%name
+        for name, s in pending.items():
+            if len(running) >= jobs: break
+            if all([status.get(d) == 'done' for d in s['deps']]):
+                del pending[name]
+                log = open(out+s['log'], s['mode'])
+                if s['shell']:
+                    command = ['bash', '-c', s['command']]
+                else:
+                    command = s['command']
+                try:
+                    process = subprocess.Popen(command, cwd=out, stdout=log,
+                                               stderr=subprocess.STDOUT)
+                except OSError, e:
+                    log.write('Could not start %s: %s\n'%(command[0], e))
+                    log.close()
+                    status[name] = 'failed'
+                    timings[name] = {'status':'failed', 'error':str(e)}
+                    record(name, 'failed')
+                    print 'Could not start %s: %s'%(name, e)
+                    continue
+                log.close()
+                running[process.pid] = (name, process)
+                if monitor: monitor.add(name, process.pid)
+                status[name] = 'running'
+                timings[name] = {'start':time.time()}
+                record(name, 'running')
+                print 'Started %s'%name
+        if not running:
+            break
+        try:
+            pid, wstatus, rusage = os.wait3(0)
+        except OSError, e:
+            if e.errno == errno.EINTR: continue
+            raise
+        if pid not in running: continue
+        name, process = running.pop(pid)
+        process.returncode = exit_code(wstatus)
+        end = time.time()
+        status[name] = 'done' if process.returncode == 0 else 'failed'
+        timings[name].update(end=end, elapsed=end-timings[name]['start'],
+                             returncode=process.returncode, status=status[name])
+        extra = out+'stage-%s.json'%name
+        if os.path.exists(extra):
+            timings[name].update(json.load(open(extra)))
+            os.remove(extra)
+        resources = monitor.remove(name, rusage) if monitor else None
+        record(name, status[name], process.returncode, resources)
+        print '%s %s after %.1f s'%('Finished' if status[name] == 'done' else
+                                    'FAILED (exit code %i)'%process.returncode,
+                                    name, timings[name]['elapsed'])
+
+    for name in pending:
+        timings[name] = {'status':'skipped'}
+    return timings
+
+
+def write_timings(run_dir, timings):
+    '''
+    Save the stage timings and print a summary
+    '''
+    fh = open(run_dir+'/output/stage_timings.json', 'w')
+    json.dump(timings, fh, indent=1)
+    fh.close()
+    print '%-20s %-8s %10s'%('stage', 'status', 'time (s)')
+    for name, t in timings.iteritems():
+        print '%-20s %-8s %10s'%(name, t['status'],
+                                 '%.1f'%t['elapsed'] if 'elapsed' in t else '')
+
+
+def write_stage_info(name, info):
+    '''
+    Extra information of a task for the stage timings
+    '''
+    fh = open('stage-%s.json'%name, 'w')
+    json.dump(info, fh)
+    fh.close()
+
+
+def zero_velocities(fits_file):
+    '''
+    Set the velocities of the star particles to zero
+    '''
+    import astropy.io.fits as pyfits
+    pd,pdh = pyfits.getdata(fits_file,'PARTICLEDATA',header=True)
+    dat = np.array(pd)
+    dat['velocity'][:,:]=0.0
+    pyfits.update(fits_file,dat,header=pdh,ext=4,memmap=False)
+    print 'modified file velocity to zero'
+
+
+def task_sfrhist(run_dir, launcher):
+    '''
+    Link sfrhist.fits from the stage store, or make it: assemble a layered
+    initial.fits or copy a linked one, zero the star velocities, run
+    sfrhist and remove the assembled or copied initial.fits
+    '''
+    inp = run_dir+'/input/'
+    stage_dir = None
+    if os.path.exists(inp+'sfrhist.stage'):
+        stage_dir = open(inp+'sfrhist.stage').read().strip()
+        print 'Waiting for the lock of', stage_dir
+        sys.stdout.flush()
+        lock = stageStore.StageLock(stage_dir)
+    else:
+        lock = None
+    reused = True
+    returncode = 0
+    if lock: lock.__enter__()
+    try:
+        if stage_dir and not os.path.exists('sfrhist.fits') and \
+                stageStore.link_output(stage_dir, 'sfrhist.fits', 'sfrhist.fits'):
+            print 'Linked sfrhist.fits from', stage_dir
+        elif os.path.exists('sfrhist.fits'):
+            print 'sfrhist.fits found - skipping sfrhist'
+        else:
+            reused = False
+            layered = os.path.exists(inp+'initial.layers')
+            # A linked initial.fits is the export shared by the runs and the
+            # stage store, zero the velocities of a copy of it
+            export = None
+            if os.path.islink(inp+'initial.fits'):
+                export = os.readlink(inp+'initial.fits')
+            try:
+                if layered and not os.path.exists(inp+'initial.fits'):
+                    fitsLayers.assemble(inp+'initial.layers', inp+'initial.fits')
+                elif export:
+                    os.remove(inp+'initial.fits')
+                    shutil.copy(export, inp+'initial.fits')
+                print 'No broadband found - running sfrhist'
+                zero_velocities(inp+'initial.fits')
+                sys.stdout.flush()
+                sunrise = os.environ.get('SUNRISE_DIR', run_dir+'/sunrise')
+                returncode = subprocess.call(shlex.split(launcher)+
+                                             [sunrise+'/src/sfrhist', inp+'sfrhist.config'])
+            finally:
+                # The assembled copy is as large as the export, keep only the layers
+                if layered and os.path.exists(inp+'initial.fits'):
+                    os.remove(inp+'initial.fits')
+                    print 'Removed the assembled initial.fits'
+                elif export:
+                    if os.path.lexists(inp+'initial.fits'):
+                        os.remove(inp+'initial.fits')
+                    os.symlink(export, inp+'initial.fits')
+                    print 'Removed the copy of initial.fits'
+        if returncode == 0 and stage_dir and os.path.isfile('sfrhist.fits') \
+                and not os.path.islink('sfrhist.fits'):
+            stageStore.store_output(stage_dir, 'sfrhist.fits', 'sfrhist.fits')
+            print 'Stored sfrhist.fits in', stage_dir
+    finally:
+        if lock: lock.__exit__()
+    write_stage_info('sfrhist', {'reused':reused})
+    return returncode
+
+
+def task_mcrx(run_dir, launcher):
+    '''
+    Run mcrx. Its memory is sampled by the stage monitor of the driver.
+    '''
+    print 'starting MCRX'
+    sys.stdout.flush()
+    sunrise = os.environ.get('SUNRISE_DIR', run_dir+'/sunrise')
+    returncode = subprocess.call(shlex.split(launcher)+
+                                 [sunrise+'/src/mcrx', run_dir+'/input/mcrx.config'])
+    print 'finished MCRX'
+    for dump in glob('mcrx-*.fits'):
+        os.remove(dump)
+    return returncode
+
+
+def run(run_dir, jobs=None, launcher=None, monitor_interval=5.0, calzetti_onepass=False):
+    '''
+    Run all the stages of run_dir. Returns whether they all succeeded.
+    '''
+    run_dir = os.path.abspath(run_dir)
+    if launcher is None:
+        launcher = default_launcher()
+    skip_calzetti, skip_idl = env_flag('SKIPCALZETTI'), env_flag('SKIPIDL')
+    jobs = jobs or multiprocessing.cpu_count()
+    record = Recorder(run_dir)
+    monitor = None
+    if monitor_interval > 0:
+        monitor = StageMonitor(run_dir+'/output', monitor_interval)
+        monitor.start()
+
+    print 'Starting Sunrise run and CANDELization on %s at %s'\
+        %(os.environ.get('HOST', os.uname()[1]), run_dir)
+    record(status='running')
+    prepare(run_dir, skip_calzetti)
+    stages = build_stages(run_dir, launcher, skip_calzetti, skip_idl, calzetti_onepass)
+    t0 = time.time()
+    try:
+        timings = run_stages(run_dir, stages, jobs, record, monitor)
+    finally:
+        if monitor: monitor.close()
+    ok = all([timings[s['name']]['status'] == 'done' for s in stages if s['required']])
+    timings['total'] = {'status':'done' if ok else 'failed', 'start':t0, 'end':time.time(),
+                        'elapsed':time.time()-t0}
+    write_timings(run_dir, timings)
+    record(status='done' if ok else 'failed')
+    return ok
+
+
+if __name__ == "__main__":
+
+    args = parse()
+    run_dir = os.path.abspath(args['run_dir'])
+
+    if args['command'] == 'list':
+        for s in build_stages(run_dir, args['launcher'], env_flag('SKIPCALZETTI'),
+                              env_flag('SKIPIDL'), args['calzetti_onepass']):
+            print '%-20s after %s'%(s['name'], ', '.join(s['deps']) or '-')
+
+    elif args['command'] == 'task':
+        os.chdir(run_dir+'/output')
+        if args['task'] == 'sfrhist':
+            returncode = task_sfrhist(run_dir, args['launcher'])
+        else:
+            returncode = task_mcrx(run_dir, args['launcher'])
+        sys.exit(returncode)
+
+    else:
+        if not run(run_dir, args['jobs'], args['launcher'], args['monitor_interval'],
+                   args['calzetti_onepass']):
+            sys.exit(1)
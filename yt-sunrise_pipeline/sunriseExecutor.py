@@ -0,0 +1,326 @@
+'''
+Run prepared Sunrise run directories (see setupSunriseRun.py) on the
+local node, several at a time, within a budget of cores and memory.
+
+Runs are started longest first according to input/cost_prediction.npy
+(see sunriseCost.py), which packs the node better, and any queued run
+that fits in the cores and memory left is started. Each run gets a
+status.json file and a log file, failed runs are retried, and the state
+of the queue is saved so that an interrupted session can be resumed by
+running the same command again.
+
+Usage:
+
+    python sunriseExecutor.py sim_dir/sunrise_input --max_cores 48 --max_mem 120000
+
+Outside of a PBS job, the driver started by runSunrise.sh runs sfrhist
+and mcrx without aprun (see sunriseDriver.py --launcher). Use --command to
+run something else than runSunrise.sh in each run directory.
+'''
+import os, sys, argparse
+import json
+import time
+import socket
+import subprocess
+import multiprocessing
+import numpy as np
+
+
+script_name = 'runSunrise.sh'
+state_version = 1
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Run prepared Sunrise run directories on this node.
+                                 ''')
+
+    parser.add_argument('dirs', nargs='*', default=[],
+                        help='Run directories, or directories to search for them. '\
+                            'Optional when resuming from --state.')
+
+    parser.add_argument('--state', default='sunrise_queue.json',
+                        help='File the state of the queue is saved to and resumed from.')
+
+    parser.add_argument('--max_cores', default=None, type=int,
+                        help='Cores available to the runs. Defaults to the number of CPUs.')
+
+    parser.add_argument('--max_mem', default=None, type=float,
+                        help='Memory available to the runs in MB. Defaults to the '\
+                            'physical memory of the node.')
+
+    parser.add_argument('--cores_per_run', default=12, type=int,
+                        help='Cores of a run whose script does not request a number '\
+                            'of cpus (#PBS -l ncpus=).')
+
+    parser.add_argument('--mem_per_run', default=16000, type=float,
+                        help='Memory of a run without a cost prediction, in MB.')
+
+    parser.add_argument('--retries', default=1, type=int,
+                        help='Number of times a failed run is retried.')
+
+    parser.add_argument('--command', default='bash '+script_name,
+                        help='Command run in each run directory.')
+
+    parser.add_argument('--success_file', default='output/broadband.fits',
+                        help='File a successful run leaves behind, relative to the run '\
+                            'directory. runSunrise.sh exits with 1 when a required stage '\
+                            'fails (see sunriseDriver.py), so this only catches a stage '\
+                            'that exits with 0 without writing its output, or a --command '\
+                            'that does not report failures. Empty to only check the exit code.')
+
+    parser.add_argument('--poll', default=10.0, type=float,
+                        help='Seconds between checks of the running runs.')
+
+    parser.add_argument('--rerun', action='store_true', default=False,
+                        help='Queue runs again even if they are done or have failed.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def find_runs(dirs):
+    '''
+    Run directories (containing runSunrise.sh) in or below dirs
+    '''
+    runs = []
+    for top in dirs:
+        top = os.path.abspath(top)
+        for root, subdirs, files in os.walk(top):
+            if script_name in files:
+                runs.append(root)
+                subdirs[:] = []
+            else:
+                subdirs[:] = [d for d in subdirs if d not in ['input', 'output', 'sunrise']]
+    return sorted(runs)
+
+
+def node_memory():
+    '''
+    Physical memory of the node in MB
+    '''
+    for line in open('/proc/meminfo'):
+        if line.startswith('MemTotal:'):
+            return float(line.split()[1])/1024.0
+    raise IOError('MemTotal not found in /proc/meminfo')
+
+
+def run_cores(run_dir, default):
+    '''
+    Cores requested by the run script (#PBS -l ncpus=N)
+    '''
+    script = run_dir+'/'+script_name
+    if os.path.exists(script):
+        for line in open(script):
+            if line.startswith('#PBS') and 'ncpus=' in line:
+                try:
+                    return int(line.split('ncpus=')[1].split()[0].split(':')[0])
+                except ValueError:
+                    break
+    return default
+
+
+def run_cost(run_dir, mem_default):
+    '''
+    Predicted time (s, None if unknown) and memory (MB) of a run
+    '''
+    prediction_file = run_dir+'/input/cost_prediction.npy'
+    if not os.path.exists(prediction_file):
+        return None, mem_default
+    prediction = np.load(prediction_file)[()]
+    return prediction.get('total_time_upper'), prediction.get('mcrx_mem_upper', mem_default)
+
+
+def new_entry(run_dir, cores_per_run, mem_per_run):
+    cost, mem = run_cost(run_dir, mem_per_run)
+    return {'status':'queued', 'attempts':0, 'cores':run_cores(run_dir, cores_per_run),
+            'mem':mem, 'cost':cost, 'returncode':None, 'start':None, 'end':None}
+
+
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return {'version':state_version, 'runs':{}}
+    fh = open(state_file)
+    state = json.load(fh)
+    fh.close()
+    return state
+
+
+def save_state(state_file, state):
+    fh = open(state_file+'.tmp', 'w')
+    json.dump(state, fh, indent=1, sort_keys=True)
+    fh.close()
+    os.rename(state_file+'.tmp', state_file)
+
+
+def write_status(run_dir, entry):
+    '''
+    Status of a run in its own directory
+    '''
+    fh = open(run_dir+'/status.json', 'w')
+    json.dump(dict(entry, host=socket.gethostname(), updated=time.time()),
+              fh, indent=1, sort_keys=True)
+    fh.close()
+
+
+def queue_order(runs):
+    '''
+    Longest predicted runs first, then runs without a prediction, then by name
+    '''
+    def key(run_dir):
+        cost = runs[run_dir]['cost']
+        return (cost is None, -(cost or 0.0), run_dir)
+    return sorted([r for r, e in runs.iteritems() if e['status'] == 'queued'], key=key)
+
+
+class Executor(object):
+    '''
+    Starts the queued runs of the state within the core and memory budget
+    and records their outcome
+    '''
+
+    def __init__(self, state, state_file, max_cores, max_mem, command,
+                 retries=1, success_file='output/broadband.fits', poll=10.0):
+        self.state = state
+        self.state_file = state_file
+        self.max_cores = max_cores
+        self.max_mem = max_mem
+        self.command = command
+        self.retries = retries
+        self.success_file = success_file
+        self.poll = poll
+        self.running = {}
+
+    def save(self):
+        save_state(self.state_file, self.state)
+
+    def update(self, run_dir, **kwargs):
+        entry = self.state['runs'][run_dir]
+        entry.update(kwargs)
+        write_status(run_dir, entry)
+        self.save()
+
+    def fits(self, entry):
+        '''
+        Whether a run fits in what the running runs leave. Runs larger than
+        the whole budget are started on an otherwise idle node.
+        '''
+        runs = self.state['runs']
+        cores = sum([runs[r]['cores'] for r in self.running])
+        mem = sum([runs[r]['mem'] for r in self.running])
+        if not self.running: return True
+        return cores+entry['cores'] <= self.max_cores and mem+entry['mem'] <= self.max_mem
+
+    def start(self, run_dir):
+        entry = self.state['runs'][run_dir]
+        if entry['cores'] > self.max_cores or entry['mem'] > self.max_mem:
+            print 'WARNING: %s needs more than the budget, running it alone'%run_dir
+        log = open(run_dir+'/log-executor', 'a')
+        process = subprocess.Popen(self.command, shell=True, cwd=run_dir,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        self.running[run_dir] = process
+        self.update(run_dir, status='running', attempts=entry['attempts']+1,
+                    start=time.time(), end=None, returncode=None, pid=process.pid)
+        print 'Started %s (attempt %i, %i cores, %.0f MB)'\
+            %(run_dir, entry['attempts'], entry['cores'], entry['mem'])
+
+    def finish(self, run_dir, returncode):
+        entry = self.state['runs'][run_dir]
+        ok = returncode == 0 and (not self.success_file or
+                                  os.path.exists(run_dir+'/'+self.success_file))
+        if ok:
+            status = 'done'
+        elif entry['attempts'] <= self.retries:
+            status = 'queued'
+        else:
+            status = 'failed'
+        self.update(run_dir, status=status, returncode=returncode, end=time.time(), pid=None)
+        missing = '' if ok or returncode != 0 else ', no %s'%self.success_file
+        print '%s %s after %.0f s (exit code %i%s)'\
+            %('Finished' if ok else 'Failed', run_dir, entry['end']-entry['start'],
+              returncode, missing),
+        print '-- retrying' if status == 'queued' and not ok else ''
+
+    def run(self):
+        '''
+        Run until the queue is empty
+        '''
+        try:
+            while True:
+                for run_dir, process in self.running.items():
+                    if process.poll() is not None:
+                        del self.running[run_dir]
+                        self.finish(run_dir, process.returncode)
+                for run_dir in queue_order(self.state['runs']):
+                    if self.fits(self.state['runs'][run_dir]):
+                        self.start(run_dir)
+                if not self.running: break
+                time.sleep(self.poll)
+        except KeyboardInterrupt:
+            print 'Interrupted, stopping the running runs and saving the queue'
+            for run_dir, process in self.running.items():
+                process.terminate()
+                process.wait()
+                entry = self.state['runs'][run_dir]
+                self.update(run_dir, status='queued', attempts=entry['attempts']-1, pid=None)
+            raise
+        return summary(self.state)
+
+
+def summary(state):
+    '''
+    Number of runs in each status
+    '''
+    counts = {}
+    for entry in state['runs'].itervalues():
+        counts[entry['status']] = counts.get(entry['status'], 0)+1
+    return counts
+
+
+def execute(run_dirs, state_file='sunrise_queue.json', max_cores=None, max_mem=None,
+            cores_per_run=12, mem_per_run=16000, retries=1, command='bash '+script_name,
+            success_file='output/broadband.fits', poll=10.0, rerun=False):
+    '''
+    Add run_dirs to the queue saved in state_file and run it. Runs left
+    running by an interrupted session are queued again.
+    '''
+    state = load_state(state_file)
+    runs = state['runs']
+    for run_dir, entry in runs.iteritems():
+        if entry['status'] == 'running':
+            entry['status'] = 'queued'
+    for run_dir in run_dirs:
+        run_dir = os.path.abspath(run_dir)
+        if run_dir not in runs or (rerun and runs[run_dir]['status'] != 'queued'):
+            runs[run_dir] = new_entry(run_dir, cores_per_run, mem_per_run)
+    save_state(state_file, state)
+
+    max_cores = max_cores or multiprocessing.cpu_count()
+    max_mem = max_mem or node_memory()
+    print 'Running %i queued runs in %i cores and %.0f MB'\
+        %(len(queue_order(runs)), max_cores, max_mem)
+    executor = Executor(state, state_file, max_cores, max_mem, command,
+                        retries=retries, success_file=success_file, poll=poll)
+    counts = executor.run()
+    print 'Queue finished:', ', '.join(['%i %s'%(n, s) for s, n in sorted(counts.iteritems())])
+    return counts
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    run_dirs = find_runs(args['dirs'])
+    if args['dirs'] and not run_dirs:
+        print 'No run directories found in', args['dirs']
+
+    counts = execute(run_dirs, args['state'], args['max_cores'], args['max_mem'],
+                     args['cores_per_run'], args['mem_per_run'], args['retries'],
+                     args['command'], args['success_file'], args['poll'], args['rerun'])
+    if counts.get('failed'):
+        sys.exit(1)
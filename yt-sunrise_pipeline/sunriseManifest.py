@@ -0,0 +1,296 @@
+'''
+Manifest database of Sunrise runs. setupSunriseRun.py records every run it
+sets up (names, parameters, a hash of its inputs) and sunriseDriver.py
+updates its status, the timings and resources of its stages and its
+outputs, so that the state of thousands of runs can be queried without
+walking the run directories. The manifest is an SQLite file, by default
+sunrise_manifest.db in the input dir of the simulation.
+
+Usage:
+
+    python sunriseManifest.py status sunrise_manifest.db
+    python sunriseManifest.py list sunrise_manifest.db --status failed
+    python sunriseManifest.py show sunrise_manifest.db <run name, short name or run dir>
+    python sunriseManifest.py stages sunrise_manifest.db
+    python sunriseManifest.py update sunrise_manifest.db <run dir> --stage mcrx --status done
+'''
+import os, sys, argparse
+import json
+import time
+import hashlib
+import sqlite3
+from glob import glob
+
+import stageStore
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_dir TEXT PRIMARY KEY,
+    run_name TEXT,
+    short TEXT,
+    fits_file TEXT,
+    parameters TEXT,
+    input_hash TEXT,
+    status TEXT,
+    created REAL,
+    updated REAL,
+    outputs TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (run_name);
+CREATE INDEX IF NOT EXISTS runs_short ON runs (short);
+CREATE TABLE IF NOT EXISTS stages (
+    run_dir TEXT,
+    stage TEXT,
+    status TEXT,
+    start_time REAL,
+    end_time REAL,
+    returncode INTEGER,
+    peak_rss_mb REAL,
+    cpu_time REAL,
+    PRIMARY KEY (run_dir, stage)
+);
+'''
+
+# Columns added to the stages table since it was created, for older manifests
+stage_columns = [('peak_rss_mb', 'REAL'), ('cpu_time', 'REAL')]
+
+# Outputs recorded when a run is done, relative to the run directory
+output_patterns = ['output/*.fits', 'output/*.tar.gz', 'output/*.png', 'output/*.json',
+                   'output/images/composite*.png']
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Query or update the manifest database of Sunrise runs.
+                                 ''')
+
+    parser.add_argument('command', choices=['status', 'list', 'show', 'stages', 'update'],
+                        help="'status' counts the runs in each status, 'list' lists "\
+                            "runs, 'show' prints everything recorded about a run, "\
+                            "'stages' summarizes the stage timings and 'update' records "\
+                            "the progress of a run.")
+
+    parser.add_argument('manifest', help='Manifest database, e.g. sunrise_manifest.db')
+
+    parser.add_argument('run', nargs='?', default=None,
+                        help='Run name, short name or run directory, for show and update.')
+
+    parser.add_argument('--status', default=None,
+                        help='Only list runs with this status, or the status to record.')
+
+    parser.add_argument('--like', default=None,
+                        help="Only list or count runs whose name matches this SQL "\
+                            "pattern, e.g. '%%a0.500%%'.")
+
+    parser.add_argument('--stage', default=None,
+                        help='Stage to summarize, or whose status to record.')
+
+    parser.add_argument('--returncode', default=None, type=int,
+                        help='Exit code of the stage to record.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def connect(manifest):
+    conn = sqlite3.connect(manifest, timeout=300)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(schema)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(stages)')]
+    for column, kind in stage_columns:
+        if column not in columns:
+            conn.execute('ALTER TABLE stages ADD COLUMN %s %s'%(column, kind))
+    return conn
+
+
+def input_hash(fits_file, parameters):
+    '''
+    Hash of the exported FITS file identity and the parameters of a run
+    '''
+    inputs = {'fits_file':stageStore.file_identity(fits_file), 'parameters':parameters}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str)).hexdigest()
+
+
+def add_run(manifest, run_dir, run_name, short, fits_file, parameters, input_hash):
+    '''
+    Record a run that was just set up, replacing any earlier record. Runs
+    are keyed on their absolute, normalized run dir (see update_run).
+    '''
+    run_dir = os.path.abspath(run_dir)
+    now = time.time()
+    conn = connect(manifest)
+    with conn:
+        conn.execute('DELETE FROM stages WHERE run_dir = ?', (run_dir,))
+        conn.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?,?,?,?,?,?,?)',
+                     (run_dir, run_name, short, fits_file,
+                      json.dumps(parameters, sort_keys=True, default=str), input_hash,
+                      'set_up', now, now, None))
+    conn.close()
+
+
+def run_outputs(run_dir):
+    outputs = []
+    for pattern in output_patterns:
+        outputs += [os.path.relpath(f, run_dir) for f in sorted(glob(run_dir+'/'+pattern))]
+    return outputs
+
+
+def update_run(manifest, run_dir, status):
+    '''
+    Record the status of a run, and its outputs once it is done. run_dir
+    is normalized as in add_run, so that it matches however it is spelled.
+    '''
+    run_dir = os.path.abspath(run_dir)
+    outputs = json.dumps(run_outputs(run_dir)) if status == 'done' else None
+    conn = connect(manifest)
+    with conn:
+        conn.execute('UPDATE runs SET status = ?, updated = ?, outputs = coalesce(?, outputs) '
+                     'WHERE run_dir = ?', (status, time.time(), outputs, run_dir))
+    conn.close()
+
+
+def update_stage(manifest, run_dir, stage, status, returncode=None, resources=None):
+    '''
+    Record the status of a stage of a run. The start time is recorded
+    when it starts running, the end time when it is done or failed, with
+    its peak RSS and CPU time if resources (see stageMonitor.py) are given.
+    A failed stage fails the run.
+    '''
+    run_dir = os.path.abspath(run_dir)
+    resources = resources or {}
+    now = time.time()
+    conn = connect(manifest)
+    with conn:
+        if status == 'running':
+            conn.execute('INSERT OR REPLACE INTO stages (run_dir, stage, status, start_time) '
+                         'VALUES (?,?,?,?)', (run_dir, stage, status, now))
+        else:
+            conn.execute('INSERT OR IGNORE INTO stages (run_dir, stage) VALUES (?,?)',
+                         (run_dir, stage))
+            conn.execute('UPDATE stages SET status = ?, end_time = ?, returncode = ?, '
+                         'peak_rss_mb = ?, cpu_time = ? WHERE run_dir = ? AND stage = ?',
+                         (status, now, returncode, resources.get('peak_rss_mb'),
+                          resources.get('cpu_time'), run_dir, stage))
+        run_status = 'failed' if status == 'failed' else 'running'
+        conn.execute('UPDATE runs SET status = ?, updated = ? WHERE run_dir = ?',
+                     (run_status, now, run_dir))
+    conn.close()
+
+
+def find_runs(manifest, status=None, like=None):
+    '''
+    Records of the runs, optionally with the given status and a run name
+    matching the SQL pattern like
+    '''
+    query, values = 'SELECT * FROM runs WHERE 1', []
+    if status is not None:
+        query += ' AND status = ?'
+        values.append(status)
+    if like is not None:
+        query += ' AND run_name LIKE ?'
+        values.append(like)
+    conn = connect(manifest)
+    runs = [dict(row) for row in conn.execute(query+' ORDER BY run_name', values)]
+    conn.close()
+    return runs
+
+
+def run_record(manifest, run):
+    '''
+    Record of a run given its name, short name or directory, with its stages
+    '''
+    conn = connect(manifest)
+    row = conn.execute('SELECT * FROM runs WHERE run_name = ? OR short = ? OR run_dir = ?',
+                       (run, run, os.path.abspath(run))).fetchone()
+    if row is None:
+        conn.close()
+        return None
+    record = dict(row)
+    record['parameters'] = json.loads(record['parameters'] or 'null')
+    record['outputs'] = json.loads(record['outputs'] or 'null')
+    record['stages'] = [dict(s) for s in conn.execute(
+        'SELECT * FROM stages WHERE run_dir = ? ORDER BY start_time', (record['run_dir'],))]
+    conn.close()
+    return record
+
+
+def status_counts(manifest, like=None):
+    query, values = 'SELECT status, count(*) FROM runs', []
+    if like is not None:
+        query += ' WHERE run_name LIKE ?'
+        values.append(like)
+    conn = connect(manifest)
+    counts = dict(conn.execute(query+' GROUP BY status', values).fetchall())
+    conn.close()
+    return counts
+
+
+def stage_summary(manifest, stage=None):
+    '''
+    Number, mean and maximum time (s) and largest peak RSS (MB) of the
+    completed runs of each stage
+    '''
+    query = "SELECT stage, count(*), avg(end_time-start_time), max(end_time-start_time), "\
+        "max(peak_rss_mb) "\
+        "FROM stages WHERE status = 'done' AND start_time IS NOT NULL"
+    values = []
+    if stage is not None:
+        query += ' AND stage = ?'
+        values.append(stage)
+    conn = connect(manifest)
+    summary = conn.execute(query+' GROUP BY stage ORDER BY stage', values).fetchall()
+    conn.close()
+    return summary
+
+
+if __name__ == "__main__":
+
+    args = parse()
+    manifest = args['manifest']
+
+    if args['command'] != 'update' and not os.path.exists(manifest):
+        print 'No manifest database', manifest
+        sys.exit(1)
+
+    if args['command'] == 'status':
+        counts = status_counts(manifest, args['like'])
+        for status, n in sorted(counts.iteritems()):
+            print '%-10s %6i'%(status, n)
+        print '%-10s %6i'%('total', sum(counts.values()))
+
+    elif args['command'] == 'list':
+        for run in find_runs(manifest, args['status'], args['like']):
+            print '%-8s %-24s %s  %s'%(run['status'], run['short'], run['run_name'], run['run_dir'])
+
+    elif args['command'] == 'show':
+        record = run_record(manifest, args['run'])
+        if record is None:
+            print 'No run', args['run'], 'in', manifest
+            sys.exit(1)
+        stages = record.pop('stages')
+        for k in sorted(record.keys()):
+            print '%-12s %s'%(k, record[k])
+        for s in stages:
+            duration = s['end_time']-s['start_time'] if s['end_time'] and s['start_time'] else None
+            print '    %-12s %-8s %8s %10s'%(s['stage'], s['status'],
+                                          '%.0f s'%duration if duration is not None else '',
+                                          '%.0f MB'%s['peak_rss_mb'] if s['peak_rss_mb'] else '')
+
+    elif args['command'] == 'stages':
+        print '%-12s %6s %12s %12s %12s'%('stage', 'runs', 'mean (s)', 'max (s)', 'max rss (MB)')
+        for stage, n, mean, longest, rss in stage_summary(manifest, args['stage']):
+            print '%-12s %6i %12.0f %12.0f %12s'%(stage, n, mean, longest,
+                                                  '%.0f'%rss if rss is not None else '')
+
+    else:
+        run_dir = os.path.abspath(args['run'])
+        if args['stage'] is not None:
+            update_stage(manifest, run_dir, args['stage'], args['status'], args['returncode'])
+        else:
+            update_run(manifest, run_dir, args['status'])
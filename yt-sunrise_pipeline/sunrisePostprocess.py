@@ -0,0 +1,238 @@
+'''
+Post-processing of a Sunrise run in one process: the AB magnitudes of
+the filters and cameras asked for, from the FILTERS table of each
+broadband file opened once, and the PNGs of the candelized images.
+
+Filters are selected as for extract_mag.py, by a case-insensitive part
+of their name (e.g. nuv, bessel_u, wfcam_j), and cameras by number.
+The magnitudes are written to a JSON file and, with --names, printed
+as shell variables (<name><camera>=<magnitude>) to eval.
+
+Usage:
+
+    python sunrisePostprocess.py mags broadband.fits broadbandz.fits --filters nuv bessel_v --cameras 0 1
+    python sunrisePostprocess.py images images/
+'''
+import os, sys, argparse
+import json
+import numpy as np
+
+from plotWriter import PlotWriter
+
+
+default_filters = ['nuv', 'bessel_u', 'bessel_v', 'wfcam_j', 'wfcam_z']
+
+# The candelized images rendered by default: camera, filter, PNG name
+# suffix and label
+candelized_images = [(cam, filt, suffix, label) for cam in [0, 1]
+                     for filt, suffix, label in [('F606W', 'v', 'V '), ('F125W', 'j', 'J '),
+                                                 ('F160W', 'h', 'H '), ('F850LP', 'z', 'z ')]]
+candelized_pattern = 'broadbandz_CAMERA%i-BROADBAND_%s_candelized_noise.fits'
+
+
+def parse():
+    '''
+    Parse command line arguments
+    '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='''\
+                                 Extract magnitudes and render the candelized images
+                                 of a Sunrise run.
+                                 ''')
+
+    parser.add_argument('command', choices=['mags', 'images'],
+                        help="'mags' extracts the magnitudes of broadband files, 'images' "\
+                            "renders the candelized images of an images dir.")
+
+    parser.add_argument('inputs', nargs='+',
+                        help='Broadband files for mags, the images dir for images.')
+
+    parser.add_argument('--filters', nargs='+', default=default_filters,
+                        help='Filters, by a part of their name.')
+
+    parser.add_argument('--cameras', nargs='+', default=[0, 1], type=int,
+                        help='Cameras.')
+
+    parser.add_argument('--nonscatter', action='store_true', default=False,
+                        help='Magnitudes without scattering (AB_mag_nonscatter).')
+
+    parser.add_argument('--output', default='magnitudes.json',
+                        help='JSON file the magnitudes are written to.')
+
+    parser.add_argument('--names', nargs='+', default=None,
+                        help='Print the magnitudes of the first broadband file as shell '\
+                            'variables, named after these, one per filter.')
+
+    parser.add_argument('--scale', default=-1.0, type=float,
+                        help='Upper limit of the image stretch, -1 for the 99.5 percentile '\
+                            'of each image.')
+
+    parser.add_argument('--png_dir', default=None,
+                        help='Dir the PNGs are written to. Defaults to the images dir.')
+
+    parser.add_argument('--threads', default=2, type=int,
+                        help='Threads encoding and writing the PNGs.')
+
+    args = vars(parser.parse_args())
+    return args
+
+
+def filter_index(names, selection):
+    '''
+    Index of the filter named like selection: the one whose name without
+    extension is selection, otherwise the first that contains it
+    '''
+    lower = [n.strip().lower() for n in names]
+    selection = selection.lower()
+    for i, name in enumerate(lower):
+        if os.path.splitext(os.path.basename(name))[0] == selection:
+            return i
+    for i, name in enumerate(lower):
+        if selection in name:
+            return i
+    raise KeyError('No filter %s in %s'%(selection, ', '.join(names)))
+
+
+def magnitudes(broadband_file, filters, cameras, nonscatter=False):
+    '''
+    AB magnitudes of the filters (columns) in the cameras (rows) of a
+    broadband file, and the names of the filters. Filters the file does
+    not have get NaN magnitudes and None names.
+    '''
+    import pyfits
+    fh = pyfits.open(broadband_file, memmap=True)
+    table = fh['FILTERS'].data
+    names = list(table.field('filter'))
+    indices = []
+    for f in filters:
+        try:
+            indices.append(filter_index(names, f))
+        except KeyError:
+            print 'WARNING: no filter %s in %s'%(f, broadband_file)
+            indices.append(-1)
+    indices = np.array(indices)
+    column = 'AB_mag_nonscatter%i' if nonscatter else 'AB_mag%i'
+    mags = np.array([np.asarray(table.field(column%cam), dtype='f8')[indices]
+                     for cam in cameras]).reshape(len(cameras), len(filters))
+    mags[:, indices < 0] = np.nan
+    fh.close()
+    return mags, [names[i].strip() if i >= 0 else None for i in indices]
+
+
+def magnitude_table(broadband_files, filters, cameras, nonscatter=False):
+    '''
+    Magnitudes of each broadband file, as saved to JSON (None for the
+    filters a file does not have)
+    '''
+    table = {}
+    for broadband_file in broadband_files:
+        mags, names = magnitudes(broadband_file, filters, cameras, nonscatter)
+        table[os.path.basename(broadband_file)] = {
+            'filters':list(filters), 'filter_names':names, 'cameras':list(cameras),
+            'column':'AB_mag_nonscatter' if nonscatter else 'AB_mag',
+            'mags':[[None if np.isnan(m) else float(m) for m in row] for row in mags]}
+    return table
+
+
+def shell_variables(entry, names):
+    '''
+    <name><camera>=<magnitude> lines of a magnitude table entry, empty for
+    missing filters
+    '''
+    lines = []
+    for j, name in enumerate(names):
+        for i, cam in enumerate(entry['cameras']):
+            mag = entry['mags'][i][j]
+            lines.append('export %s%i=%s'%(name, cam, '%.2f'%mag if mag is not None else ''))
+    return lines
+
+
+def stretch(image, scale=-1.0):
+    '''
+    Asinh stretch of an image to 0-1, up to scale (the 99.5 percentile of
+    the image if scale is negative)
+    '''
+    image = np.nan_to_num(np.asarray(image, dtype='f8'))
+    if scale <= 0:
+        scale = np.percentile(image, 99.5)
+    if scale <= 0:
+        scale = image.max() or 1.0
+    noise = max(np.median(np.abs(image-np.median(image))), scale*1e-3)
+    return np.clip(np.arcsinh(image/noise)/np.arcsinh(scale/noise), 0.0, 1.0)
+
+
+def render_image(fits_file, scale=-1.0, label=None):
+    '''
+    A figure of a candelized image, one pixel per pixel, with its label
+    in the top left corner
+    '''
+    import pyfits
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    image = pyfits.getdata(fits_file)
+    dpi = 100.0
+    fig = Figure(figsize=(image.shape[1]/dpi, image.shape[0]/dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(stretch(image, scale), cmap='gray', origin='lower', interpolation='nearest',
+              vmin=0.0, vmax=1.0)
+    ax.set_axis_off()
+    if label:
+        ax.text(0.04, 0.96, label, color='white', fontsize=12, ha='left', va='top',
+                transform=ax.transAxes)
+    return fig
+
+
+def render_candelized(images_dir, png_dir=None, scale=-1.0, threads=2):
+    '''
+    Render the default candelized images of an images dir to PNGs, the
+    encoding and writing in background threads. Returns the PNGs written,
+    none if the images were not made (e.g. IDL was skipped).
+    '''
+    png_dir = png_dir or images_dir
+    if not os.path.isdir(images_dir):
+        print 'WARNING: no images dir', images_dir
+        return []
+    writer = PlotWriter(nthreads=threads)
+    written = []
+    for cam, filt, suffix, label in candelized_images:
+        fits_file = os.path.join(images_dir, candelized_pattern%(cam, filt))
+        if not os.path.exists(fits_file):
+            print 'WARNING: no', fits_file
+            continue
+        png = os.path.join(png_dir, 'cam%i_%s.png'%(cam, suffix))
+        writer.savefig(render_image(fits_file, scale, label), png, dpi=100)
+        written.append(png)
+    writer.close()
+    return written
+
+
+if __name__ == "__main__":
+
+    args = parse()
+
+    if args['command'] == 'mags':
+        table = magnitude_table(args['inputs'], args['filters'], args['cameras'],
+                                args['nonscatter'])
+        fh = open(args['output'], 'w')
+        json.dump(table, fh, indent=1, sort_keys=True)
+        fh.close()
+        if args['names']:
+            entry = table[os.path.basename(args['inputs'][0])]
+            print '\n'.join(shell_variables(entry, args['names']))
+        else:
+            for f, entry in sorted(table.iteritems()):
+                print f
+                print '%-10s'%'camera'+''.join(['%12s'%n for n in entry['filters']])
+                for cam, row in zip(entry['cameras'], entry['mags']):
+                    print '%-10i'%cam+''.join(['%12.2f'%m if m is not None else '%12s'%'-'
+                                               for m in row])
+
+    else:
+        written = render_candelized(args['inputs'][0], args['png_dir'], args['scale'],
+                                    args['threads'])
+        if written:
+            print 'Wrote', ' '.join(written)
+        else:
+            print 'WARNING: no candelized images to render'
@@ -0,0 +1,44 @@
+'''
+Galaxy properties found by findGalaxyProps.py on a snapshot and on its
+cutout written by genCutouts.py.
+
+Usage:
+
+    python -m pytest test_findGalaxyProps.py
+'''
+import numpy as np
+import pytest
+
+pytest.importorskip('yt')
+pytest.importorskip('h5py')
+
+from genCutouts import write_cutout, load_cutout
+from findGalaxyProps import galaxy_properties
+
+
+def test_cutout_properties(galaxy_snapshot, tmpdir):
+    ds = galaxy_snapshot
+    filename = str(tmpdir.join('galaxy_cutout.h5'))
+    write_cutout(ds, filename, [500.0, 500.0, 500.0], 150.0,
+                 particle_types=['stars', 'darkmatter'])
+    cells, particles = load_cutout(filename)
+
+    center, rvir = [500.0, 500.0, 500.0], 120.0
+    snap_props = galaxy_properties(ds, ds.arr(center, 'kpc'), ds.quan(rvir, 'kpc'),
+                                   shapes_nrad=0)
+    cutout_props = galaxy_properties(cells, cells.arr(center, 'kpc'), cells.quan(rvir, 'kpc'),
+                                     shapes_nrad=0, particles=particles)
+    assert sorted(snap_props) == sorted(cutout_props)
+
+    for field in ['stars_total_mass', 'stars_com', 'stars_hist_center', 'stars_rhalf',
+                  'stars_L', 'gas_total_mass', 'gas_L']:
+        assert np.allclose(snap_props[field], cutout_props[field], rtol=1e-10), field
+    for field in ['stars_mass_profile', 'gas_maxdens']:
+        for s, c in zip(snap_props[field], cutout_props[field]):
+            assert np.allclose(s, c, rtol=1e-10), field
+    assert snap_props['gas_total_mass'] > 0 and snap_props['stars_rhalf'] > 0
+
+    # The cutouts deposit the stars per oct as the octrees of the ART
+    # snapshots do, not over the whole grid, which changes the peak density
+    # but not the cell it is in
+    assert np.allclose(snap_props['stars_maxdens'][1], cutout_props['stars_maxdens'][1])
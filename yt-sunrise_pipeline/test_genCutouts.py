@@ -0,0 +1,124 @@
+'''
+Round trip of genCutouts: write cutouts of yt sample datasets, load them
+back and compare them, and the images and deposits made from them, with
+the region they were cut from.
+
+Usage:
+
+    python -m pytest test_genCutouts.py
+'''
+import numpy as np
+import pytest
+
+yt = pytest.importorskip('yt')
+pytest.importorskip('h5py')
+from yt.testing import fake_random_ds, fake_amr_ds
+
+from genCutouts import write_cutout, load_cutout, check_cutout, cell_sphere, LeafCells
+
+yt.funcs.mylog.setLevel(40)
+
+
+def set_cosmology(ds, redshift=1.5):
+    ds.cosmological_simulation = 1
+    ds.current_redshift = redshift
+    ds.omega_matter, ds.omega_lambda, ds.hubble_constant = 0.3, 0.7, 0.7
+    return ds
+
+
+def test_uniform_grid(tmpdir):
+    ds = set_cosmology(fake_random_ds(16, fields=('density', 'temperature'),
+                                      units=('g/cm**3', 'K'), particles=1000,
+                                      length_unit=(1.0, 'Mpc')))
+    filename = str(tmpdir.join('uniform_cutout.h5'))
+    write_cutout(ds, filename, [500.0, 480.0, 520.0], 200.0, particle_types=['io'])
+    assert check_cutout(ds, filename) == []
+
+    cells, particles = load_cutout(filename)
+    box = ds.box(ds.arr([300.0, 280.0, 320.0], 'kpc'), ds.arr([700.0, 680.0, 720.0], 'kpc'))
+    npart = box['io', 'particle_mass'].size
+    assert 0 < npart < 1000
+    assert particles.all_data()['io', 'particle_mass'].size == npart
+    assert ('gas', 'temperature') in cells.derived_field_list
+
+    # The comoving units are those of the snapshot
+    for c in [cells, particles]:
+        assert c.current_redshift == 1.5 and c.cosmology is not None
+        assert np.isclose(c.quan(1.0, 'kpccm/h').in_units('kpc').value, 1.0/2.5/0.7)
+
+
+def test_refined_grids(tmpdir):
+    ds = fake_amr_ds(fields=('density',), particles=20, length_unit=(1.0, 'Mpc'))
+    filename = str(tmpdir.join('amr_cutout.h5'))
+    write_cutout(ds, filename, [480.0, 510.0, 530.0], 40.0, particle_types=['io'])
+    assert check_cutout(ds, filename) == []
+
+    # The cutout keeps the refinement of the snapshot, and none of its
+    # particles are in the region
+    cells, particles = load_cutout(filename)
+    assert len(np.unique(cells.all_data()['index', 'dx'])) > 2
+    assert particles is None
+
+
+def test_check_finds_misplaced_cells(tmpdir):
+    import h5py
+
+    ds = fake_random_ds(16, fields=('density',), units=('g/cm**3',), particles=100,
+                        length_unit=(1.0, 'Mpc'))
+    filename = str(tmpdir.join('shuffled_cutout.h5'))
+    write_cutout(ds, filename, [500.0, 500.0, 500.0], 200.0, particle_types=['io'])
+    fh = h5py.File(filename, 'r+')
+    density = fh['octree/density']
+    density[:] = density[:][::-1]
+    fh.close()
+    assert any('center_x' in d for d in check_cutout(ds, filename))
+
+
+def test_leaf_deposits():
+    # A root oct refined once more in its first cell, with octs of 2x2x2
+    # cells as in the ART snapshots
+    mask = np.array([1, 1]+[0]*8+[0]*7, dtype=np.uint8)
+    ncells = 8*(mask == 0).sum()
+    ds = yt.load_octree(octree_mask=mask, data={('stream', 'density'): (np.ones((ncells, 1)), '')},
+                        bbox=np.array([[0.0, 1.0]]*3), over_refine_factor=1, partial_coverage=0)
+    ad = ds.all_data()
+    pos = np.array([ad['index', ax].v for ax in 'xyz']).transpose()
+    leaves = LeafCells(pos, ad['index', 'dx'].v, np.zeros(3), 1.0)
+
+    rng = np.random.RandomState(1)
+    positions, weights = rng.uniform(0, 1, (500, 3)), rng.uniform(1, 2, 500)
+    for method in ['cic', 'sum']:
+        def _deposit(field, data, method=method):
+            return data.ds.arr(data.deposit(data.ds.arr(positions, 'code_length'), [weights],
+                                            method=method), '')
+        ds.add_field(('deposit', method), function=_deposit, units='', sampling_type='cell',
+                     validators=[yt.ValidateSpatial()])
+        assert np.allclose(leaves.deposit(positions, weights, method), ad['deposit', method],
+                           rtol=1e-12, atol=0)
+
+
+def test_cutout_images(galaxy_snapshot, tmpdir):
+    ds = galaxy_snapshot
+    filename = str(tmpdir.join('galaxy_cutout.h5'))
+    write_cutout(ds, filename, [500.0, 500.0, 500.0], 150.0,
+                 particle_types=['stars', 'darkmatter'])
+    cells, particles = load_cutout(filename)
+
+    # The images of the gas and the stars in a cell of genSunriseInput.py
+    center, normal = [505.0, 505.0, 505.0], [1.0, 0.3, 0.2]
+    for field, units in [(('gas', 'density'), 'g/cm**2'),
+                         (('deposit', 'stars_density'), 'Msun/kpc**2')]:
+        images = []
+        for d in [ds, cells]:
+            p = yt.OffAxisProjectionPlot(d, normal, field, d.arr(center, 'kpc'),
+                                         width=(50, 'kpc'), depth=(50, 'kpc'),
+                                         north_vector=[0, 0, 1])
+            images.append(p.frb[field].in_units(units).value)
+        assert images[0].max() > 0
+        assert np.allclose(images[0], images[1], rtol=1e-10), field
+
+    # The cells of the phase plots
+    spheres = [cell_sphere(d, d.arr(center, 'kpc'), (62.5, 'kpc')) for d in [ds, cells]]
+    masses = [s['gas', 'cell_mass'].in_units('Msun').value for s in spheres]
+    assert masses[0].size == masses[1].size
+    assert np.allclose(np.sort(masses[0]), np.sort(masses[1]), rtol=1e-10)
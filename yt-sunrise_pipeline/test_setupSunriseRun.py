@@ -0,0 +1,33 @@
+'''
+Run directories set up by setupSunriseRun.py.
+
+Usage:
+
+    python -m pytest test_setupSunriseRun.py
+'''
+import os
+
+
+def test_sweep_pbs(setup_runs):
+    runs = setup_runs('--skip_calzetti', '--skip_idl', '--sweep_pbs', 'NHOURS:8:24')
+    assert None not in runs
+    run_names = [run_name for run_name, short, run_dir in runs]
+    assert [r.rsplit('_', 2)[1:] for r in run_names] == [['NHOURS', '8'], ['NHOURS', '24']]
+    assert len(set([run_dir for run_name, short, run_dir in runs])) == 2
+
+    # The swept wall clock reaches the script of each run
+    for (run_name, short, run_dir), nhours in zip(runs, [8, 24]):
+        script = open(run_dir+'/runSunrise.sh').read()
+        assert '#PBS -l walltime=%i:00:00\n'%(nhours-1) in script
+        assert '$' not in script.split('\n')[1]
+        assert 'export FULLNAME="%s"'%run_name in script
+
+
+def test_pbs_options(setup_runs):
+    (run_name, short, run_dir), = setup_runs('--skip_calzetti', '--skip_idl',
+                                             '--pbs', 'PBS_NCPUS:24')
+    assert run_name.endswith('_PBS_NCPUS_24')
+    script = open(run_dir+'/runSunrise.sh').read()
+    assert '#PBS -l ncpus=24\n' in script
+    assert '#PBS -l walltime=23:00:00\n' in script
+    assert os.path.exists(run_dir+'/input/sfrhist.config')
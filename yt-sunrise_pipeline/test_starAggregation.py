@@ -0,0 +1,122 @@
+'''
+Conservation checks of starAggregation.aggregate_stars on a synthetic
+PARTICLEDATA table, and the leaf cells of stars in a yt sample dataset.
+
+Usage:
+
+    python -m pytest test_starAggregation.py
+'''
+import numpy as np
+import pytest
+
+from starAggregation import aggregate_stars, conserved_totals, luminosity_proxy, leaf_cell_ids
+
+
+particledata_dtype = [('position', 'f8', 3), ('velocity', 'f8', 3), ('ID', 'i8'),
+                      ('mass', 'f8'), ('creation_mass', 'f8'), ('formation_time', 'f8'),
+                      ('radius', 'f8'), ('age', 'f8'), ('metallicity', 'f8')]
+
+snapshot_time = 1.2e10
+
+
+def synthetic_stars(n=5000, ncells=40, seed=1):
+    '''
+    A PARTICLEDATA table of n stars spread over ncells leaf cells, with
+    ages from 1e6 to 1e10 years, and the leaf cell of each star (-1 for the
+    tenth outside of the export region)
+    '''
+    rng = np.random.RandomState(seed)
+    pd = np.zeros(n, dtype=particledata_dtype)
+    pd['position'] = rng.uniform(-10, 10, (n, 3))
+    pd['velocity'] = rng.normal(0, 100, (n, 3))
+    pd['ID'] = np.arange(n)
+    pd['mass'] = rng.lognormal(np.log(1e4), 0.5, n)
+    pd['creation_mass'] = pd['mass']*1.3
+    pd['age'] = 10**rng.uniform(6, 10, n)
+    pd['formation_time'] = snapshot_time-pd['age']
+    pd['radius'] = 0.1
+    pd['metallicity'] = 10**rng.uniform(-4, -1.5, n)
+    cell_ids = rng.randint(0, ncells, n)
+    cell_ids[rng.uniform(size=n) < 0.1] = -1
+    return pd, cell_ids
+
+
+def test_conservation():
+    pd, cell_ids = synthetic_stars()
+    min_age = 1e8
+    out, stats = aggregate_stars(pd, cell_ids, min_age, nage_bins=8, nz_bins=4)
+
+    old = (pd['age'] > min_age) & (cell_ids >= 0)
+    assert stats['nstars_merged'] == old.sum()
+    assert out.size == (~old).sum()+stats['nsuper'] < pd.size
+    assert stats['conserved']
+
+    before, after = conserved_totals(pd), conserved_totals(out)
+    for k in ['mass', 'metal_mass', 'luminosity']:
+        assert np.isclose(after[k], before[k], rtol=1e-10, atol=0), k
+        assert stats[k] == (before[k], after[k])
+    momentum = lambda p: (p['mass'][:,np.newaxis]*p['velocity']).sum(axis=0)
+    assert np.allclose(momentum(out), momentum(pd), rtol=1e-10, atol=0)
+    assert np.isclose(out['creation_mass'].sum(), pd['creation_mass'].sum(), rtol=1e-10)
+
+
+def test_super_particles():
+    pd, cell_ids = synthetic_stars()
+    min_age = 1e8
+    out, stats = aggregate_stars(pd, cell_ids, min_age)
+
+    # Young stars and stars outside of the region are kept as they are
+    kept = ~((pd['age'] > min_age) & (cell_ids >= 0))
+    assert np.array_equal(out[:kept.sum()], pd[kept])
+
+    # Each super-particle carries the luminosity proxy of its mass and age,
+    # is old and was formed at the time of the snapshot minus its age
+    merged = out[kept.sum():]
+    assert np.all(merged['age'] > min_age)
+    assert np.allclose(merged['formation_time']+merged['age'], snapshot_time, rtol=1e-12)
+    assert np.isclose(luminosity_proxy(merged['mass'], merged['age']).sum(),
+                      luminosity_proxy(pd['mass'], pd['age'])[~kept].sum(), rtol=1e-10)
+
+
+def test_nothing_to_merge():
+    pd, cell_ids = synthetic_stars(n=100)
+    out, stats = aggregate_stars(pd, cell_ids, 1e11)
+    assert np.array_equal(out, pd)
+    assert stats['nstars_merged'] == 0 and stats['nsuper'] == 0 and stats['conserved']
+
+
+def test_leaf_cell_ids():
+    yt = pytest.importorskip('yt')
+    from yt.testing import fake_amr_ds
+    yt.funcs.mylog.setLevel(40)
+
+    ds = fake_amr_ds(fields=('density',), length_unit=(1.0, 'Mpc'))
+    center, width = ds.arr([600.0, 600.0, 700.0], 'kpc'), ds.quan(30.0, 'kpc')
+    rng = np.random.RandomState(2)
+    positions = rng.uniform(-1.3, 1.3, (400, 3))*width.value+center.value
+
+    # The leaf cell of the region each star falls in
+    region = ds.box(center-width, center+width)
+    cells = np.array([region['index', ax].in_units('kpc').value for ax in 'xyz']).T
+    dx = np.array([region['index', 'd'+ax].in_units('kpc').value for ax in 'xyz']).T
+    in_cell = np.all(np.abs(positions[:,np.newaxis]-cells) < dx/2.0, axis=2)
+    assert np.all(in_cell.sum(axis=1) <= 1) and len(np.unique(dx)) == 3
+    cell = np.where(in_cell.any(axis=1), in_cell.argmax(axis=1), -1)
+    assert 0 < (cell < 0).sum() < 200
+
+    def same_cells(ids, keys, found):
+        assert np.array_equal(ids >= 0, found)
+        pairs = set(zip(ids[found], keys[found]))
+        return len(pairs) == len(set(ids[found])) == len(set(keys[found]))
+
+    assert same_cells(leaf_cell_ids(ds, center, width, positions), cell, cell >= 0)
+
+    # Above max_level, stars share the cell of that level they are in,
+    # which may reach out of the region
+    root_dx = (ds.domain_width/ds.domain_dimensions).in_units('kpc').value
+    le = ds.domain_left_edge.in_units('kpc').value
+    root_key = lambda pos: np.dot(np.floor((pos-le)/root_dx).astype('int64'), [1024**2, 1024, 1])
+    roots = root_key(positions)
+    found = np.in1d(roots, root_key(cells))
+    assert found.sum() > (cell >= 0).sum()
+    assert same_cells(leaf_cell_ids(ds, center, width, positions, max_level=0), roots, found)
@@ -0,0 +1,68 @@
+'''
+Stages of sunriseDriver.py run with stub Sunrise executables.
+
+Usage:
+
+    python -m pytest test_sunriseDriver.py
+'''
+import os, sys
+import json
+import numpy as np
+import pyfits
+
+import sunriseDriver
+import sunriseExecutor
+import sunriseManifest
+
+
+def test_sfrhist_keeps_export(setup_runs, sunrise_inputs, monkeypatch):
+    export = sunrise_inputs['fits_file']
+    before = open(export, 'rb').read(), os.stat(export).st_mtime
+    (run_name, short, run_dir), = setup_runs('--skip_calzetti', '--skip_idl')
+    assert os.path.realpath(run_dir+'/input/initial.fits') == export
+    link = os.readlink(run_dir+'/input/initial.fits')
+
+    monkeypatch.chdir(run_dir+'/output')
+    assert sunriseDriver.task_sfrhist(run_dir, '') == 0
+    pd = pyfits.getdata(run_dir+'/output/sfrhist.fits', 'PARTICLEDATA')
+    assert np.all(pd['velocity'] == 0) and pd.size == 50
+
+    # The shared export is left as it was, and still linked into the run
+    assert (open(export, 'rb').read(), os.stat(export).st_mtime) == before
+    assert os.readlink(run_dir+'/input/initial.fits') == link
+
+    # Runs set up later with the same sfrhist inputs share its sfrhist.fits
+    (run_name, short, other_dir), = setup_runs('--skip_calzetti', '--skip_idl',
+                                               '--mcrx', 'nrays_nonscatter:1e7')
+    stage_dir = open(run_dir+'/input/sfrhist.stage').read()
+    assert open(other_dir+'/input/sfrhist.stage').read() == stage_dir
+    monkeypatch.chdir(other_dir+'/output')
+    assert sunriseDriver.task_sfrhist(other_dir, '') == 0
+    assert os.readlink('sfrhist.fits') == stage_dir.strip()+'/sfrhist.fits'
+
+
+def test_local_run(setup_runs, sunrise_inputs, monkeypatch):
+    monkeypatch.delenv('PBS_JOBID', raising=False)
+    (run_name, short, run_dir), = setup_runs('--skip_calzetti', '--skip_idl')
+
+    # runSunrise.sh runs the driver with the python of the PATH
+    bin_dir = sunrise_inputs['tmpdir'].mkdir('bin')
+    bin_dir.join('python').mksymlinkto(sys.executable)
+    monkeypatch.setenv('PATH', str(bin_dir)+os.pathsep+os.environ['PATH'])
+
+    state_file = str(sunrise_inputs['tmpdir'].join('sunrise_queue.json'))
+    counts = sunriseExecutor.execute([run_dir], state_file, max_cores=12, max_mem=32000,
+                                     poll=0.1)
+    assert counts == {'done':1}, open(run_dir+'/log-executor').read()
+
+    timings = json.load(open(run_dir+'/output/stage_timings.json'))
+    for name in ['sfrhist', 'mcrx', 'aux', 'broadband', 'broadbandz', 'total']:
+        assert timings[name]['status'] == 'done', name
+    assert pyfits.getheader(run_dir+'/output/aux.fits', 'MCRX')['N_CAMERA'] == 1
+    assert os.path.exists(run_dir+'/output/broadbandz.fits')
+
+    manifest = open(run_dir+'/input/manifest').read().strip()
+    record = sunriseManifest.run_record(manifest, run_name)
+    assert record['status'] == 'done'
+    stages = dict([(s['stage'], s['status']) for s in record['stages']])
+    assert stages['mcrx'] == stages['broadband'] == 'done'
@@ -0,0 +1,41 @@
+'''
+The manifest records of runs set up by setupSunriseRun.py and updated by
+sunriseDriver.py.
+
+Usage:
+
+    python -m pytest test_sunriseManifest.py
+'''
+import os
+
+import sunriseManifest
+from sunriseDriver import Recorder
+
+
+def test_driver_updates_setup_record(setup_runs, sunrise_inputs):
+    (run_name, short, run_dir), = setup_runs('--skip_calzetti', '--skip_idl')
+    manifest = open(run_dir+'/input/manifest').read().strip()
+    assert manifest == os.path.join(sunrise_inputs['input_dir'], 'sunrise_manifest.db')
+
+    record = sunriseManifest.run_record(manifest, run_name)
+    assert record['status'] == 'set_up'
+    assert record['run_dir'] == os.path.abspath(run_dir)
+
+    # The driver records the run under its absolute run dir
+    record = Recorder(run_dir)
+    record(status='running')
+    record('sfrhist', 'running')
+    record('sfrhist', 'done', 0, {'peak_rss_mb':12.0, 'cpu_time':3.0})
+    record('mcrx', 'running')
+
+    record = sunriseManifest.run_record(manifest, short)
+    assert record['status'] == 'running'
+    stages = dict([(s['stage'], s) for s in record['stages']])
+    assert sorted(stages) == ['mcrx', 'sfrhist']
+    assert stages['sfrhist']['status'] == 'done' and stages['sfrhist']['returncode'] == 0
+    assert stages['sfrhist']['peak_rss_mb'] == 12.0
+    assert stages['mcrx']['status'] == 'running'
+
+    Recorder(run_dir)(status='done')
+    assert sunriseManifest.run_record(manifest, run_dir)['status'] == 'done'
+    assert [r['run_name'] for r in sunriseManifest.find_runs(manifest, 'done')] == [run_name]